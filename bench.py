@@ -0,0 +1,304 @@
+"""
+Microbenchmarks für den Daten-Layer und die Helfer von bot.py
+
+    python bench.py                          # small: 1k Chats, 100k Nachrichten
+    python bench.py --size large --json new.json
+    python bench.py --json new.json --compare old.json   # Exit-Code 1 bei Regression
+
+Die synthetische DB wird einmal erzeugt (deterministisch per --seed) und bei gleichen
+Parametern wiederverwendet. Jeder Lauf misst auf einer frischen Kopie davon, die
+Schreib-Benchmarks (new_message, log_msg, ...) verändern das Original also nie.
+Gemessen werden die `.sync`-Varianten der DB-Funktionen (also ohne Event-Loop/Thread-Hop),
+die In-Memory-Indizes und die reinen Helfer.
+"""
+
+import argparse
+import json
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from telegram import Chat as TgChat, Message, PhotoSize, Voice
+
+import bot
+
+SIZES = {
+    "small": (1_000, 100_000),
+    "medium": (100_000, 5_000_000),
+    "large": (1_000_000, 20_000_000),
+    "huge": (1_000_000, 50_000_000),
+}
+
+FIRST_NAMES = ["Anna", "Ben", "Clara", "David", "Emma", "Felix", "Greta", "Hannah", "Jonas", "Lea", "Lukas", "Marie",
+               "Noah", "Paul", "Sophie", "Tim", "Zoë", "Jörg", "Özlem", "Mia"]
+LAST_NAMES = ["Müller", "Schmidt", "Schneider", "Fischer", "Weber", "Meyer", "Wagner", "Becker", "Schulz", "Hoffmann", ""]
+WORDS = ("bestellung lieferung rechnung paket adresse zahlung rückerstattung konto passwort frage danke hallo "
+         "problem termin preis rabatt gutschein versand größe farbe umtausch retoure nummer status heute morgen").split()
+
+USER_ID_BASE = 1_000_000
+CHUNK = 100_000
+
+# ============================================================
+# SYNTHETISCHE DATENBANK
+# ============================================================
+
+def generate(path: Path, chats: int, messages: int, seed: int):
+    """Build a bench DB with the real schema (bot.init_db). FTS is rebuilt once at the end instead of per-row triggers"""
+    rng = random.Random(seed)
+    bot.DB_PATH = path
+    bot.init_db()
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("DROP TRIGGER IF EXISTS messages_fts_ai")
+    conn.execute("DROP TRIGGER IF EXISTS chats_change_ai")  # Änderungs-Log für andere Instanzen – beim Bulk-Load unnötig
+    now = datetime.now()
+
+    def chat_rows():
+        for i in range(chats):
+            status = rng.choices(["unread", "read", "answered", "closed"], [20, 10, 50, 20])[0]
+            last_message = now - timedelta(minutes=rng.randint(0, 60 * 24 * 60))
+            last_reply = last_message + timedelta(minutes=rng.randint(1, 600)) if status == "answered" else None
+            yield (USER_ID_BASE + i, f"user{i}" if rng.random() < 0.6 else None,
+                   rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), USER_ID_BASE + i, status,
+                   rng.choices(["normal", "vip", "urgent"], [93, 5, 2])[0],
+                   rng.randint(1, 5) if status == "unread" else 0,
+                   " ".join(rng.choices(WORDS, k=5)), "text", last_message, last_reply, int(status == "closed"),
+                   rng.choice([0, 0, 0, 1, 2]), None, 0, "🔴")
+
+    def message_rows():
+        for _ in range(messages):
+            yield (USER_ID_BASE + rng.randrange(chats), rng.choice(["in", "out"]), "text",
+                   " ".join(rng.choices(WORDS, k=rng.randint(3, 12))), "", 0,
+                   now - timedelta(minutes=rng.randint(0, 60 * 24 * 365)))
+
+    for sql, rows, total in [
+        ("""INSERT INTO chats (user_id, username, first_name, last_name, topic_id, status, priority, unread_count,
+            last_message_preview, last_message_type, last_message_at, last_reply_at, is_archived,
+            followup_stage, followup_skipped_until, followup_done, topic_name) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+         chat_rows(), chats),
+        ("INSERT INTO messages (user_id, direction, msg_type, content, file_id, duration, created_at) VALUES (?,?,?,?,?,?,?)",
+         message_rows(), messages),
+    ]:
+        done = 0
+        while done < total:
+            batch = [row for _, row in zip(range(CHUNK), rows)]
+            conn.executemany(sql, batch)
+            conn.commit()
+            done += len(batch)
+            print(f"\r  {sql.split()[2]}: {done:,}/{total:,}", end="", file=sys.stderr)
+        print(file=sys.stderr)
+
+    if bot.FTS_ENABLED:
+        print("  messages_fts: rebuild", file=sys.stderr)
+        conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+    print("  chat_stats: backfill", file=sys.stderr)
+    bot.backfill_chat_stats(conn)
+    conn.execute("CREATE TABLE bench_meta (chats INTEGER, messages INTEGER, seed INTEGER)")
+    conn.execute("INSERT INTO bench_meta VALUES (?,?,?)", (chats, messages, seed))
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    bot.init_db()  # Trigger wieder anlegen
+
+def remove_db(path: Path):
+    for suffix in ("", "-wal", "-shm"):
+        Path(f"{path}{suffix}").unlink(missing_ok=True)
+
+def prepare(path: Path, chats: int, messages: int, seed: int, fresh: bool):
+    if path.exists() and not fresh:
+        try:
+            with sqlite3.connect(path) as conn:
+                meta = conn.execute("SELECT chats, messages, seed FROM bench_meta").fetchone()
+                counts = conn.execute("SELECT (SELECT COUNT(*) FROM chats), (SELECT COUNT(*) FROM messages)").fetchone()
+        except sqlite3.Error:
+            meta = None
+        if meta == (chats, messages, seed):
+            if counts != (chats, messages):
+                sys.exit(f"❌ {path}: {counts[0]:,} Chats / {counts[1]:,} Nachrichten statt {chats:,} / {messages:,} laut "
+                         f"bench_meta – die Messdaten wurden verändert, mit --fresh neu erzeugen")
+            bot.DB_PATH = path
+            bot.init_db()  # Schema-Änderungen (Indizes, Trigger) einmal im Original nachziehen
+            return
+    remove_db(path)
+    print(f"Erzeuge {path} ({chats:,} Chats, {messages:,} Nachrichten) ...", file=sys.stderr)
+    generate(path, chats, messages, seed)
+
+def working_copy(path: Path) -> Path:
+    """Fresh copy of the bench DB for one run, so every run measures the same data"""
+    copy = path.with_name(f"{path.stem}.run{path.suffix}")
+    remove_db(copy)
+    with sqlite3.connect(path) as src, sqlite3.connect(copy) as dst:
+        src.backup(dst)
+    bot.DB_PATH = copy
+    return copy
+
+# ============================================================
+# MESSUNG
+# ============================================================
+
+def measure(fn, args_fn, seconds: float, max_n: int) -> dict:
+    """Time single calls until `seconds` or `max_n` are used up (min. 5); µs statistics"""
+    for _ in range(min(3, max_n)):
+        fn(*args_fn())
+    times = []
+    deadline = time.perf_counter() + seconds
+    while len(times) < max_n and (len(times) < 5 or time.perf_counter() < deadline):
+        args = args_fn()
+        t0 = time.perf_counter_ns()
+        fn(*args)
+        times.append(time.perf_counter_ns() - t0)
+    times.sort()
+    return {
+        "n": len(times),
+        "median_us": round(statistics.median(times) / 1000, 2),
+        "p95_us": round(times[int(len(times) * 0.95) - 1 if len(times) > 1 else 0] / 1000, 2),
+        "mean_us": round(statistics.fmean(times) / 1000, 2),
+        "min_us": round(times[0] / 1000, 2),
+    }
+
+def sample_messages() -> list:
+    chat = TgChat(1, "private")
+    date = datetime.now()
+    return [
+        Message(1, date, chat, text="Hallo, wo ist meine Bestellung 4711?"),
+        Message(2, date, chat, photo=(PhotoSize("a", "a", 90, 90), PhotoSize("b", "b", 800, 800)), caption="Screenshot"),
+        Message(3, date, chat, voice=Voice("v", "v", 12)),
+    ]
+
+def benchmarks(chats: int, rng: random.Random) -> list:
+    """(name, fn, args_fn, max_n) – heavy full-table operations get fewer iterations"""
+    conn = bot.get_db()
+    user_ids = [r[0] for r in conn.execute("SELECT user_id FROM chats")]
+    active = bot.Chat.get_all_active.sync()
+    bot.INBOX.rebuild(active)
+    bot.NAMES.rebuild(active)
+    for uid in user_ids[:bot.CHAT_CACHE_SIZE]:
+        bot.CHAT_CACHE.by_user[uid] = {"user_id": uid, "topic_id": uid}
+
+    uid = lambda: (rng.choice(user_ids),)
+    now = datetime.now()
+    stale_cutoff = now - timedelta(days=bot.ARCHIVE_AFTER_DAYS)
+    msgs = sample_messages()
+    chat_row = dict(active[0]) if active else None
+    queries = [bot.parse_search(q) for q in ["bestellung", '"danke hallo"', "rück*", "paket dir:in", "rechnung ab:2020-01-01"]]
+    heavy = 20 if chats > 10_000 else 200
+
+    return [
+        # Chat-Layer (Cache-Miss-Pfad von Chat.get / get_by_topic)
+        ("Chat.load", bot.Chat.load.sync, uid, 100_000),
+        ("Chat.load_by_topic", bot.Chat.load_by_topic.sync, uid, 100_000),
+        ("CHAT_CACHE.get (hit)", bot.CHAT_CACHE.get, uid, 1_000_000),
+        ("Chat.new_message", bot.Chat.new_message.sync, lambda: (rng.choice(user_ids), "Hallo", "text"), 20_000),
+        ("Chat.mark_answered", bot.Chat.mark_answered.sync, uid, 20_000),
+        ("log_msg", bot.log_msg.sync, lambda: (rng.choice(user_ids), "in", "text", "Hallo Bestellung", "", 0), 20_000),
+        ("log_msgs (album 10)", bot.log_msgs.sync, lambda: (rng.choice(user_ids), "in", [("photo", "Foto", "f", 0)] * 10), 5_000),
+        ("get_chat_stats", bot.get_chat_stats.sync, uid, 20_000),
+        ("get_notes", bot.get_notes.sync, uid, 50_000),
+        # Listen / Jobs
+        ("Chat.get_all_active", bot.Chat.get_all_active.sync, lambda: (), heavy),
+        ("Chat.get_followups_due", bot.Chat.get_followups_due.sync, lambda: (), heavy),
+        ("Chat.get_followups_page", bot.Chat.get_followups_page.sync, lambda: (), 20_000),
+        ("Chat.count_followups_due", bot.Chat.count_followups_due.sync, lambda: (), 5_000),
+        ("Chat.get_stale", bot.Chat.get_stale.sync, lambda: (stale_cutoff,), 5_000),
+        ("search_messages", bot.search_messages.sync, lambda: (rng.choice(queries),), 2_000),
+        # In-Memory-Indizes
+        ("INBOX.rebuild", bot.INBOX.rebuild, lambda: (active,), heavy),
+        ("INBOX.page (unread)", bot.INBOX.page, lambda: (["unread"],), 100_000),
+        ("INBOX.update", bot.INBOX.update, lambda: (chat_row,), 100_000),
+        ("NAMES.find", bot.NAMES.find, lambda: (rng.choice(FIRST_NAMES),), 20_000),
+        # Reine Helfer
+        ("extract_info", bot.extract_info, lambda: (rng.choice(msgs),), 200_000),
+        ("get_topic_name", bot.get_topic_name, lambda: (chat_row,), 200_000),
+        ("topic_title", bot.topic_title, lambda: (chat_row,), 200_000),
+        ("time_ago", bot.time_ago, lambda: (now - timedelta(minutes=rng.randint(0, 100_000)),), 200_000),
+        ("parse_search", bot.parse_search, lambda: ('bestellung "danke hallo" dir:in ab:2024-01-01',), 200_000),
+        ("normalize_name", bot.normalize_name, lambda: ("Zoë-Marie @Müller_K",), 200_000),
+    ]
+
+# ============================================================
+# VERGLEICH
+# ============================================================
+
+def compare(results: dict, baseline: dict, threshold: float, noise_us: float) -> list:
+    """Print new vs. old medians; returns the names that got slower than `threshold`×"""
+    regressions = []
+    print(f"\n{'Benchmark':<28} {'alt µs':>12} {'neu µs':>12} {'Faktor':>8}")
+    for name, new in results.items():
+        old = baseline.get(name)
+        if not old:
+            print(f"{name:<28} {'–':>12} {new['median_us']:>12.2f}")
+            continue
+        ratio = new["median_us"] / old["median_us"] if old["median_us"] else float("inf")
+        slower = ratio > threshold and new["median_us"] - old["median_us"] > noise_us
+        if slower: regressions.append(name)
+        print(f"{name:<28} {old['median_us']:>12.2f} {new['median_us']:>12.2f} {ratio:>7.2f}x{'  ❌' if slower else ''}")
+    return regressions
+
+def git_rev() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        return ""
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks für bot.py")
+    parser.add_argument("--size", choices=SIZES, default="small")
+    parser.add_argument("--chats", type=int, help="überschreibt --size")
+    parser.add_argument("--messages", type=int, help="überschreibt --size")
+    parser.add_argument("--db", type=Path, help="Bench-DB (Default: im Temp-Verzeichnis, wird wiederverwendet)")
+    parser.add_argument("--fresh", action="store_true", help="DB neu erzeugen")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--seconds", type=float, default=1.0, help="Zeitbudget pro Benchmark")
+    parser.add_argument("--only", help="nur Benchmarks, deren Name diesen Text enthält")
+    parser.add_argument("--json", type=Path, help="Ergebnisse als JSON schreiben")
+    parser.add_argument("--compare", type=Path, help="mit früherem --json vergleichen")
+    parser.add_argument("--threshold", type=float, default=1.25, help="ab diesem Faktor langsamer = Regression")
+    parser.add_argument("--noise-us", type=float, default=5.0, help="Unterschiede darunter ignorieren")
+    args = parser.parse_args()
+
+    chats, messages = SIZES[args.size]
+    chats, messages = args.chats or chats, args.messages if args.messages is not None else messages
+    path = args.db or Path(tempfile.gettempdir()) / f"support-bench-{chats}-{messages}-{args.seed}.db"
+    prepare(path, chats, messages, args.seed, args.fresh)
+    copy = working_copy(path)
+
+    rng = random.Random(args.seed)
+    results = {}
+    print(f"{'Benchmark':<28} {'n':>8} {'median µs':>12} {'p95 µs':>12} {'ops/s':>12}")
+    try:
+        for name, fn, args_fn, max_n in benchmarks(chats, rng):
+            if args.only and args.only.lower() not in name.lower(): continue
+            r = results[name] = measure(fn, args_fn, args.seconds, max_n)
+            print(f"{name:<28} {r['n']:>8} {r['median_us']:>12.2f} {r['p95_us']:>12.2f} {1e6 / r['mean_us']:>12.0f}")
+    finally:
+        bot.close_db()
+        remove_db(copy)
+
+    report = {
+        "meta": {"chats": chats, "messages": messages, "seed": args.seed, "git": git_rev(),
+                 "python": platform.python_version(), "sqlite": sqlite3.sqlite_version, "fts": bot.FTS_ENABLED,
+                 "date": datetime.now().isoformat(timespec="seconds")},
+        "results": results,
+    }
+    if args.json:
+        args.json.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        if baseline["meta"].get("chats") != chats or baseline["meta"].get("messages") != messages:
+            print("⚠️ Vergleichslauf hatte andere DB-Größe", file=sys.stderr)
+        regressions = compare(results, baseline["results"], args.threshold, args.noise_us)
+        if regressions:
+            print(f"\n❌ {len(regressions)} Regression(en): {', '.join(regressions)}")
+            sys.exit(1)
+        print("\n✅ Keine Regression")
+
+if __name__ == "__main__":
+    main()
@@ -6,18 +6,34 @@ Fühlt sich an wie normales Telegram-Chatten.
 + Ultra Follow-Up System mit Reminders
 """
 
+import abc
 import asyncio
+import bisect
+import functools
+import heapq
+import itertools
+import json
 import logging
 import sqlite3
 import os
+import sys
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Optional, List, Tuple
+from typing import Awaitable, Callable, Optional, List, Tuple
 import html
+import re
+import socket
 
-from telegram import Update, Bot, Message
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
+from telegram import Update, Bot, Message, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Application, BaseRateLimiter, BaseUpdateProcessor, CallbackQueryHandler, CommandHandler, MessageHandler, ContextTypes, filters
 from telegram.constants import ParseMode, ChatAction
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 
 # ============================================================
 # KONFIGURATION (Environment Variables oder Defaults)
@@ -27,13 +43,58 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "8544263228:AAGh08e5WK6N7NEVUNfQyEhembOQSwCVY
 SUPPORT_GROUP_ID = int(os.getenv("SUPPORT_GROUP_ID", "-1003740182436"))
 ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", "2089427192,6696982829").split(",")]
 
+# Webhook statt Polling, sobald WEBHOOK_URL gesetzt ist (öffentliche Basis-URL, z.B. https://bot.example.com)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")   # wird von Telegram als X-Telegram-Bot-Api-Secret-Token mitgeschickt
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Andere Bot-API (z.B. lokaler Fake-Server zum Testen oder selbst gehosteter telegram-bot-api)
+BOT_API_URL = os.getenv("BOT_API_URL", "")
+
+# Mehrere Instanzen (Webhook hinter Load Balancer): eine hält die Leader-Lease und macht Jobs, Timer, Broadcasts
+LEASE_BACKEND = os.getenv("LEASE_BACKEND", "sqlite")   # siehe LEASE_BACKENDS
+LEASE_TTL_SECONDS = 15       # so lange gilt die Lease ohne Verlängerung → Failover-Zeit
+LEASE_RENEW_SECONDS = 5
+REPLICA_ID = os.getenv("REPLICA_ID", "") or f"{socket.gethostname()}-{os.getpid()}"
+REPLICA_SYNC_MS = int(os.getenv("REPLICA_SYNC_MS", "1000"))   # Chat-Änderungen anderer Instanzen übernehmen
+# Anzahl Instanzen: die Token Buckets leben pro Prozess, also bekommt jede nur ihren Anteil am Global- und Gruppenlimit
+REPLICAS = max(1, int(os.getenv("REPLICAS", "1")))
+CHAT_CHANGES_KEEP_MINUTES = 10
+
+# Prometheus-Metriken unter http://<METRICS_LISTEN>:<METRICS_PORT>/metrics (0 = aus), Übersicht per /stats
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "0.0.0.0")
+
+# Der Bot verarbeitet nur Nachrichten + Blätter-Buttons – alles andere gar nicht erst abonnieren
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
 ARCHIVE_AFTER_DAYS = 14
 DIGEST_INTERVAL_MINUTES = 30
 TYPING_INDICATOR = True
+ARCHIVE_BATCH_SIZE = 100   # Chats pro Archiv-Transaktion (kurze Write-Locks)
+
+# Telegram Flood Limits (global ~30/s, 1/s pro Privatchat, ~20/min pro Gruppe)
+RATE_GLOBAL_PER_SECOND = 30
+RATE_PRIVATE_PER_SECOND = 1
+RATE_GROUP_PER_MINUTE = 20
+RATE_MAX_RETRIES = 3
+TOPIC_RENAME_DELAY = 3   # Sekunden: Statuswechsel sammeln, dann max. eine Umbenennung
+TOPIC_RENAME_MAX_DELAY = 300   # Umbenennen gescheitert (Netzwerk, Flood, Rechte) → Backoff bis max. 5 Min.
+MAX_CONCURRENT_UPDATES = 256   # parallel verarbeitete Updates (verschiedene Kunden/Topics)
+ALBUM_WINDOW_MS = 800   # Alben (media_group_id) so lange sammeln, dann als Ganzes weiterleiten
+
+# Broadcasts
+BROADCAST_CONCURRENCY = 30       # parallele Sends (Tempo regelt der Rate Limiter)
+BROADCAST_MAX_ATTEMPTS = 3       # bei Netzwerkfehlern
+BROADCAST_PROGRESS_SECONDS = 30  # Fortschritt-Update im Status (jede Edit kostet Budget aus RATE_GROUP_PER_MINUTE)
 
 # Follow-Up Einstellungen
 FOLLOWUP_AFTER_HOURS = 24   # Nach 24h ohne Antwort → Follow-up fällig
 FOLLOWUP_MORNING_HOUR = 9   # Täglicher Report um 9:00
+FOLLOWUP_STAGES_HOURS = [FOLLOWUP_AFTER_HOURS, 72, 168]   # Erinnerung 1/2/3: Stunden nach der letzten Antwort
+FOLLOWUP_RETRY_MINUTES = 5  # Erinnerung konnte nicht gepostet werden → neuer Versuch
 
 WELCOME_MESSAGE = """Hey! 👋
 
@@ -52,15 +113,161 @@ TEMPLATES = {
     "erledigt": "Super, freut mich! ✅ Bei Fragen melde dich.",
 }
 
+# ============================================================
+# METRICS (Prometheus-Textformat + /stats)
+# ============================================================
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # letzter Bucket = +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimate from the buckets (linear within a bucket, like Prometheus' histogram_quantile)"""
+        if not self.count: return 0.0
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = LATENCY_BUCKETS[i - 1] if i else 0.0
+                upper = LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else LATENCY_BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return LATENCY_BUCKETS[-1]
+
+class Metrics:
+    """Counters, latency histograms and gauges (read on scrape), labelled like Prometheus – event loop only"""
+
+    def __init__(self):
+        self.counters = {}    # (name, labels) → float
+        self.histograms = {}  # (name, labels) → Histogram
+        self.gauges = {}      # (name, labels) → callable
+        self.started = time.time()
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram()
+        hist.observe(seconds)
+
+    def gauge(self, name: str, fn: Callable[[], float], **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = fn
+
+    def series(self, name: str) -> dict:
+        """labels dict → Histogram/counter value of one metric (for /stats)"""
+        return {labels: v for (n, labels), v in itertools.chain(self.counters.items(), self.histograms.items()) if n == name}
+
+    def render(self) -> str:
+        def fmt(labels, extra=()):
+            pairs = [f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in (*labels, *extra)]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+        lines = []
+        for kind, items in (("counter", self.counters), ("gauge", self.gauges)):
+            for name in sorted({n for n, _ in items}):
+                lines.append(f"# TYPE {name} {kind}")
+                for (n, labels), value in items.items():
+                    if n != name: continue
+                    if callable(value):
+                        try: value = value()
+                        except Exception: continue
+                    lines.append(f"{name}{fmt(labels)} {value}")
+        for name in sorted({n for n, _ in self.histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (n, labels), hist in self.histograms.items():
+                if n != name: continue
+                total = 0
+                for le, count in zip((*LATENCY_BUCKETS, "+Inf"), hist.counts):
+                    total += count
+                    lines.append(f"{name}_bucket{fmt(labels, [('le', le)])} {total}")
+                lines.append(f"{name}_sum{fmt(labels)} {hist.sum}")
+                lines.append(f"{name}_count{fmt(labels)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+def timed(metric: str, label: str):
+    """Record the duration (and failures) of a handler/job coroutine as `metric`{label=<function name>}"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                METRICS.inc(f"{metric}_errors_total", **{label: fn.__name__})
+                raise
+            finally:
+                METRICS.observe(f"{metric}_seconds", time.perf_counter() - t0, **{label: fn.__name__})
+        return wrapper
+    return decorator
+
+async def serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Minimal HTTP/1.1 for Prometheus: GET /metrics"""
+    try:
+        request = (await reader.readline()).split()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""): pass
+        if len(request) > 1 and request[1] == b"/metrics":
+            status, body = "200 OK", METRICS.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
 # ============================================================
 # DATABASE
 # ============================================================
 
-DB_PATH = Path(__file__).parent / "support.db"
+DB_PATH = Path(os.getenv("DB_PATH", Path(__file__).parent / "support.db"))
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")  # FULL = jede Transaktion sofort auf Platte
+DB_BUSY_TIMEOUT_MS = 5000
+DB_STATEMENT_CACHE = 256     # Prepared Statements pro Verbindung
+DB_CHECKPOINT_MINUTES = 5
+# Group Commit: Writes werden gesammelt und gemeinsam committed (ein fsync pro Batch)
+JOURNAL_FLUSH_MS = int(os.getenv("JOURNAL_FLUSH_MS", "5"))
+JOURNAL_MAX_BATCH = int(os.getenv("JOURNAL_MAX_BATCH", "200"))
+# commit = Handler wartet bis Nachrichten-Log committed ist; async = Log wird nur eingereiht
+# (bei Absturz gehen max. JOURNAL_FLUSH_MS Log-Einträge verloren, Chat-Status wird immer abgewartet)
+DB_DURABILITY = os.getenv("DB_DURABILITY", "commit")
+SEARCH_PAGE_SIZE = 10
+LIST_PAGE_SIZE = 10          # /inbox, /all, /followup: Einträge pro Seite (◀️ ▶️ blättern)
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", "10000"))  # Chats im RAM (LRU), Hot Path ohne Read-Queries
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "180"))      # ältere Nachrichten → Monatsarchive (0 = nie)
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "")                    # Default: archive/ neben der DB
+RETENTION_BATCH = 2000       # Nachrichten pro Transaktion
+RETENTION_STEP_MS = 200      # so lange am Stück auf dem Writer, dann kommen wieder normale Writes dran
+RETENTION_INTERVAL_MINUTES = 60
+VACUUM_PAGES = 512           # Seiten pro incremental_vacuum-Schritt
+FTS_ENABLED = True           # False wenn SQLite ohne FTS5 gebaut ist → LIKE-Fallback
 
 def init_db():
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
+    # Freie Seiten (nach der Retention) schrittweise per incremental_vacuum zurückgeben statt VACUUM der ganzen DB
+    if c.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        if c.execute("SELECT 1 FROM sqlite_master").fetchone():
+            logging.info("Einmalige Umstellung auf auto_vacuum=INCREMENTAL (VACUUM) …")
+            c.execute("VACUUM")
+    c.execute("PRAGMA journal_mode=WAL")
     c.execute("""
         CREATE TABLE IF NOT EXISTS chats (
             user_id INTEGER PRIMARY KEY,
@@ -80,7 +287,8 @@ def init_db():
             followup_enabled INTEGER DEFAULT 1,
             followup_stage INTEGER DEFAULT 0,
             followup_skipped_until TIMESTAMP,
-            followup_done INTEGER DEFAULT 0
+            followup_done INTEGER DEFAULT 0,
+            topic_name TEXT
         )
     """)
     c.execute("""
@@ -112,221 +320,1093 @@ def init_db():
         )
     """)
     
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_by INTEGER,
+            target_name TEXT,
+            message TEXT,
+            status TEXT DEFAULT 'running',
+            status_chat_id INTEGER,
+            status_message_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id INTEGER,
+            user_id INTEGER,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            error TEXT,
+            sent_at TIMESTAMP,
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+    """)
+    # Auto-Archiv: noch zu schließende Topics – wird mit dem Archivieren committed, übersteht Neustarts
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS topic_close_queue (
+            topic_id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Retention: Monatsarchive (archive/messages-YYYY-MM.db) und was von ihnen im Hot-DB bleibt
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS message_archives (
+            month TEXT PRIMARY KEY,
+            messages INTEGER DEFAULT 0,
+            sealed INTEGER DEFAULT 0
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS archived_counts (
+            user_id INTEGER,
+            month TEXT,
+            total INTEGER DEFAULT 0,
+            incoming INTEGER DEFAULT 0,
+            outgoing INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, month)
+        ) WITHOUT ROWID
+    """)
+    
+    # Nachrichten-Zähler pro Chat (by_type = JSON {msg_type: Anzahl}), gepflegt von log_msg/log_msgs
+    stats_exists = c.execute("SELECT 1 FROM sqlite_master WHERE name='chat_stats'").fetchone()
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS chat_stats (
+            user_id INTEGER PRIMARY KEY,
+            total INTEGER DEFAULT 0,
+            incoming INTEGER DEFAULT 0,
+            outgoing INTEGER DEFAULT 0,
+            by_type TEXT DEFAULT '{}',
+            first_message_at TIMESTAMP,
+            last_message_at TIMESTAMP,
+            first_in_at TIMESTAMP,
+            first_response_at TIMESTAMP
+        )
+    """)
+    # Vor dem Backfill anlegen – sonst läuft er beim ersten Start auf einer großen DB ohne Index
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_user ON messages(user_id, direction)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_created ON messages(created_at)")
+    if not stats_exists:
+        backfill_chat_stats(conn)
+    
+    # Mehrere Instanzen: Leader-Lease und Änderungs-Log der Chats (per Trigger, auch für Writes anderer Prozesse)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT,
+            expires_at REAL,
+            acquired_at REAL
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS chat_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chat_changes_time ON chat_changes(changed_at)")
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS chats_change_ai AFTER INSERT ON chats BEGIN
+            INSERT INTO chat_changes (user_id) VALUES (new.user_id);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS chats_change_au AFTER UPDATE ON chats BEGIN
+            INSERT INTO chat_changes (user_id) VALUES (new.user_id);
+        END
+    """)
+    
+    # Indizes für die Hot Queries (siehe HOT_QUERIES / check_query_plans)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chats_topic ON chats(topic_id) WHERE is_archived=0")
+    # Follow-ups: partielle Indizes nur über offene Follow-ups, sortiert wie SQL_FOLLOWUPS_* (kein Sortieren aller beantworteten Chats)
+    c.execute("DROP INDEX IF EXISTS idx_chats_status")
+    c.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_chats_followups ON chats(({SQL_PRIORITY_RANK}), last_reply_at, user_id)
+        WHERE {SQL_FOLLOWUPS_OPEN}
+    """)
+    c.execute(f"CREATE INDEX IF NOT EXISTS idx_chats_followups_due ON chats(last_reply_at) WHERE {SQL_FOLLOWUPS_OPEN}")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chats_last_message ON chats(last_message_at) WHERE is_archived=0")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notes_user ON notes(user_id, created_at)")
+    
+    # Volltextsuche über messages.content (External Content → kein doppelter Text, Sync per Trigger)
+    global FTS_ENABLED
+    try:
+        fts_exists = c.execute("SELECT 1 FROM sqlite_master WHERE name='messages_fts'").fetchone()
+        c.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+        c.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+            END
+        """)
+        c.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            END
+        """)
+        c.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+            END
+        """)
+        if not fts_exists:
+            # Bestehende Historie einmalig indizieren
+            c.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+    except sqlite3.OperationalError as e:
+        logging.warning(f"FTS5 nicht verfügbar, /search nutzt LIKE: {e}")
+        FTS_ENABLED = False
+    
     # Migration: Add followup columns if not exist
     try:
         c.execute("ALTER TABLE chats ADD COLUMN followup_enabled INTEGER DEFAULT 1")
-    except: pass
+    except sqlite3.OperationalError: pass  # Spalte existiert schon
     try:
         c.execute("ALTER TABLE chats ADD COLUMN followup_stage INTEGER DEFAULT 0")
-    except: pass
+    except sqlite3.OperationalError: pass
     try:
         c.execute("ALTER TABLE chats ADD COLUMN followup_skipped_until TIMESTAMP")
-    except: pass
+    except sqlite3.OperationalError: pass
     try:
         c.execute("ALTER TABLE chats ADD COLUMN followup_done INTEGER DEFAULT 0")
-    except: pass
+    except sqlite3.OperationalError: pass
+    try:
+        c.execute("ALTER TABLE chats ADD COLUMN topic_name TEXT")
+    except sqlite3.OperationalError: pass
+    
+    # Migration (einmalig, user_version 0 → 1): Follow-up-Timer gibt es erst seitdem. Bereits überfällige Stufen
+    # gelten als erinnert – sonst postet der erste Start in jedes alte Topic auf einmal (Gruppenlimit 20/min).
+    # Sie bleiben in /followup und im Morgen-Report.
+    if c.execute("PRAGMA user_version").fetchone()[0] < 1:
+        now = datetime.now()
+        overdue = " + ".join("(last_reply_at <= ?)" for _ in FOLLOWUP_STAGES_HOURS)
+        c.execute(f"UPDATE chats SET followup_stage = MAX(COALESCE(followup_stage, 0), {overdue}) WHERE {SQL_FOLLOWUPS_OPEN}",
+                  [now - timedelta(hours=h) for h in FOLLOWUP_STAGES_HOURS])
+        c.execute("PRAGMA user_version = 1")
     
     conn.commit()
     conn.close()
 
-def get_db():
-    return sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES)
+def backfill_chat_stats(conn: sqlite3.Connection):
+    """One-time migration: chat_stats from the existing message log. Archived months only contribute their
+    totals (archived_counts) – types and timestamps come from the messages still in the hot DB"""
+    conn.execute("DELETE FROM chat_stats")
+    conn.execute("""
+        INSERT INTO chat_stats (user_id, total, incoming, outgoing, first_message_at, last_message_at, first_in_at)
+        SELECT user_id, COUNT(*), SUM(CASE WHEN direction='in' THEN 1 ELSE 0 END), SUM(CASE WHEN direction='out' THEN 1 ELSE 0 END),
+               MIN(created_at), MAX(created_at), MIN(CASE WHEN direction='in' THEN created_at END)
+        FROM messages GROUP BY user_id
+    """)
+    # Set-basiert: je ein Durchlauf über messages statt einer Subquery pro Chat
+    conn.execute("""
+        UPDATE chat_stats SET by_type = t.by_type FROM (
+            SELECT user_id, json_group_object(t, n) AS by_type FROM (
+                SELECT user_id, COALESCE(msg_type, 'unknown') AS t, COUNT(*) AS n FROM messages GROUP BY user_id, t)
+            GROUP BY user_id) AS t
+        WHERE chat_stats.user_id = t.user_id
+    """)
+    conn.execute("""
+        UPDATE chat_stats SET first_response_at = r.first_response_at FROM (
+            SELECT m.user_id, MIN(m.created_at) AS first_response_at FROM messages m JOIN chat_stats s ON s.user_id = m.user_id
+            WHERE m.direction = 'out' AND m.created_at >= s.first_in_at GROUP BY m.user_id) AS r
+        WHERE chat_stats.user_id = r.user_id
+    """)
+    conn.execute("""
+        INSERT INTO chat_stats (user_id, total, incoming, outgoing)
+        SELECT user_id, SUM(total), SUM(incoming), SUM(outgoing) FROM archived_counts WHERE 1 GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            total = total + excluded.total, incoming = incoming + excluded.incoming, outgoing = outgoing + excluded.outgoing
+    """)
+
+# Jeder DB-Thread hält eine eigene, langlebige Verbindung (Writer + kleiner Read-Pool)
+_db_local = threading.local()
+_db_connections: List[sqlite3.Connection] = []
+_db_connections_lock = threading.Lock()
+
+def _init_db_thread(readonly: bool):
+    _db_local.readonly = readonly
+
+def get_db() -> sqlite3.Connection:
+    """Long-lived connection of the current DB thread (opened on first use)"""
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                               cached_statements=DB_STATEMENT_CACHE, check_same_thread=False)
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        conn.execute("PRAGMA journal_size_limit=67108864")  # WAL nach Checkpoint auf 64 MB kürzen
+        if getattr(_db_local, "readonly", False):
+            conn.execute("PRAGMA query_only=1")
+        with _db_connections_lock:
+            _db_connections.append(conn)
+        _db_local.conn = conn
+    return conn
+
+# Alle DB-Zugriffe laufen in eigenen Threads, nie direkt im Event-Loop.
+# Ein Writer (SQLite erlaubt nur einen), Leser parallel dank WAL.
+DB_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write", initializer=_init_db_thread, initargs=(False,))
+DB_READERS = ThreadPoolExecutor(max_workers=DB_READ_POOL_SIZE, thread_name_prefix="db-read", initializer=_init_db_thread, initargs=(True,))
+
+def _run_write(fn, *args, **kwargs):
+    conn = get_db()
+    try:
+        result = fn(*args, **kwargs)
+        conn.commit()
+        return result
+    except:
+        conn.rollback()
+        raise
+
+def db_read(fn):
+    """Make a blocking read-only DB function awaitable (runs on the read pool); `.sync` runs it in the calling thread"""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        t0 = time.perf_counter()
+        try:
+            return await loop.run_in_executor(DB_READERS, functools.partial(fn, *args, **kwargs))
+        finally:
+            METRICS.observe("support_db_seconds", time.perf_counter() - t0, op=fn.__qualname__, kind="read")
+    wrapper.sync = fn
+    return wrapper
+
+def _run_batch(batch: list) -> list:
+    """Writer thread: run queued writes in ONE transaction (one fsync); each op isolated by a savepoint"""
+    conn = get_db()
+    results = []
+    conn.execute("BEGIN")
+    try:
+        for fn, args, kwargs, _ in batch:
+            conn.execute("SAVEPOINT op")
+            try:
+                results.append((True, fn(*args, **kwargs)))
+                conn.execute("RELEASE op")
+            except Exception as e:
+                conn.execute("ROLLBACK TO op")
+                conn.execute("RELEASE op")
+                results.append((False, e))
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    return results
+
+class Journal:
+    """Group commit for all db_write calls: queued writes are flushed by a single task every
+    JOURNAL_FLUSH_MS or JOURNAL_MAX_BATCH items, in one transaction on the writer thread"""
+
+    def __init__(self):
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def submit(self, fn, args, kwargs) -> asyncio.Future:
+        if self.task is None:
+            self.queue = asyncio.Queue()
+            self.task = asyncio.get_running_loop().create_task(self._run(), name="db-journal")
+        fut = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((fn, args, kwargs, fut))
+        return fut
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + JOURNAL_FLUSH_MS / 1000
+            while len(batch) < JOURNAL_MAX_BATCH:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            await self._flush(batch)
+
+    async def _flush(self, batch: list):
+        t0 = time.perf_counter()
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(DB_WRITER, _run_batch, batch)
+        except Exception as e:
+            results = [(False, e)] * len(batch)
+        METRICS.observe("support_db_commit_seconds", time.perf_counter() - t0)
+        METRICS.inc("support_db_commits_total")
+        METRICS.inc("support_db_committed_ops_total", len(batch))
+        for (*_, fut), (ok, result) in zip(batch, results):
+            if fut.done(): continue
+            if ok: fut.set_result(result)
+            else: fut.set_exception(result)
+
+    async def close(self):
+        """Flush-on-shutdown: stop the flusher and commit whatever is still queued"""
+        if self.task is None: return
+        self.task.cancel()
+        try: await self.task
+        except asyncio.CancelledError: pass
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        if batch: await self._flush(batch)
+        self.task = None
+
+JOURNAL = Journal()
+
+def db_write(fn):
+    """Make a blocking DB write awaitable (group-committed via JOURNAL); `.sync` runs + commits it in the calling thread"""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return await JOURNAL.submit(fn, args, kwargs)
+        finally:
+            # inkl. Warten auf den Group Commit
+            METRICS.observe("support_db_seconds", time.perf_counter() - t0, op=fn.__qualname__, kind="write")
+    wrapper.sync = functools.partial(_run_write, fn)
+    return wrapper
+
+def db_log(fn):
+    """db_write for append-only log writes nobody reads back right away:
+    with DB_DURABILITY=async the caller doesn't wait for the commit"""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        fut = JOURNAL.submit(fn, args, kwargs)
+        if DB_DURABILITY == "async":
+            fut.add_done_callback(_log_journal_error)
+            return None
+        return await fut
+    wrapper.sync = functools.partial(_run_write, fn)
+    return wrapper
+
+def _log_journal_error(fut: asyncio.Future):
+    if not fut.cancelled() and fut.exception():
+        logging.error(f"Journal write failed: {fut.exception()!r}")
+
+async def db_checkpoint():
+    """Fold the WAL back into the main DB file without blocking readers or the writer"""
+    def checkpoint():
+        get_db().execute("PRAGMA wal_checkpoint(PASSIVE)")
+    await asyncio.get_running_loop().run_in_executor(DB_WRITER, checkpoint)
+
+def close_db():
+    DB_WRITER.shutdown(wait=True)
+    DB_READERS.shutdown(wait=True)
+    with _db_connections_lock:
+        for conn in _db_connections:
+            conn.close()
+        _db_connections.clear()
+
+# ============================================================
+# HOT QUERIES (+ Indizes in init_db)
+# ============================================================
+
+SQL_CHAT_BY_TOPIC = "SELECT * FROM chats WHERE topic_id = ? AND is_archived = 0"
+
+SQL_ALL_ACTIVE = """
+    SELECT * FROM chats WHERE is_archived=0
+    ORDER BY CASE status WHEN 'unread' THEN 1 WHEN 'read' THEN 2 ELSE 3 END, last_message_at DESC
+"""
+
+# Get answered chats where:
+# - Not archived
+# - Status is 'answered' (we replied, waiting for customer)
+# - Follow-up not done yet
+# - Last reply older than 24h
+# - Not skipped
+SQL_PRIORITY_RANK = "CASE priority WHEN 'urgent' THEN 1 WHEN 'vip' THEN 2 ELSE 3 END"
+
+# Prädikat der partiellen Follow-up-Indizes – muss wörtlich in der Query stehen, damit SQLite sie nimmt
+SQL_FOLLOWUPS_OPEN = "is_archived=0 AND status='answered' AND followup_done=0"
+
+SQL_FOLLOWUPS_WHERE = f"""
+    WHERE {SQL_FOLLOWUPS_OPEN}
+    AND last_reply_at < ?
+    AND (followup_skipped_until IS NULL OR followup_skipped_until < ?)
+"""
+
+SQL_FOLLOWUPS_DUE = f"SELECT * FROM chats {SQL_FOLLOWUPS_WHERE} ORDER BY {SQL_PRIORITY_RANK}, last_reply_at, user_id"
+
+# Keyset-Seiten für /followup: Cursor = (Priorität, last_reply_at, user_id) der letzten bzw. ersten gezeigten Zeile
+SQL_FOLLOWUPS_NEXT = f"""
+    SELECT * FROM chats {SQL_FOLLOWUPS_WHERE} AND ({SQL_PRIORITY_RANK}, last_reply_at, user_id) > (?, ?, ?)
+    ORDER BY {SQL_PRIORITY_RANK}, last_reply_at, user_id LIMIT ?
+"""
+SQL_FOLLOWUPS_PREV = f"""
+    SELECT * FROM chats {SQL_FOLLOWUPS_WHERE} AND ({SQL_PRIORITY_RANK}, last_reply_at, user_id) < (?, ?, ?)
+    ORDER BY {SQL_PRIORITY_RANK} DESC, last_reply_at DESC, user_id DESC LIMIT ?
+"""
+SQL_FOLLOWUPS_COUNT = f"SELECT COUNT(*) FROM chats {SQL_FOLLOWUPS_WHERE}"
+
+SQL_STALE = "SELECT * FROM chats WHERE is_archived=0 AND last_message_at<? ORDER BY last_message_at LIMIT ?"
+SQL_STALE_COUNT = "SELECT COUNT(*) FROM chats WHERE is_archived=0 AND last_message_at<?"
+
+# Ein Batch des Auto-Archivs: set-basiert statt UPDATE pro Chat
+SQL_ARCHIVE_BATCH = """
+    UPDATE chats SET is_archived=1, status='closed'
+    WHERE user_id IN (SELECT user_id FROM chats WHERE is_archived=0 AND last_message_at<? ORDER BY last_message_at LIMIT ?)
+    RETURNING *
+"""
+
+# Retention: ein Batch der ältesten Nachrichten; ids kommen als JSON-Liste, damit Kopieren und Löschen dieselben Zeilen treffen
+SQL_RETENTION_IDS = "SELECT id FROM messages WHERE created_at < ? ORDER BY created_at LIMIT ?"
+SQL_RETENTION_COPY = """
+    INSERT OR IGNORE INTO arch.messages
+    SELECT id, user_id, direction, msg_type, content, file_id, duration, created_at
+    FROM main.messages WHERE id IN (SELECT value FROM json_each(?))
+"""
+SQL_RETENTION_COUNT = """
+    INSERT INTO archived_counts (user_id, month, total, incoming, outgoing)
+    SELECT user_id, ?, COUNT(*), SUM(CASE WHEN direction='in' THEN 1 ELSE 0 END), SUM(CASE WHEN direction='out' THEN 1 ELSE 0 END)
+    FROM main.messages WHERE id IN (SELECT value FROM json_each(?)) GROUP BY user_id
+    ON CONFLICT (user_id, month) DO UPDATE SET
+        total = total + excluded.total, incoming = incoming + excluded.incoming, outgoing = outgoing + excluded.outgoing
+"""
+
+# /info: Zähler pro Chat statt COUNT über messages
+SQL_CHAT_STATS = "SELECT * FROM chat_stats WHERE user_id=?"
+
+# In derselben Transaktion wie das INSERT in messages (log_msg/log_msgs), einmal pro Nachrichtentyp
+SQL_COUNT_MESSAGES = """
+    INSERT INTO chat_stats (user_id, total, incoming, outgoing, by_type, first_message_at, last_message_at, first_in_at)
+    VALUES (:user_id, :n, :incoming, :outgoing, json_object(:type, :n), CURRENT_TIMESTAMP, CURRENT_TIMESTAMP,
+            CASE WHEN :incoming > 0 THEN CURRENT_TIMESTAMP END)
+    ON CONFLICT (user_id) DO UPDATE SET
+        total = total + :n, incoming = incoming + :incoming, outgoing = outgoing + :outgoing,
+        by_type = json_set(by_type, '$."' || :type || '"', COALESCE(json_extract(by_type, '$."' || :type || '"'), 0) + :n),
+        first_message_at = COALESCE(first_message_at, excluded.first_message_at),
+        last_message_at = excluded.last_message_at,
+        first_in_at = COALESCE(first_in_at, excluded.first_in_at),
+        first_response_at = CASE WHEN first_response_at IS NULL AND first_in_at IS NOT NULL AND :outgoing > 0
+                                 THEN excluded.last_message_at ELSE first_response_at END
+"""
+
+# Leader-Lease nehmen oder verlängern: nur wenn sie uns gehört oder abgelaufen ist (RETURNING leer = gehört jemand anderem)
+SQL_ACQUIRE_LEASE = """
+    INSERT INTO leases (name, holder, expires_at, acquired_at) VALUES (:name, :holder, :expires_at, :now)
+    ON CONFLICT (name) DO UPDATE SET
+        acquired_at = CASE WHEN holder = excluded.holder THEN acquired_at ELSE excluded.acquired_at END,
+        holder = excluded.holder, expires_at = excluded.expires_at
+    WHERE holder = excluded.holder OR expires_at < :now
+    RETURNING holder
+"""
+
+# Chat-Änderungen seit dem letzten Abgleich (eine Zeile pro Chat)
+SQL_CHAT_CHANGES = "SELECT user_id, MAX(seq) FROM chat_changes WHERE seq > ? GROUP BY user_id"
+
+SQL_NOTES = "SELECT note, created_at FROM notes WHERE user_id=? ORDER BY created_at DESC LIMIT ?"
+
+# Basis der /search-Query, Filter werden in search_messages() angehängt
+SQL_SEARCH = """
+    SELECT m.content, m.direction, c.first_name, m.created_at,
+           snippet(messages_fts, 0, char(2), char(3), '…', 10), rank
+    FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid JOIN chats c ON c.user_id = m.user_id
+    WHERE messages_fts MATCH ?
+"""
+
+HOT_QUERIES = {
+    "Chat.get_by_topic": SQL_CHAT_BY_TOPIC,
+    "Chat.get_all_active": SQL_ALL_ACTIVE,
+    "Chat.get_followups_due": SQL_FOLLOWUPS_DUE,
+    "Chat.get_followups_page": SQL_FOLLOWUPS_NEXT,
+    "Chat.get_followups_page (zurück)": SQL_FOLLOWUPS_PREV,
+    "Chat.count_followups_due": SQL_FOLLOWUPS_COUNT,
+    "Chat.get_stale": SQL_STALE,
+    "Chat.count_stale": SQL_STALE_COUNT,
+    "Chat.archive_stale": SQL_ARCHIVE_BATCH,
+    "get_chat_stats": SQL_CHAT_STATS,
+    "run_retention": SQL_RETENTION_IDS,
+    "get_notes": SQL_NOTES,
+    "acquire_lease": SQL_ACQUIRE_LEASE,
+    "ChatChangeFeed": SQL_CHAT_CHANGES,
+    "search_messages": SQL_SEARCH + " ORDER BY rank LIMIT ?",
+}
+
+# Liefern ohnehin alle aktiven Chats – Scan über den partiellen Index (nur is_archived=0) und Sortieren sind ok
+INDEX_SCAN_OK = {"Chat.get_all_active"}
+# Partielle Indizes, die nur die offenen Fälle enthalten – ein Scan darüber liest nichts Überflüssiges
+NARROW_INDEXES = {"idx_chats_followups"}
+
+def check_query_plans(conn: sqlite3.Connection) -> List[str]:
+    """EXPLAIN QUERY PLAN every hot query; returns the ones that fall back to a scan or sort in a temp b-tree"""
+    problems = []
+    for name, sql in HOT_QUERIES.items():
+        names = set(re.findall(r"(?<![:\w]):(\w+)", sql))
+        params = dict.fromkeys(names) if names else (None,) * sql.count("?")
+        plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        scans = [p for p in plan if p.startswith("SCAN ") and "VIRTUAL TABLE" not in p
+                 and not p.startswith("SCAN (")  # Ergebnis einer Subquery, keine Tabelle
+                 and not (name in INDEX_SCAN_OK and " USING " in p)
+                 and not any(p.endswith(f" USING INDEX {idx}") for idx in NARROW_INDEXES)]
+        # Temp-B-Tree fürs ORDER BY = alle Treffer lesen und sortieren, bevor LIMIT greift
+        scans += [p for p in plan if p.startswith("USE TEMP B-TREE FOR") and "ORDER BY" in p and name not in INDEX_SCAN_OK]
+        if scans:
+            problems.append(f"{name}: {'; '.join(scans)}")
+    return problems
 
 # ============================================================
 # CHAT MANAGER
 # ============================================================
 
+class ChatCache:
+    """Bounded LRU of chat rows indexed by user_id and topic_id (only touched from the event loop)"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.by_user: "OrderedDict[int, dict]" = OrderedDict()
+        self.by_topic = {}
+
+    def get(self, user_id: int) -> Optional[dict]:
+        chat = self.by_user.get(user_id)
+        if chat is None: return None
+        self.by_user.move_to_end(user_id)
+        return dict(chat)
+
+    def get_by_topic(self, topic_id: int) -> Optional[dict]:
+        user_id = self.by_topic.get(topic_id)
+        return self.get(user_id) if user_id is not None else None
+
+    def put(self, chat: dict) -> dict:
+        """Write-through from a Chat mutator – always wins"""
+        INBOX.update(chat)
+        NAMES.update(chat)
+        FOLLOWUPS.update(chat)
+        self.invalidate(chat['user_id'])
+        self.by_user[chat['user_id']] = dict(chat)
+        # Wie SQL_CHAT_BY_TOPIC: archivierte Chats sind per Topic nicht auffindbar
+        if chat['topic_id'] and not chat['is_archived']:
+            self.by_topic[chat['topic_id']] = chat['user_id']
+        while len(self.by_user) > self.max_size:
+            self.invalidate(next(iter(self.by_user)))
+        return dict(chat)
+
+    def fill(self, chat: Optional[dict]) -> Optional[dict]:
+        """Cache a row read from the DB, unless a write-through landed while it was being read"""
+        if chat is None: return None
+        cached = self.get(chat['user_id'])
+        return cached if cached is not None else self.put(chat)
+
+    def invalidate(self, user_id: Optional[int] = None):
+        """Drop one chat (or everything) – next access reads from SQLite again"""
+        if user_id is None:
+            self.by_user.clear()
+            self.by_topic.clear()
+            return
+        chat = self.by_user.pop(user_id, None)
+        if chat and self.by_topic.get(chat['topic_id']) == user_id:
+            del self.by_topic[chat['topic_id']]
+
+CHAT_CACHE = ChatCache(CHAT_CACHE_SIZE)
+
+PRIORITY_RANK = {"urgent": 1, "vip": 2}     # Rest: 3
+STATUS_ORDER = ["unread", "read", "answered"]
+
+class InboxIndex:
+    """All open chats (is_archived=0) in memory with one sorted view per status, ordered like the inbox:
+    priority, then newest message first. Maintained on every chat change (CHAT_CACHE.put), loaded at startup"""
+
+    def __init__(self):
+        self.chats = {}   # user_id → row
+        self.keys = {}    # user_id → (status, sort key)
+        self.views = {}   # status → sortierte Liste von sort keys
+
+    @staticmethod
+    def sort_key(chat: dict) -> tuple:
+        ts = chat['last_message_at']
+        return (PRIORITY_RANK.get(chat['priority'], 3), -ts.timestamp() if ts else float("inf"), chat['user_id'])
+
+    def rebuild(self, chats: List[dict]):
+        self.chats, self.keys, self.views = {}, {}, {}
+        for chat in chats:
+            self.chats[chat['user_id']] = dict(chat)
+            self.keys[chat['user_id']] = (chat['status'], self.sort_key(chat))
+            self.views.setdefault(chat['status'], []).append(self.sort_key(chat))
+        for view in self.views.values():
+            view.sort()
+
+    def update(self, chat: dict):
+        user_id = chat['user_id']
+        new = None if chat['is_archived'] else (chat['status'], self.sort_key(chat))
+        old = self.keys.get(user_id)
+        if old != new:
+            if old:
+                view = self.views[old[0]]
+                del view[bisect.bisect_left(view, old[1])]
+                del self.keys[user_id]
+            if new:
+                bisect.insort(self.views.setdefault(new[0], []), new[1])
+                self.keys[user_id] = new
+        if new: self.chats[user_id] = dict(chat)
+        else: self.chats.pop(user_id, None)
+
+    def count(self, status: str = None) -> int:
+        return len(self.views.get(status, ())) if status else len(self.chats)
+
+    def view(self, status: str, limit: int = None) -> List[dict]:
+        """Chats of one status in inbox order (only the first `limit` are materialized)"""
+        return [self.chats[key[-1]] for key in itertools.islice(self.views.get(status, ()), limit)]
+
+    def older_than(self, status: str, ts: datetime, limit: int) -> Tuple[int, List[dict]]:
+        """(count, first `limit` in inbox order) of the chats of one status whose last message is older than ts –
+        one bisect per priority instead of a pass over the whole view"""
+        view, bound = self.views.get(status, []), -ts.timestamp()
+        count, rows = 0, []
+        for rank in sorted(set(PRIORITY_RANK.values()) | {3}):
+            lo = bisect.bisect_right(view, (rank, bound, float("inf")))
+            hi = bisect.bisect_left(view, (rank, float("inf")))   # ohne last_message_at → nicht mitzählen
+            count += max(hi - lo, 0)
+            rows += [self.chats[key[-1]] for key in view[lo:min(hi, lo + limit - len(rows))]]
+        return count, rows
+
+    def statuses(self) -> List[str]:
+        """Order of /all: unread, read, answered, then anything else"""
+        return STATUS_ORDER + sorted(set(self.views) - set(STATUS_ORDER))
+
+    def page(self, statuses: List[str], cursor: tuple = None, forward: bool = True, limit: int = LIST_PAGE_SIZE):
+        """Keyset page over the given views in sequence. cursor = (view index, *sort key) of the last (forward)
+        or first (backward) row shown. Returns ([(cursor, chat)], position of the first row, total)"""
+        views = [self.views.get(s, []) for s in statuses]
+        total = sum(map(len, views))
+        if cursor is None:
+            pos = 0
+        else:
+            i, key = cursor[0], tuple(cursor[1:])
+            pos = sum(map(len, views[:i])) + (bisect.bisect_right if forward else bisect.bisect_left)(views[i], key)
+        start = pos if forward else max(pos - limit, 0)
+        end = min(start + limit, total)
+        
+        rows, offset = [], 0
+        for i, view in enumerate(views):
+            for key in view[max(start - offset, 0):max(end - offset, 0)]:
+                rows.append(((i, *key), self.chats[key[-1]]))
+            offset += len(view)
+        return rows, start, total
+
+INBOX = InboxIndex()
+
+def normalize_name(text: str) -> str:
+    """Casefold, strip accents and punctuation: 'Zoë-Marie @Müller_K' → 'zoe marie muller_k'"""
+    text = "".join(ch for ch in unicodedata.normalize("NFKD", text) if not unicodedata.combining(ch))
+    return " ".join(re.sub(r"[^\w\s]", " ", text.casefold()).split())
+
+def name_grams(word: str) -> set:
+    """Trigrams of a word plus ' xy' for its start – short queries (2 chars) match word prefixes"""
+    padded = " " + word
+    return {padded[i:i + 3] for i in range(len(padded) - 2)} or {padded}
+
+class NameIndex:
+    """Trigram index over first name, last name and username of all open chats (is_archived=0),
+    maintained next to INBOX. find() returns ranked matches: exact > word prefix > substring"""
+
+    def __init__(self):
+        self.names = {}   # user_id → normalisierter Suchtext
+        self.grams = {}   # trigram → set(user_id)
+
+    def rebuild(self, chats: List[dict]):
+        self.names, self.grams = {}, {}
+        for chat in chats:
+            self.update(chat)
+
+    def update(self, chat: dict):
+        user_id = chat['user_id']
+        text = None if chat['is_archived'] else normalize_name(" ".join(filter(None, (chat['first_name'], chat['last_name'], chat['username']))))
+        old = self.names.get(user_id)
+        if old == text: return
+        if old is not None:
+            for gram in set().union(*map(name_grams, old.split())):
+                users = self.grams.get(gram)
+                if users: users.discard(user_id)
+                if not users: self.grams.pop(gram, None)
+            del self.names[user_id]
+        if text is not None:
+            for gram in set().union(*map(name_grams, text.split())):
+                self.grams.setdefault(gram, set()).add(user_id)
+            self.names[user_id] = text
+
+    def find(self, query: str, limit: int = 5) -> List[Tuple[int, dict]]:
+        """[(rank, chat)], best first; rank 0 = every word is a whole name part, 1 = a name part prefix, 2 = a substring"""
+        words = normalize_name(query).split()
+        if not words: return []
+        # Kandidaten: Schnittmenge der Trigramme (1-Zeichen-Wörter filtern nicht vor)
+        grams = [g for w in words if len(w) > 1 for g in (name_grams(w) - {" " + w[:2]} if len(w) > 2 else {" " + w})]
+        candidates = set.intersection(*(self.grams.get(g, set()) for g in grams)) if grams else set(self.names)
+        
+        matches = []
+        for user_id in candidates:
+            text = self.names[user_id]
+            tokens = text.split()
+            if all(w in tokens for w in words): rank = 0
+            elif all(any(t.startswith(w) for t in tokens) for w in words): rank = 1
+            elif all(w in text for w in words): rank = 2
+            else: continue
+            chat = INBOX.chats.get(user_id)
+            if chat: matches.append((rank, chat))
+        # Bei Gleichstand: zuletzt aktiver Kunde zuerst
+        matches.sort(key=lambda m: (m[0], INBOX.sort_key(m[1])[1]))
+        return matches[:limit]
+
+NAMES = NameIndex()
+
+def _chat_row(c: sqlite3.Cursor) -> Optional[dict]:
+    row = c.fetchone()
+    if row:
+        cols = [d[0] for d in c.description]
+        return dict(zip(cols, row))
+    return None
+
+def chat_write(fn):
+    """db_write for Chat mutators: they return the updated row (RETURNING *), which is written through to CHAT_CACHE"""
+    write = db_write(fn)
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        chat = await write(*args, **kwargs)
+        return CHAT_CACHE.put(chat) if chat else None
+    wrapper.sync = write.sync
+    return wrapper
+
 class Chat:
     @staticmethod
-    def get(user_id: int) -> Optional[dict]:
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("SELECT * FROM chats WHERE user_id = ?", (user_id,))
-        row = c.fetchone()
-        if row:
-            cols = [d[0] for d in c.description]
-            conn.close()
-            return dict(zip(cols, row))
-        conn.close()
-        return None
+    async def get(user_id: int) -> Optional[dict]:
+        chat = CHAT_CACHE.get(user_id)
+        return chat if chat is not None else CHAT_CACHE.fill(await Chat.load(user_id))
 
     @staticmethod
-    def get_by_topic(topic_id: int) -> Optional[dict]:
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("SELECT * FROM chats WHERE topic_id = ? AND is_archived = 0", (topic_id,))
-        row = c.fetchone()
-        if row:
-            cols = [d[0] for d in c.description]
-            conn.close()
-            return dict(zip(cols, row))
-        conn.close()
-        return None
+    async def get_by_topic(topic_id: int) -> Optional[dict]:
+        chat = CHAT_CACHE.get_by_topic(topic_id)
+        return chat if chat is not None else CHAT_CACHE.fill(await Chat.load_by_topic(topic_id))
 
     @staticmethod
-    def create(user_id: int, username: str, first_name: str, last_name: str, topic_id: int):
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("""
-            INSERT INTO chats (user_id, username, first_name, last_name, topic_id, last_message_at, status, unread_count)
-            VALUES (?, ?, ?, ?, ?, ?, 'unread', 1)
+    @db_read
+    def load(user_id: int) -> Optional[dict]:
+        """Uncached read – use Chat.get"""
+        return _chat_row(get_db().execute("SELECT * FROM chats WHERE user_id = ?", (user_id,)))
+
+    @staticmethod
+    @db_read
+    def load_by_topic(topic_id: int) -> Optional[dict]:
+        """Uncached read – use Chat.get_by_topic"""
+        return _chat_row(get_db().execute(SQL_CHAT_BY_TOPIC, (topic_id,)))
+
+    @staticmethod
+    @chat_write
+    def create(user_id: int, username: str, first_name: str, last_name: str, topic_id: int, topic_name: str = None):
+        return _chat_row(get_db().execute("""
+            INSERT INTO chats (user_id, username, first_name, last_name, topic_id, topic_name, last_message_at, status, unread_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 'unread', 1)
             ON CONFLICT(user_id) DO UPDATE SET
                 username=excluded.username, first_name=excluded.first_name, last_name=excluded.last_name,
-                topic_id=excluded.topic_id, is_archived=0, status='unread', unread_count=1
-        """, (user_id, username, first_name, last_name, topic_id, datetime.now()))
-        conn.commit()
-        conn.close()
+                topic_id=excluded.topic_id, topic_name=excluded.topic_name, is_archived=0, status='unread', unread_count=1
+            RETURNING *
+        """, (user_id, username, first_name, last_name, topic_id, topic_name, datetime.now())))
 
     @staticmethod
-    def new_message(user_id: int, preview: str, msg_type: str):
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("""
-            UPDATE chats SET status='unread', unread_count=unread_count+1,
+    @chat_write
+    def new_message(user_id: int, preview: str, msg_type: str, count: int = 1):
+        return _chat_row(get_db().execute("""
+            UPDATE chats SET status='unread', unread_count=unread_count+?,
             last_message_preview=?, last_message_type=?, last_message_at=?,
             followup_stage=0, followup_done=0, followup_skipped_until=NULL
-            WHERE user_id=?
-        """, (preview[:100], msg_type, datetime.now(), user_id))
-        conn.commit()
-        conn.close()
+            WHERE user_id=? RETURNING *
+        """, (count, preview[:100], msg_type, datetime.now(), user_id)))
 
     @staticmethod
+    @chat_write
     def mark_read(user_id: int):
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("UPDATE chats SET status=CASE WHEN status='unread' THEN 'read' ELSE status END, unread_count=0 WHERE user_id=?", (user_id,))
-        conn.commit()
-        conn.close()
+        return _chat_row(get_db().execute("UPDATE chats SET status=CASE WHEN status='unread' THEN 'read' ELSE status END, unread_count=0 WHERE user_id=? RETURNING *", (user_id,)))
 
     @staticmethod
+    @chat_write
     def mark_unread(user_id: int):
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("UPDATE chats SET status='unread', unread_count=CASE WHEN unread_count=0 THEN 1 ELSE unread_count END WHERE user_id=?", (user_id,))
-        conn.commit()
-        conn.close()
+        return _chat_row(get_db().execute("UPDATE chats SET status='unread', unread_count=CASE WHEN unread_count=0 THEN 1 ELSE unread_count END WHERE user_id=? RETURNING *", (user_id,)))
 
     @staticmethod
+    @chat_write
     def mark_answered(user_id: int):
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("UPDATE chats SET status='answered', unread_count=0, last_reply_at=? WHERE user_id=?", (datetime.now(), user_id))
-        conn.commit()
-        conn.close()
+        return _chat_row(get_db().execute("UPDATE chats SET status='answered', unread_count=0, last_reply_at=? WHERE user_id=? RETURNING *", (datetime.now(), user_id)))
 
     @staticmethod
+    @chat_write
     def set_priority(user_id: int, priority: str):
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("UPDATE chats SET priority=? WHERE user_id=?", (priority, user_id))
-        conn.commit()
-        conn.close()
+        return _chat_row(get_db().execute("UPDATE chats SET priority=? WHERE user_id=? RETURNING *", (priority, user_id)))
 
     @staticmethod
+    @chat_write
     def archive(user_id: int):
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("UPDATE chats SET is_archived=1, status='closed' WHERE user_id=?", (user_id,))
-        conn.commit()
-        conn.close()
-
-    @staticmethod
-    def get_unread() -> List[dict]:
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("""
-            SELECT * FROM chats WHERE is_archived=0 AND status='unread'
-            ORDER BY CASE priority WHEN 'urgent' THEN 1 WHEN 'vip' THEN 2 ELSE 3 END, last_message_at DESC
-        """)
-        rows = c.fetchall()
-        cols = [d[0] for d in c.description]
-        conn.close()
-        return [dict(zip(cols, r)) for r in rows]
+        return _chat_row(get_db().execute("UPDATE chats SET is_archived=1, status='closed' WHERE user_id=? RETURNING *", (user_id,)))
 
     @staticmethod
+    @db_read
     def get_all_active() -> List[dict]:
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("""
-            SELECT * FROM chats WHERE is_archived=0
-            ORDER BY CASE status WHEN 'unread' THEN 1 WHEN 'read' THEN 2 ELSE 3 END, last_message_at DESC
-        """)
+        c = get_db().execute(SQL_ALL_ACTIVE)
         rows = c.fetchall()
         cols = [d[0] for d in c.description]
-        conn.close()
         return [dict(zip(cols, r)) for r in rows]
 
     # ==================== FOLLOW-UP METHODS ====================
     
     @staticmethod
+    @chat_write
     def reset_followup(user_id: int):
         """Reset follow-up when customer replies"""
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("""
+        return _chat_row(get_db().execute("""
             UPDATE chats SET followup_stage=0, followup_done=0, followup_skipped_until=NULL 
-            WHERE user_id=?
-        """, (user_id,))
-        conn.commit()
-        conn.close()
+            WHERE user_id=? RETURNING *
+        """, (user_id,)))
 
     @staticmethod
+    @chat_write
     def mark_followup_done(user_id: int):
         """Mark follow-up as done (no more reminders)"""
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("UPDATE chats SET followup_done=1 WHERE user_id=?", (user_id,))
-        conn.commit()
-        conn.close()
+        return _chat_row(get_db().execute("UPDATE chats SET followup_done=1 WHERE user_id=? RETURNING *", (user_id,)))
 
     @staticmethod
+    @chat_write
     def skip_followup(user_id: int, days: int = 3):
         """Skip follow-up for X days"""
-        conn = get_db()
-        c = conn.cursor()
         skip_until = datetime.now() + timedelta(days=days)
-        c.execute("UPDATE chats SET followup_skipped_until=? WHERE user_id=?", (skip_until, user_id))
-        conn.commit()
-        conn.close()
+        return _chat_row(get_db().execute("UPDATE chats SET followup_skipped_until=? WHERE user_id=? RETURNING *", (skip_until, user_id)))
+
+    @staticmethod
+    @chat_write
+    def set_followup_stage(user_id: int, stage: int):
+        """Jump to a follow-up stage (reminders missed while offline are skipped)"""
+        return _chat_row(get_db().execute("UPDATE chats SET followup_stage=? WHERE user_id=? RETURNING *", (stage, user_id)))
 
     @staticmethod
+    @chat_write
     def advance_followup_stage(user_id: int):
         """Move to next follow-up stage"""
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("UPDATE chats SET followup_stage=followup_stage+1 WHERE user_id=?", (user_id,))
-        conn.commit()
-        conn.close()
+        return _chat_row(get_db().execute("UPDATE chats SET followup_stage=followup_stage+1 WHERE user_id=? RETURNING *", (user_id,)))
 
     @staticmethod
+    @db_read
     def get_followups_due() -> List[dict]:
         """Get all chats needing follow-up (max 1 per customer)"""
-        conn = get_db()
-        c = conn.cursor()
         now = datetime.now()
         cutoff = now - timedelta(hours=FOLLOWUP_AFTER_HOURS)
         
-        # Get answered chats where:
-        # - Not archived
-        # - Status is 'answered' (we replied, waiting for customer)
-        # - Follow-up not done yet
-        # - Last reply older than 24h
-        # - Not skipped
-        c.execute("""
-            SELECT * FROM chats 
-            WHERE is_archived=0 
-            AND status='answered' 
-            AND followup_done=0
-            AND last_reply_at < ?
-            AND (followup_skipped_until IS NULL OR followup_skipped_until < ?)
-            ORDER BY CASE priority WHEN 'urgent' THEN 1 WHEN 'vip' THEN 2 ELSE 3 END, last_reply_at ASC
-        """, (cutoff, now))
+        c = get_db().execute(SQL_FOLLOWUPS_DUE, (cutoff, now))
         rows = c.fetchall()
         cols = [d[0] for d in c.description]
-        conn.close()
         
         return [dict(zip(cols, r)) for r in rows]
 
+    @staticmethod
+    @db_read
+    def get_followups_page(cursor: tuple = None, forward: bool = True, limit: int = LIST_PAGE_SIZE) -> List[dict]:
+        """Due follow-ups after (forward) or before the cursor (see followup_cursor), always in list order"""
+        now = datetime.now()
+        cutoff = now - timedelta(hours=FOLLOWUP_AFTER_HOURS)
+        
+        c = get_db().execute(SQL_FOLLOWUPS_NEXT if forward else SQL_FOLLOWUPS_PREV, (cutoff, now, *(cursor or (0, "", 0)), limit))
+        cols = [d[0] for d in c.description]
+        rows = [dict(zip(cols, r)) for r in c.fetchall()]
+        return rows if forward else rows[::-1]
+
+    @staticmethod
+    @db_read
+    def count_followups_due() -> int:
+        now = datetime.now()
+        return get_db().execute(SQL_FOLLOWUPS_COUNT, (now - timedelta(hours=FOLLOWUP_AFTER_HOURS), now)).fetchone()[0]
+
+    @staticmethod
+    @chat_write
+    def set_topic(user_id: int, topic_id: int, topic_name: str = None):
+        return _chat_row(get_db().execute("UPDATE chats SET topic_id=?, topic_name=? WHERE user_id=? RETURNING *", (topic_id, topic_name, user_id)))
+
+    @staticmethod
+    @chat_write
+    def set_topic_name(user_id: int, topic_name: str):
+        """Remember the name the topic actually has in Telegram"""
+        return _chat_row(get_db().execute("UPDATE chats SET topic_name=? WHERE user_id=? RETURNING *", (topic_name, user_id)))
+
+    @staticmethod
+    @db_read
+    def get_stale(cutoff: datetime, limit: int = ARCHIVE_BATCH_SIZE) -> List[dict]:
+        """Active chats without messages since cutoff, longest silent first"""
+        c = get_db().execute(SQL_STALE, (cutoff, limit))
+        cols = [d[0] for d in c.description]
+        return [dict(zip(cols, r)) for r in c.fetchall()]
+
+    @staticmethod
+    @db_read
+    def count_stale(cutoff: datetime) -> int:
+        return get_db().execute(SQL_STALE_COUNT, (cutoff,)).fetchone()[0]
+
+    @staticmethod
+    async def archive_stale(cutoff: datetime, limit: int = ARCHIVE_BATCH_SIZE) -> List[dict]:
+        """Archive up to `limit` stale chats in one transaction and queue their topics for closing"""
+        return [CHAT_CACHE.put(chat) for chat in await _archive_stale(cutoff, limit)]
+
+# ============================================================
+# MESSAGES, NOTES & VOICE TEMPLATES
+# ============================================================
+
+@db_read
+def get_chat_stats(user_id: int) -> dict:
+    """Message counters of a customer (chat_stats row, by_type decoded) – archived months included"""
+    row = _chat_row(get_db().execute(SQL_CHAT_STATS, (user_id,)))
+    if not row:
+        return {'user_id': user_id, 'total': 0, 'incoming': 0, 'outgoing': 0, 'by_type': {}, 'first_message_at': None,
+                'last_message_at': None, 'first_in_at': None, 'first_response_at': None}
+    row['by_type'] = json.loads(row['by_type'] or '{}')
+    return row
+
+def search_sql(query: dict) -> Tuple[str, list, bool]:
+    """SQL (with ORDER BY, without LIMIT) + params for a parsed /search query, and whether it ranks by FTS.
+    Runs unchanged on a month archive (its messages/messages_fts, chats from the attached hot DB)"""
+    where, params = [], []
+    if query['terms'] and FTS_ENABLED:
+        sql = SQL_SEARCH
+        params.append(fts_match(query['terms']))
+        order = "rank"
+    else:
+        # Nur Filter (oder kein FTS5): neueste zuerst
+        sql = """
+            SELECT m.content, m.direction, c.first_name, m.created_at, m.content, m.created_at
+            FROM messages m JOIN chats c ON c.user_id = m.user_id WHERE 1
+        """
+        for term in query['terms']:
+            where.append("m.content LIKE ?")
+            params.append(f"%{term.rstrip('*')}%")
+        order = "m.created_at DESC"
+    
+    if query['direction']:
+        where.append("m.direction = ?")
+        params.append(query['direction'])
+    customer = query['customer']
+    if customer:
+        if customer.isdigit():
+            where.append("m.user_id = ?")
+            params.append(int(customer))
+        elif customer.startswith("@"):
+            where.append("c.username = ? COLLATE NOCASE")
+            params.append(customer[1:])
+        else:
+            where.append("(COALESCE(c.first_name, '') || ' ' || COALESCE(c.last_name, '')) LIKE ?")
+            params.append(f"%{customer}%")
+    if query['since']:
+        where.append("m.created_at >= ?")
+        params.append(query['since'])
+    if query['until']:
+        where.append("m.created_at < date(?, '+1 day')")
+        params.append(query['until'])
+    
+    sql += "".join(f" AND {w}" for w in where) + f" ORDER BY {order}"
+    return sql, params, order == "rank"
+
+@db_read
+def search_messages(query: dict) -> Tuple[List[tuple], bool]:
+    """Run a parsed /search query (see parse_search) → (page of (content, direction, name, created_at, snippet), has_more).
+    With archiv:ja the month archives are searched too: top hits per DB, merged by rank/date"""
+    sql, params, ranked = search_sql(query)
+    offset = (query['page'] - 1) * SEARCH_PAGE_SIZE
+    if not query['archive']:
+        rows = get_db().execute(sql + " LIMIT ? OFFSET ?", params + [SEARCH_PAGE_SIZE + 1, offset]).fetchall()
+    else:
+        limit = offset + SEARCH_PAGE_SIZE + 1
+        rows = get_db().execute(sql + " LIMIT ?", params + [limit]).fetchall()
+        for month in archive_months.sync(query['since'], query['until']):
+            with closing(open_archive(month)) as conn:
+                rows += conn.execute(sql + " LIMIT ?", params + [limit]).fetchall()
+        # Letzte Spalte: rank (kleiner = besser) bzw. created_at (neuer = besser)
+        rows.sort(key=lambda r: r[5], reverse=not ranked)
+        rows = rows[offset:limit]
+    return [r[:5] for r in rows[:SEARCH_PAGE_SIZE]], len(rows) > SEARCH_PAGE_SIZE
+
+@db_write
+def add_note(user_id: int, note: str):
+    get_db().execute("INSERT INTO notes (user_id, note) VALUES (?,?)", (user_id, note))
+
+@db_read
+def get_notes(user_id: int, limit: int = 5) -> List[Tuple[str, datetime]]:
+    return get_db().execute(SQL_NOTES, (user_id, limit)).fetchall()
+
+@db_read
+def get_voice_templates() -> List[Tuple[str, int]]:
+    return get_db().execute("SELECT name, duration FROM voice_templates ORDER BY name").fetchall()
+
+@db_read
+def get_voice_template(name: str) -> Optional[Tuple[str, int]]:
+    return get_db().execute("SELECT file_id, duration FROM voice_templates WHERE name=?", (name,)).fetchone()
+
+@db_write
+def save_voice_template(name: str, file_id: str, duration: int):
+    get_db().execute("INSERT OR REPLACE INTO voice_templates (name, file_id, duration) VALUES (?, ?, ?)",
+                     (name, file_id, duration))
+
+@db_write
+def delete_voice_template(name: str) -> int:
+    return get_db().execute("DELETE FROM voice_templates WHERE name=?", (name,)).rowcount
+
+# ============================================================
+# BROADCASTS (Job + Status pro Empfänger, überlebt Neustarts)
+# ============================================================
+
+@db_write
+def create_broadcast(created_by: int, target_name: str, message: str, user_ids: List[int],
+                     status_chat_id: int, status_message_id: int) -> int:
+    conn = get_db()
+    c = conn.execute("""
+        INSERT INTO broadcasts (created_by, target_name, message, status_chat_id, status_message_id)
+        VALUES (?, ?, ?, ?, ?)
+    """, (created_by, target_name, message, status_chat_id, status_message_id))
+    broadcast_id = c.lastrowid
+    conn.executemany("INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, user_id) VALUES (?, ?)",
+                     [(broadcast_id, u) for u in user_ids])
+    return broadcast_id
+
+@db_read
+def get_running_broadcasts() -> List[dict]:
+    c = get_db().execute("SELECT * FROM broadcasts WHERE status='running' ORDER BY id")
+    cols = [d[0] for d in c.description]
+    return [dict(zip(cols, r)) for r in c.fetchall()]
+
+@db_read
+def get_broadcast_pending(broadcast_id: int) -> List[int]:
+    rows = get_db().execute("SELECT user_id FROM broadcast_recipients WHERE broadcast_id=? AND status='pending'", (broadcast_id,))
+    return [r[0] for r in rows]
+
+@db_read
+def get_broadcast_counts(broadcast_id: int) -> dict:
+    rows = get_db().execute("SELECT status, COUNT(*) FROM broadcast_recipients WHERE broadcast_id=? GROUP BY status", (broadcast_id,))
+    return dict(rows.fetchall())
+
+@db_write
+def set_recipient_state(broadcast_id: int, user_id: int, status: str, error: str = None):
+    get_db().execute("""
+        UPDATE broadcast_recipients SET status=?, error=?, attempts=attempts+1,
+        sent_at=CASE WHEN ?='sent' THEN ? ELSE sent_at END
+        WHERE broadcast_id=? AND user_id=?
+    """, (status, error, status, datetime.now(), broadcast_id, user_id))
+
+@db_write
+def finish_broadcast(broadcast_id: int, status: str = "done"):
+    get_db().execute("UPDATE broadcasts SET status=?, finished_at=? WHERE id=?", (status, datetime.now(), broadcast_id))
+
+@db_write
+def _archive_stale(cutoff: datetime, limit: int) -> List[dict]:
+    c = get_db().execute(SQL_ARCHIVE_BATCH, (cutoff, limit))
+    cols = [d[0] for d in c.description]
+    chats = [dict(zip(cols, r)) for r in c.fetchall()]
+    get_db().executemany("INSERT OR IGNORE INTO topic_close_queue (topic_id, user_id) VALUES (?, ?)",
+                         [(chat['topic_id'], chat['user_id']) for chat in chats if chat['topic_id']])
+    return chats
+
+@db_read
+def get_topic_close_queue(limit: int = ARCHIVE_BATCH_SIZE) -> List[int]:
+    return [r[0] for r in get_db().execute("SELECT topic_id FROM topic_close_queue ORDER BY queued_at LIMIT ?", (limit,))]
+
+@db_read
+def count_topic_close_queue() -> int:
+    return get_db().execute("SELECT COUNT(*) FROM topic_close_queue").fetchone()[0]
+
+@db_write
+def dequeue_topic_close(topic_id: int):
+    get_db().execute("DELETE FROM topic_close_queue WHERE topic_id=?", (topic_id,))
+
 # ============================================================
 # HELPERS
 # ============================================================
@@ -348,6 +1428,13 @@ def get_topic_name(chat: dict) -> str:
         parts.append(f"({chat['unread_count']})")
     return " ".join(parts)[:128]
 
+def topic_title(chat: dict) -> str:
+    """Topic name as kept in Telegram – like get_topic_name, but without the unread counter (fewer renames)"""
+    name = get_name(chat)
+    s = STATUS.get(chat['status'], "")
+    p = PRIORITY.get(chat['priority'], "")
+    return " ".join(x for x in [p, s, name] if x)[:128]
+
 def time_ago(dt) -> str:
     if not dt: return ""
     delta = datetime.now() - dt
@@ -356,67 +1443,487 @@ def time_ago(dt) -> str:
     if delta.seconds >= 60: return f"vor {delta.seconds // 60}min"
     return "gerade"
 
+def fmt_duration(delta: timedelta) -> str:
+    minutes = int(delta.total_seconds() // 60)
+    if minutes >= 1440: return f"{minutes // 1440}d {minutes % 1440 // 60}h"
+    if minutes >= 60: return f"{minutes // 60}h {minutes % 60}min"
+    return f"{minutes}min"
+
+SEARCH_FILTERS = {"dir": "direction", "kunde": "customer", "ab": "since", "bis": "until", "seite": "page", "archiv": "archive"}
+
+def parse_search(text: str) -> Optional[dict]:
+    """Parse '/search' arguments: words, "phrases", prefix*, dir:in|out, kunde:<name|@user|id>, ab:/bis:YYYY-MM-DD, seite:N, archiv:ja"""
+    query = {'terms': [], 'direction': None, 'customer': None, 'since': None, 'until': None, 'page': 1, 'archive': False}
+    for token in re.findall(r'"[^"]*"|\S+', text):
+        key, sep, value = token.partition(":")
+        field = SEARCH_FILTERS.get(key.lower()) if sep and value else None
+        if not field:
+            query['terms'].append(token)
+        elif field == "direction":
+            if value not in ("in", "out"): return None
+            query['direction'] = value
+        elif field in ("since", "until"):
+            try: query[field] = datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+            except ValueError: return None
+        elif field == "page":
+            if not value.isdigit() or int(value) < 1: return None
+            query['page'] = int(value)
+        elif field == "archive":
+            if value.lower() not in ("ja", "nein"): return None
+            query['archive'] = value.lower() == "ja"
+        else:
+            query[field] = value
+    return query
+
+def fts_match(terms: List[str]) -> str:
+    """Build a safe FTS5 MATCH expression: every term quoted, trailing * kept as prefix query, all terms ANDed"""
+    parts = []
+    for term in terms:
+        prefix = term.endswith("*") and not term.startswith('"')
+        term = term.strip('"').rstrip("*")
+        if term:
+            parts.append('"' + term.replace('"', '""') + '"' + ("*" if prefix else ""))
+    return " ".join(parts) or '""'
+
 def msg_icon(t: str) -> str:
-    return {"voice": "🎤", "video_note": "⏺", "photo": "📷", "video": "🎬", "document": "📎", "sticker": "😀"}.get(t, "")
+    return {"voice": "🎤", "video_note": "⏺", "photo": "📷", "video": "🎬", "document": "📎", "sticker": "😀",
+            "location": "📍", "venue": "📍", "poll": "📊"}.get(t, "")
 
 def extract_info(msg: Message) -> Tuple[str, str, str, int]:
+    """(type, preview, file_id, duration) – only for the message log / inbox preview, forwarding uses copy_message"""
     if msg.text: return ("text", msg.text[:100], "", 0)
     if msg.voice: return ("voice", f"Sprachnachricht ({msg.voice.duration}s)", msg.voice.file_id, msg.voice.duration)
     if msg.video_note: return ("video_note", "Videonachricht", msg.video_note.file_id, msg.video_note.duration)
     if msg.photo: return ("photo", msg.caption or "Foto", msg.photo[-1].file_id, 0)
     if msg.video: return ("video", msg.caption or "Video", msg.video.file_id, msg.video.duration or 0)
+    if msg.animation: return ("animation", "GIF", msg.animation.file_id, 0)  # vor document: GIFs haben beides
     if msg.document: return ("document", msg.document.file_name or "Dokument", msg.document.file_id, 0)
     if msg.audio: return ("audio", msg.audio.title or "Audio", msg.audio.file_id, msg.audio.duration or 0)
     if msg.sticker: return ("sticker", msg.sticker.emoji or "Sticker", msg.sticker.file_id, 0)
-    if msg.animation: return ("animation", "GIF", msg.animation.file_id, 0)
+    if msg.venue: return ("venue", msg.venue.title, "", 0)
     if msg.location: return ("location", "Standort", "", 0)
     if msg.contact: return ("contact", msg.contact.first_name, "", 0)
+    if msg.poll: return ("poll", msg.poll.question[:100], "", 0)
+    if msg.dice: return ("dice", msg.dice.emoji, "", 0)
     return ("unknown", "", "", 0)
 
+def _count_messages(user_id: int, direction: str, types: Counter):
+    for msg_type, n in types.items():
+        get_db().execute(SQL_COUNT_MESSAGES, {'user_id': user_id, 'n': n, 'type': msg_type,
+                                              'incoming': n if direction == "in" else 0, 'outgoing': n if direction == "out" else 0})
+
+@db_log
 def log_msg(user_id: int, direction: str, msg_type: str, content: str = "", file_id: str = "", duration: int = 0):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("INSERT INTO messages (user_id, direction, msg_type, content, file_id, duration) VALUES (?,?,?,?,?,?)",
-              (user_id, direction, msg_type, content, file_id, duration))
-    conn.commit()
-    conn.close()
+    get_db().execute("INSERT INTO messages (user_id, direction, msg_type, content, file_id, duration) VALUES (?,?,?,?,?,?)",
+                     (user_id, direction, msg_type, content, file_id, duration))
+    _count_messages(user_id, direction, Counter([msg_type]))
+
+@db_log
+def log_msgs(user_id: int, direction: str, infos: List[Tuple[str, str, str, int]]):
+    """log_msg for several messages at once (album), infos as returned by extract_info"""
+    get_db().executemany("INSERT INTO messages (user_id, direction, msg_type, content, file_id, duration) VALUES (?,?,?,?,?,?)",
+                         [(user_id, direction, *info) for info in infos])
+    _count_messages(user_id, direction, Counter(info[0] for info in infos))
 
 # ============================================================
-# TOPIC MANAGEMENT
+# RETENTION (alte Nachrichten → Monatsarchive, Hot-DB bleibt klein)
 # ============================================================
 
-# Track last topic name to avoid unnecessary renames
-TOPIC_NAME_CACHE = {}
+def archive_path(month: str) -> Path:
+    return Path(ARCHIVE_DIR or DB_PATH.parent / "archive") / f"messages-{month}.db"
 
-async def update_topic(bot: Bot, chat: dict):
-    """Update topic name with status - only if changed"""
+def next_month(month: str) -> str:
+    year, mon = map(int, month.split("-"))
+    return f"{year + mon // 12:04d}-{mon % 12 + 1:02d}"
+
+def _init_archive(conn: sqlite3.Connection):
+    """Schema of a month archive attached as `arch`: messages with their original ids, own FTS index"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS arch.messages (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            direction TEXT,
+            msg_type TEXT,
+            content TEXT,
+            file_id TEXT,
+            duration INTEGER,
+            created_at TIMESTAMP
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS arch.idx_messages_user ON messages(user_id, direction)")
+    conn.execute("CREATE INDEX IF NOT EXISTS arch.idx_messages_created ON messages(created_at)")
+    if FTS_ENABLED:
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS arch.messages_fts USING fts5(
+                content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS arch.messages_fts_ai AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+            END
+        """)
+
+def _attach_archive(conn: sqlite3.Connection, month: str):
+    path = archive_path(month)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn.execute("ATTACH DATABASE ? AS arch", (str(path),))
+    _init_archive(conn)
+
+def _archive_batch(conn: sqlite3.Connection, cutoff: str) -> int:
+    """Writer thread: move the oldest batch (one month) into its archive. Copy and delete are two transactions
+    (attached DBs don't commit atomically together) – copying is idempotent, so a crash in between only repeats it"""
+    oldest = conn.execute("SELECT MIN(created_at) FROM messages").fetchone()[0]
+    if oldest is None or str(oldest) >= cutoff: return 0
+    month = str(oldest)[:7]
+    end = min(cutoff, f"{next_month(month)}-01 00:00:00")
+    ids = json.dumps([row[0] for row in conn.execute(SQL_RETENTION_IDS, (end, RETENTION_BATCH))])
+    _attach_archive(conn, month)
     try:
-        name = get_name(chat)
-        s = STATUS.get(chat['status'], "")
-        p = PRIORITY.get(chat['priority'], "")
-        parts = [x for x in [p, s, name] if x]
-        topic_name = " ".join(parts)[:128]
-        
-        # Only rename if actually changed
-        cache_key = chat['topic_id']
-        cached = TOPIC_NAME_CACHE.get(cache_key)
-        
-        print(f"[DEBUG] update_topic: status={chat['status']}, cached={cached}, new={topic_name}")
+        conn.execute("BEGIN")
+        try:
+            conn.execute(SQL_RETENTION_COPY, (ids,))
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+    finally:
+        conn.execute("DETACH DATABASE arch")
+    conn.execute("BEGIN")
+    try:
+        conn.execute(SQL_RETENTION_COUNT, (month, ids))
+        moved = conn.execute("DELETE FROM messages WHERE id IN (SELECT value FROM json_each(?))", (ids,)).rowcount
+        conn.execute("""INSERT INTO message_archives (month, messages) VALUES (?, ?)
+                        ON CONFLICT (month) DO UPDATE SET messages = messages + excluded.messages""", (month, moved))
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    return moved
+
+def _retention_step(cutoff: str) -> int:
+    """Writer thread: move batches for at most RETENTION_STEP_MS, then hand the writer back"""
+    conn = get_db()
+    deadline = time.perf_counter() + RETENTION_STEP_MS / 1000
+    moved = 0
+    while time.perf_counter() < deadline:
+        n = _archive_batch(conn, cutoff)
+        if not n: break
+        moved += n
+    return moved
+
+@db_read
+def get_unsealed_months(cutoff: str) -> List[str]:
+    """Archived months that can't receive more messages (completely before the cutoff and the oldest hot message)"""
+    oldest = get_db().execute("SELECT MIN(created_at) FROM messages").fetchone()[0]
+    first_hot = str(oldest or cutoff)[:7]
+    return [m for (m,) in get_db().execute("SELECT month FROM message_archives WHERE sealed=0")
+            if f"{next_month(m)}-01 00:00:00" <= cutoff and m < first_hot]
+
+@db_write
+def set_month_sealed(month: str):
+    get_db().execute("UPDATE message_archives SET sealed=1 WHERE month=?", (month,))
+
+def _seal_archive(month: str):
+    """Finished month: merge its FTS segments and compact the file. Own connection, off the writer thread –
+    nothing else writes to a month that lies completely before the cutoff"""
+    with closing(sqlite3.connect(archive_path(month), timeout=DB_BUSY_TIMEOUT_MS / 1000)) as conn:
+        if FTS_ENABLED:
+            conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('optimize')")
+            conn.commit()
+        conn.execute("VACUUM")
+
+def _vacuum_step() -> int:
+    """Writer thread: give free pages back to the filesystem for at most RETENTION_STEP_MS"""
+    conn = get_db()
+    deadline = time.perf_counter() + RETENTION_STEP_MS / 1000
+    freed = 0
+    while time.perf_counter() < deadline:
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if not free: break
+        conn.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})").fetchall()
+        freed += min(free, VACUUM_PAGES)
+    return freed
+
+async def run_retention() -> Tuple[int, int]:
+    """Move messages older than RETENTION_DAYS into the month archives, then shrink the hot DB.
+    Runs in short steps on the writer thread – group commits of the live traffic get in between"""
+    if RETENTION_DAYS <= 0: return 0, 0
+    loop = asyncio.get_running_loop()
+    cutoff = await db_now(f"-{RETENTION_DAYS} days")
+    moved = freed = 0
+    while n := await loop.run_in_executor(DB_WRITER, _retention_step, cutoff):
+        moved += n
+        METRICS.inc("support_retention_messages_total", n)
+        await asyncio.sleep(0)
+    sealed = await get_unsealed_months(cutoff)
+    for month in sealed:
+        await loop.run_in_executor(None, _seal_archive, month)
+        await set_month_sealed(month)
+    while n := await loop.run_in_executor(DB_WRITER, _vacuum_step):
+        freed += n
+        await asyncio.sleep(0)
+    if moved or freed or sealed:
+        await db_checkpoint()
+        logging.info(f"Retention: {moved} Nachrichten archiviert, {len(sealed)} Monat(e) abgeschlossen, {freed} Seiten freigegeben")
+    return moved, freed
+
+@db_read
+def db_now(modifier: str) -> str:
+    """SQLite's UTC clock (like CURRENT_TIMESTAMP in messages.created_at), shifted by a date modifier"""
+    return get_db().execute("SELECT datetime('now', ?)", (modifier,)).fetchone()[0]
+
+@db_read
+def archive_months(since: str = None, until: str = None) -> List[str]:
+    """Archived months (newest first), optionally limited to a /search date range"""
+    months = [m for (m,) in get_db().execute("SELECT month FROM message_archives WHERE messages > 0 ORDER BY month DESC")]
+    return [m for m in months if (not since or m >= since[:7]) and (not until or m <= until[:7]) and archive_path(m).exists()]
+
+def open_archive(month: str) -> sqlite3.Connection:
+    """Read-only connection to a month archive with the hot DB attached (for chats)"""
+    conn = sqlite3.connect(archive_path(month).resolve().as_uri() + "?mode=ro", uri=True,
+                           detect_types=sqlite3.PARSE_DECLTYPES, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    conn.execute("ATTACH DATABASE ? AS hot", (Path(DB_PATH).resolve().as_uri() + "?mode=ro",))
+    return conn
+
+# ============================================================
+# RATE LIMITING (alle Bot-API-Calls laufen hier durch)
+# ============================================================
+
+# Prioritäten-Lanes: per rate_limit_args=LANE_BULK an jedem Bot-Call wählbar, Default interaktiv
+LANE_INTERACTIVE = 0   # Kunde → Topic, Admin → Kunde, Befehls-Antworten
+LANE_BULK = 1          # Topic-Umbenennungen, Broadcasts, Digest, Auto-Archiv
+
+class TokenBucket:
+    def __init__(self, rate: float, per: float):
+        self.capacity = rate
+        self.tokens = rate
+        self.fill_rate = rate / per
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.fill_rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+class PriorityGate:
+    """Token bucket whose waiters are released by lane first, then in arrival order"""
+
+    def __init__(self, rate: float, per: float):
+        self.bucket = TokenBucket(rate, per)
+        self.waiters = []  # heap of (lane, seq, future)
+        self.blocked_until = 0.0  # gesetzt durch RetryAfter
+        self.task: Optional[asyncio.Task] = None
+
+    async def acquire(self, lane: int):
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        heapq.heappush(self.waiters, (lane, next(_gate_seq), fut))
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self._serve())
+        await fut
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def is_idle(self) -> bool:
+        return not self.waiters and time.monotonic() >= self.blocked_until and self.bucket.is_full()
+
+    async def _serve(self):
+        while self.waiters:
+            delay = max(self.bucket.wait_time(), self.blocked_until - time.monotonic())
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, fut = heapq.heappop(self.waiters)
+            if fut.done(): continue  # Aufrufer abgebrochen
+            self.bucket.take()
+            fut.set_result(None)
+
+_gate_seq = itertools.count()
+
+def is_rate_limited(endpoint: str) -> bool:
+    """Only calls that produce/edit messages count against Telegram's flood limits"""
+    if endpoint == "sendChatAction": return False
+    return endpoint.startswith(("send", "copy", "forward", "edit")) or endpoint.endswith("ForumTopic")
+
+def retry_after_seconds(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if isinstance(ra, timedelta) else float(ra)
+
+class SupportRateLimiter(BaseRateLimiter[int]):
+    """Central send scheduler: global + per-chat token buckets (private 1/s, groups 20/min),
+    priority lanes and automatic RetryAfter handling. With REPLICAS > 1 the global and group budgets
+    are split evenly, so all instances together stay within Telegram's limits"""
+
+    def __init__(self):
+        self.global_gate = PriorityGate(RATE_GLOBAL_PER_SECOND / REPLICAS, 1)
+        self.chat_gates = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        for gate in [self.global_gate, *self.chat_gates.values()]:
+            if gate.task: gate.task.cancel()
+
+    def _chat_gate(self, chat_id: int) -> PriorityGate:
+        gate = self.chat_gates.get(chat_id)
+        if gate is None:
+            if len(self.chat_gates) > 10000:
+                self.chat_gates = {k: g for k, g in self.chat_gates.items() if not g.is_idle()}
+            if chat_id < 0:
+                gate = PriorityGate(RATE_GROUP_PER_MINUTE / REPLICAS, 60)
+            else:
+                gate = PriorityGate(RATE_PRIVATE_PER_SECOND, 1)
+            self.chat_gates[chat_id] = gate
+        return gate
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        lane = rate_limit_args if rate_limit_args is not None else LANE_INTERACTIVE
+        chat_gate = None
+        try: chat_gate = self._chat_gate(int(data["chat_id"]))
+        except (KeyError, TypeError, ValueError): pass
+        limited = is_rate_limited(endpoint)
         
-        if cached == topic_name:
-            print(f"[DEBUG] Skipping - name unchanged")
+        for attempt in range(RATE_MAX_RETRIES + 1):
+            if limited:
+                t0 = time.perf_counter()
+                if chat_gate: await chat_gate.acquire(lane)
+                await self.global_gate.acquire(lane)
+                METRICS.observe("support_rate_wait_seconds", time.perf_counter() - t0, lane="bulk" if lane == LANE_BULK else "interactive")
+            METRICS.inc("support_api_calls_total", method=endpoint)
+            t0 = time.perf_counter()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                METRICS.inc("support_api_retry_after_total", method=endpoint)
+                if attempt == RATE_MAX_RETRIES: raise
+                wait = retry_after_seconds(e) + 0.1
+                logging.warning(f"RetryAfter {wait:.1f}s für {endpoint} (chat {data.get('chat_id')})")
+                # Betroffenen Chat (bzw. ohne chat_id alles) pausieren, dann mit gleicher Lane erneut anstellen
+                (chat_gate or self.global_gate).block(wait)
+                if not limited or not chat_gate:
+                    await asyncio.sleep(wait)
+            except TelegramError as e:
+                METRICS.inc("support_api_errors_total", method=endpoint, error=type(e).__name__)
+                raise
+            finally:
+                METRICS.observe("support_api_seconds", time.perf_counter() - t0, method=endpoint)
+
+# ============================================================
+# UPDATE PROCESSING (parallel, aber pro Unterhaltung in Reihenfolge)
+# ============================================================
+
+def conversation_key(update: object) -> Optional[tuple]:
+    """Updates with the same key are processed strictly in order: one private chat, one forum topic, ..."""
+    if not isinstance(update, Update) or not update.effective_chat: return None
+    chat = update.effective_chat
+    if chat.type == "private":
+        return ("user", chat.id)
+    msg = update.effective_message
+    if msg and msg.is_topic_message and msg.message_thread_id:
+        return ("topic", chat.id, msg.message_thread_id)
+    return ("chat", chat.id)
+
+class ConversationUpdateProcessor(BaseUpdateProcessor):
+    """Different customers/topics run concurrently; within one conversation updates stay serial"""
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self.locks = {}  # key → [Lock, Anzahl wartender/laufender Updates]
+
+    async def do_process_update(self, update: object, coroutine):
+        key = conversation_key(update)
+        if key is None:
+            await coroutine
             return
-        
-        await bot.edit_forum_topic(chat_id=SUPPORT_GROUP_ID, message_thread_id=chat['topic_id'], name=topic_name)
-        TOPIC_NAME_CACHE[cache_key] = topic_name
-        print(f"[DEBUG] Topic renamed to: {topic_name}")
-    except Exception as e:
-        print(f"[DEBUG] update_topic error: {e}")
+        entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:  # asyncio.Lock ist FIFO → Reihenfolge bleibt erhalten
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
         pass
 
+# ============================================================
+# TOPIC MANAGEMENT
+# ============================================================
+
+class TopicRenamer:
+    """Coalesces topic renames: status changes of one chat within TOPIC_RENAME_DELAY collapse into a
+    single check, and edit_forum_topic only runs if the final name differs from chats.topic_name"""
+
+    def __init__(self):
+        self.pending = {}  # user_id → Task
+
+    def schedule(self, bot: Bot, user_id: int, delay: float = TOPIC_RENAME_DELAY):
+        if user_id in self.pending: return  # läuft schon – liest beim Ausführen den neuesten Stand
+        task = asyncio.get_running_loop().create_task(self._apply_later(bot, user_id, delay), name=f"Topic umbenennen {user_id}")
+        task.add_done_callback(self._done)
+        self.pending[user_id] = task
+
+    def _done(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            logging.error(f"{task.get_name()} fehlgeschlagen: {task.exception()!r}")
+
+    async def _apply_later(self, bot: Bot, user_id: int, delay: float):
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self.pending.pop(user_id, None)
+        chat = await Chat.get(user_id)
+        if not chat or chat['is_archived']: return
+        topic_name = topic_title(chat)
+        if topic_name == chat.get('topic_name'): return
+        try:
+            await bot.edit_forum_topic(chat_id=SUPPORT_GROUP_ID, message_thread_id=chat['topic_id'], name=topic_name,
+                                       rate_limit_args=LANE_BULK)
+        except BadRequest as e:
+            if "not_modified" not in e.message.lower():
+                logging.warning(f"Topic {chat['topic_id']} umbenennen fehlgeschlagen: {e}")
+                return
+        except TelegramError as e:
+            # Vorübergehend (Netzwerk, RetryAfter nach allen Versuchen, Rechte kurz weg) → später erneut
+            retry = min(delay * 2, TOPIC_RENAME_MAX_DELAY)
+            logging.warning(f"Topic {chat['topic_id']} umbenennen fehlgeschlagen, neuer Versuch in {retry:.0f}s: {e!r}")
+            self.schedule(bot, user_id, retry)
+            return
+        await Chat.set_topic_name(user_id, topic_name)
+
+    def cancel_all(self):
+        for task in self.pending.values():
+            task.cancel()
+
+TOPIC_RENAMER = TopicRenamer()
+
+async def update_topic(bot: Bot, chat: dict):
+    """Update topic name with status - only if changed (coalesced, see TopicRenamer)"""
+    TOPIC_RENAMER.schedule(bot, chat['user_id'])
+
 async def repair_topic_if_needed(bot: Bot, user_id: int, user) -> dict:
     """Check if topic exists, recreate if not"""
-    chat = Chat.get(user_id)
+    chat = await Chat.get(user_id)
     if not chat:
         return None
     
@@ -426,8 +1933,8 @@ async def repair_topic_if_needed(bot: Bot, user_id: int, user) -> dict:
         await bot.get_chat(chat_id=SUPPORT_GROUP_ID)
         # If topic_id is valid, this should work
         return chat
-    except:
-        pass
+    except TelegramError as e:
+        logging.warning(f"Support-Gruppe nicht erreichbar, lege Topic für {user_id} neu an: {e}")
     
     # If we get here, try creating new topic
     try:
@@ -436,15 +1943,9 @@ async def repair_topic_if_needed(bot: Bot, user_id: int, user) -> dict:
         topic = await bot.create_forum_topic(chat_id=SUPPORT_GROUP_ID, name=topic_name)
         
         # Update database with new topic_id
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("UPDATE chats SET topic_id=? WHERE user_id=?", (topic.message_thread_id, user_id))
-        conn.commit()
-        conn.close()
-        
-        TOPIC_NAME_CACHE[topic.message_thread_id] = topic_name
-        return Chat.get(user_id)
-    except:
+        return await Chat.set_topic(user_id, topic.message_thread_id, topic_name)
+    except TelegramError as e:
+        logging.warning(f"Topic für {user_id} neu anlegen fehlgeschlagen: {e}")
         return chat  # Return existing chat, let it fail naturally
 
 async def delete_service_messages(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -457,68 +1958,145 @@ async def delete_service_messages(update: Update, ctx: ContextTypes.DEFAULT_TYPE
     if msg.forum_topic_edited:
         try:
             await msg.delete()
-        except:
-            pass
+        except TelegramError as e:
+            logging.debug(f"Service-Nachricht nicht gelöscht: {e}")
 
 async def create_topic(bot: Bot, user) -> int:
     name = get_name({'first_name': user.first_name, 'last_name': user.last_name, 'username': user.username})
     topic_name = f"🔴 {name}"[:128]
     topic = await bot.create_forum_topic(chat_id=SUPPORT_GROUP_ID, name=topic_name)
-    Chat.create(user.id, user.username or "", user.first_name or "", user.last_name or "", topic.message_thread_id)
-    TOPIC_NAME_CACHE[topic.message_thread_id] = topic_name
+    await Chat.create(user.id, user.username or "", user.first_name or "", user.last_name or "", topic.message_thread_id, topic_name)
     return topic.message_thread_id
 
 # ============================================================
 # FORWARDING - 100% NATIVE
 # ============================================================
 
-async def to_topic(bot: Bot, msg: Message, topic_id: int, user_id: int) -> bool:
+def is_topic_missing(e: BadRequest) -> bool:
+    msg = e.message.lower()
+    return "thread not found" in msg or "topic_deleted" in msg or "topic_id_invalid" in msg
+
+async def copy_to(bot: Bot, msgs: List[Message], chat_id: int, topic_id: int = None):
+    """Copy messages 1:1 in one API call – a single message or a whole album (all content types, captions, entities)"""
+    try:
+        if len(msgs) == 1:
+            await bot.copy_message(chat_id=chat_id, message_thread_id=topic_id, from_chat_id=msgs[0].chat_id, message_id=msgs[0].message_id)
+        else:
+            await bot.copy_messages(chat_id=chat_id, message_thread_id=topic_id, from_chat_id=msgs[0].chat_id,
+                                    message_ids=[m.message_id for m in msgs])
+    except BadRequest as e:
+        if "can't be copied" not in e.message.lower(): raise
+        # Nicht kopierbar (z.B. Quiz) → wenigstens den Inhalt als Text zustellen
+        text = "\n".join(f"[{t}] {preview}".strip() for t, preview, _, _ in map(extract_info, msgs))
+        await bot.send_message(chat_id=chat_id, message_thread_id=topic_id, text=text)
+
+def summarize(msgs: List[Message], infos: list) -> Tuple[str, str]:
+    """(type, preview) for the chat row – an album shows its caption or the number of parts"""
+    if len(msgs) == 1: return infos[0][0], infos[0][1]
+    return infos[0][0], next((m.caption for m in msgs if m.caption), f"Album ({len(msgs)})")
+
+class SideEffects:
+    """Supervised fire-and-forget tasks for everything that must not delay the visible send
+    (typing indicator, log + chat status, topic rename): errors are logged, shutdown waits for them"""
+
+    def __init__(self):
+        self.tasks = set()
+
+    def spawn(self, coro: Awaitable, what: str) -> asyncio.Task:
+        task = asyncio.get_running_loop().create_task(coro, name=what)
+        self.tasks.add(task)
+        task.add_done_callback(functools.partial(self._done, what))
+        return task
+
+    def _done(self, what: str, task: asyncio.Task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logging.error(f"{what} fehlgeschlagen: {task.exception()!r}")
+
+    async def drain(self):
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks), return_exceptions=True)
+
+SIDE_EFFECTS = SideEffects()
+
+async def record(bot: Bot, user_id: int, direction: str, msgs: List[Message]):
+    """Bookkeeping after a successful send: message log + chat status, then the (coalesced) topic rename"""
+    infos = [extract_info(m) for m in msgs]
+    if direction == "in":
+        t, preview = summarize(msgs, infos)
+        await asyncio.gather(log_msgs(user_id, "in", infos), Chat.new_message(user_id, preview, t, len(msgs)))
+    else:
+        await asyncio.gather(log_msgs(user_id, "out", infos), Chat.mark_answered(user_id))
+    TOPIC_RENAMER.schedule(bot, user_id)
+
+async def to_topic(bot: Bot, msgs: List[Message], topic_id: int, user_id: int) -> bool:
     """User → Topic (100% nativ, keine Formatierung)"""
-    t, preview, fid, dur = extract_info(msg)
-    
     try:
-        if t == "text": await bot.send_message(chat_id=SUPPORT_GROUP_ID, message_thread_id=topic_id, text=msg.text)
-        elif t == "voice": await bot.send_voice(chat_id=SUPPORT_GROUP_ID, message_thread_id=topic_id, voice=fid, duration=dur)
-        elif t == "video_note": await bot.send_video_note(chat_id=SUPPORT_GROUP_ID, message_thread_id=topic_id, video_note=fid, duration=dur)
-        elif t == "photo": await bot.send_photo(chat_id=SUPPORT_GROUP_ID, message_thread_id=topic_id, photo=fid, caption=msg.caption)
-        elif t == "video": await bot.send_video(chat_id=SUPPORT_GROUP_ID, message_thread_id=topic_id, video=fid, caption=msg.caption)
-        elif t == "document": await bot.send_document(chat_id=SUPPORT_GROUP_ID, message_thread_id=topic_id, document=fid, caption=msg.caption)
-        elif t == "audio": await bot.send_audio(chat_id=SUPPORT_GROUP_ID, message_thread_id=topic_id, audio=fid, caption=msg.caption)
-        elif t == "sticker": await bot.send_sticker(chat_id=SUPPORT_GROUP_ID, message_thread_id=topic_id, sticker=fid)
-        elif t == "animation": await bot.send_animation(chat_id=SUPPORT_GROUP_ID, message_thread_id=topic_id, animation=fid, caption=msg.caption)
-        elif t == "location": await bot.send_location(chat_id=SUPPORT_GROUP_ID, message_thread_id=topic_id, latitude=msg.location.latitude, longitude=msg.location.longitude)
-        elif t == "contact": await bot.send_contact(chat_id=SUPPORT_GROUP_ID, message_thread_id=topic_id, phone_number=msg.contact.phone_number, first_name=msg.contact.first_name, last_name=msg.contact.last_name or "")
-        
-        log_msg(user_id, "in", t, preview, fid, dur)
-        Chat.new_message(user_id, preview, t)
-        return True
-    except:
-        return False
+        await copy_to(bot, msgs, SUPPORT_GROUP_ID, topic_id)
+    except BadRequest as e:
+        # Nur ein gelöschtes Topic führt zu einem neuen – alles andere ist ein echter Fehler
+        if is_topic_missing(e): return False
+        raise
+    SIDE_EFFECTS.spawn(record(bot, user_id, "in", msgs), f"Eingang {user_id} protokollieren")
+    return True
 
-async def to_user(bot: Bot, msg: Message, user_id: int, topic_id: int) -> bool:
+async def to_user(bot: Bot, msgs: List[Message], user_id: int, topic_id: int) -> bool:
     """Topic → User (100% nativ)"""
-    t, preview, fid, dur = extract_info(msg)
-    
     try:
-        if t == "text": await bot.send_message(chat_id=user_id, text=msg.text)
-        elif t == "voice": await bot.send_voice(chat_id=user_id, voice=fid, duration=dur)
-        elif t == "video_note": await bot.send_video_note(chat_id=user_id, video_note=fid, duration=dur)
-        elif t == "photo": await bot.send_photo(chat_id=user_id, photo=fid, caption=msg.caption)
-        elif t == "video": await bot.send_video(chat_id=user_id, video=fid, caption=msg.caption)
-        elif t == "document": await bot.send_document(chat_id=user_id, document=fid, caption=msg.caption)
-        elif t == "audio": await bot.send_audio(chat_id=user_id, audio=fid, caption=msg.caption)
-        elif t == "sticker": await bot.send_sticker(chat_id=user_id, sticker=fid)
-        elif t == "animation": await bot.send_animation(chat_id=user_id, animation=fid, caption=msg.caption)
-        elif t == "location": await bot.send_location(chat_id=user_id, latitude=msg.location.latitude, longitude=msg.location.longitude)
-        elif t == "contact": await bot.send_contact(chat_id=user_id, phone_number=msg.contact.phone_number, first_name=msg.contact.first_name, last_name=msg.contact.last_name or "")
-        
-        log_msg(user_id, "out", t, preview, fid, dur)
-        Chat.mark_answered(user_id)
-        
-        return True
+        await copy_to(bot, msgs, user_id)
     except Exception as e:
-        await msg.reply_text(f"⚠️ {e}")
+        await msgs[-1].reply_text(f"⚠️ {e}")
         return False
+    SIDE_EFFECTS.spawn(record(bot, user_id, "out", msgs), f"Antwort an {user_id} protokollieren")
+    return True
+
+class _Album:
+    __slots__ = ("group_id", "msgs", "deadline", "wake", "prev")
+
+class AlbumBuffer:
+    """Telegram delivers an album as one update per part. The parts are collected per conversation for
+    ALBUM_WINDOW_MS and then forwarded together: one copy_messages call, one DB batch, one topic update"""
+
+    def __init__(self):
+        self.pending = {}  # key → _Album, das noch Teile annimmt
+        self.tasks = {}    # key → letzter Flush-Task (hält die Reihenfolge pro Gespräch)
+
+    def add(self, key, msg: Message, forward: Callable[[List[Message]], Awaitable]):
+        loop = asyncio.get_running_loop()
+        album = self.pending.get(key)
+        if album and album.group_id != msg.media_group_id:
+            album.wake.set()  # neues Album → das vorige sofort abschicken
+            album = None
+        if album is None:
+            album = _Album()
+            album.group_id, album.msgs, album.wake, album.prev = msg.media_group_id, [], asyncio.Event(), self.tasks.get(key)
+            self.pending[key] = album
+            self.tasks[key] = loop.create_task(self._run(key, album, forward), name=f"album-{msg.media_group_id}")
+        album.msgs.append(msg)
+        album.deadline = loop.time() + ALBUM_WINDOW_MS / 1000
+
+    async def _run(self, key, album: _Album, forward):
+        loop = asyncio.get_running_loop()
+        try:
+            while not album.wake.is_set() and (delay := album.deadline - loop.time()) > 0:
+                try: await asyncio.wait_for(album.wake.wait(), delay)
+                except asyncio.TimeoutError: pass
+            if self.pending.get(key) is album: del self.pending[key]
+            if album.prev: await album.prev
+            await forward(sorted(album.msgs, key=lambda m: m.message_id))
+        except Exception as e:
+            logging.error(f"Album {album.group_id} weiterleiten fehlgeschlagen: {e!r}")
+        finally:
+            if self.tasks.get(key) is asyncio.current_task(): del self.tasks[key]
+
+    async def flush(self, key=None):
+        """Forward a pending album now and wait for it (before a later message of the same conversation, or on shutdown)"""
+        keys = [key] if key is not None else list(self.tasks)
+        for k in keys:
+            if k in self.pending: self.pending[k].wake.set()
+        await asyncio.gather(*(self.tasks[k] for k in keys if k in self.tasks))
+
+ALBUMS = AlbumBuffer()
 
 # ============================================================
 # HANDLERS
@@ -533,22 +2111,27 @@ async def handle_user(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if await handle_voice_save(update, ctx):
         return
     
-    chat = Chat.get(user.id)
+    key = ("user", user.id)
+    if msg.media_group_id:
+        ALBUMS.add(key, msg, functools.partial(forward_user, ctx.bot, user))
+        return
+    await ALBUMS.flush(key)
+    await forward_user(ctx.bot, user, [msg])
+
+async def forward_user(bot: Bot, user, msgs: List[Message]):
+    chat = await Chat.get(user.id)
     if not chat or chat['is_archived']:
-        topic_id = await create_topic(ctx.bot, user)
-        if WELCOME_MESSAGE: await msg.reply_text(WELCOME_MESSAGE)
-        chat = Chat.get(user.id)
+        topic_id = await create_topic(bot, user)
+        if WELCOME_MESSAGE: await msgs[0].reply_text(WELCOME_MESSAGE)
+        chat = await Chat.get(user.id)
     
     # Try to send to topic, create new if fails
-    success = await to_topic(ctx.bot, msg, chat['topic_id'], user.id)
+    success = await to_topic(bot, msgs, chat['topic_id'], user.id)
     if not success:
         # Topic doesn't exist anymore - create new one
-        topic_id = await create_topic(ctx.bot, user)
-        chat = Chat.get(user.id)
-        await to_topic(ctx.bot, msg, chat['topic_id'], user.id)
-    
-    chat = Chat.get(user.id)
-    await update_topic(ctx.bot, chat)
+        topic_id = await create_topic(bot, user)
+        chat = await Chat.get(user.id)
+        await to_topic(bot, msgs, chat['topic_id'], user.id)
 
 async def handle_admin(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     msg = update.message
@@ -562,42 +2145,54 @@ async def handle_admin(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not topic_id: return
     
     # Nur Bot-eigene Befehle ignorieren - alle anderen /commands werden weitergeleitet
-    BOT_COMMANDS = ['inbox', 'all', 'unread', 'read', 'info', 'vip', 'urgent', 'close', 'note', 't', 'v', 'save', 'del', 'search', 'help', 'hilfe', 'followup', 'done', 'skip', 'start', 'bc', 'broadcast', 'confirm', 'cancel']
+    BOT_COMMANDS = ['inbox', 'all', 'unread', 'read', 'info', 'vip', 'urgent', 'close', 'note', 't', 'v', 'save', 'del', 'search', 'help', 'hilfe', 'followup', 'done', 'skip', 'start', 'bc', 'broadcast', 'confirm', 'cancel', 'archive', 'stats']
     if msg.text:
         first_word = msg.text.split()[0].lower() if msg.text.split() else ""
         if first_word.startswith('/') and first_word[1:].split('@')[0] in BOT_COMMANDS:
             return
     
-    chat = Chat.get_by_topic(topic_id)
+    chat = await Chat.get_by_topic(topic_id)
     if not chat: return
     
+    key = ("topic", topic_id)
+    if msg.media_group_id:
+        ALBUMS.add(key, msg, functools.partial(forward_admin, ctx.bot, chat['user_id'], topic_id))
+        return
+    await ALBUMS.flush(key)
+    await forward_admin(ctx.bot, chat['user_id'], topic_id, [msg])
+
+async def forward_admin(bot: Bot, user_id: int, topic_id: int, msgs: List[Message]):
+    # Typing läuft neben dem Send her (zählt nicht gegen das Flood-Limit), Log + Umbenennung danach im Hintergrund
     if TYPING_INDICATOR:
-        try:
-            await ctx.bot.send_chat_action(chat_id=chat['user_id'], action=ChatAction.TYPING)
-            await asyncio.sleep(0.3)
-        except: pass
-    
-    if await to_user(ctx.bot, msg, chat['user_id'], topic_id):
-        chat = Chat.get(chat['user_id'])
-        await update_topic(ctx.bot, chat)
+        SIDE_EFFECTS.spawn(bot.send_chat_action(chat_id=user_id, action=ChatAction.TYPING), f"Typing an {user_id}")
+    await to_user(bot, msgs, user_id, topic_id)
 
 # ============================================================
 # COMMANDS
 # ============================================================
 
-async def cmd_inbox(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    if update.effective_chat.id != SUPPORT_GROUP_ID: return
-    unread = Chat.get_unread()
+def page_keyboard(view: str, rows: list, has_prev: bool, has_next: bool) -> Optional[InlineKeyboardMarkup]:
+    """◀️ ▶️ buttons carrying the keyset cursor of the first/last row (callback data pg:<view>:<p|n>:<cursor>)"""
+    buttons = []
+    if has_prev and rows: buttons.append(InlineKeyboardButton("◀️ Zurück", callback_data=f"pg:{view}:p:{';'.join(map(str, rows[0][0]))}"))
+    if has_next and rows: buttons.append(InlineKeyboardButton("Weiter ▶️", callback_data=f"pg:{view}:n:{';'.join(map(str, rows[-1][0]))}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+def followup_cursor(c: dict) -> tuple:
+    return (PRIORITY_RANK.get(c['priority'], 3), str(c['last_reply_at']), c['user_id'])
+
+async def render_inbox(cursor: tuple = None, forward: bool = True):
+    rows, start, total = INBOX.page(["unread"], cursor, forward)
     
     lines = ["━━━━━━━━━━━━━━━━━━━━", "📥 <b>INBOX</b>", "━━━━━━━━━━━━━━━━━━━━\n"]
     
-    if unread:
-        lines.append(f"🔴 <b>UNGELESEN ({len(unread)})</b>\n")
-        for i, c in enumerate(unread, 1):
+    if rows:
+        lines.append(f"🔴 <b>UNGELESEN ({total})</b>\n")
+        for i, (_, c) in enumerate(rows, start + 1):
             name = get_name(c)
             p = PRIORITY.get(c['priority'], "")
-            icon = msg_icon(c.get('last_message_type', ''))
-            preview = c.get('last_message_preview', '')
+            icon = msg_icon(c.get('last_message_type') or '')
+            preview = c.get('last_message_preview') or ''
             if icon: preview = f"{icon} {preview}"
             cnt = f"({c['unread_count']})" if c['unread_count'] > 1 else ""
             
@@ -610,44 +2205,112 @@ async def cmd_inbox(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     lines.append("━━━━━━━━━━━━━━━━━━━━")
     lines.append("/unread • /read • /all")
     
-    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+    return "\n".join(lines), page_keyboard("inbox", rows, start > 0, start + len(rows) < total)
 
-async def cmd_all(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    if update.effective_chat.id != SUPPORT_GROUP_ID: return
-    chats = Chat.get_all_active()
-    if not chats:
-        await update.message.reply_text("Keine aktiven Chats")
-        return
+async def render_all(cursor: tuple = None, forward: bool = True):
+    rows, start, total = INBOX.page(INBOX.statuses(), cursor, forward)
+    if not rows:
+        return "Keine aktiven Chats", None
     
-    lines = ["📋 <b>ALLE CHATS</b>\n"]
-    for c in chats[:25]:
+    lines = [f"📋 <b>ALLE CHATS</b> ({start + 1}–{start + len(rows)} von {total})\n"]
+    for _, c in rows:
         s = STATUS.get(c['status'], "")
         p = PRIORITY.get(c['priority'], "")
         lines.append(f"{p}{s} {html.escape(get_name(c))} – <i>{time_ago(c['last_message_at'])}</i>")
     
+    return "\n".join(lines), page_keyboard("all", rows, start > 0, start + len(rows) < total)
+
+async def render_followups(cursor: tuple = None, forward: bool = True):
+    # Eine Zeile mehr laden: zeigt, ob es in Blätterrichtung weitergeht
+    chats, total = await asyncio.gather(Chat.get_followups_page(cursor, forward, LIST_PAGE_SIZE + 1), Chat.count_followups_due())
+    more = len(chats) > LIST_PAGE_SIZE
+    chats = (chats[:LIST_PAGE_SIZE] if forward else chats[-LIST_PAGE_SIZE:])
+    if not chats:
+        return "✅ Keine Follow-ups fällig!", None
+    
+    lines = ["━━━━━━━━━━━━━━━━━━━━", f"📋 <b>FOLLOW-UPS ({total})</b>", "━━━━━━━━━━━━━━━━━━━━\n"]
+    
+    for c in chats:
+        name = get_name(c)
+        time = time_ago(c['last_reply_at'])
+        p = PRIORITY.get(c['priority'], "")
+        lines.append(f"{p}💛 <b>{html.escape(name)}</b>")
+        lines.append(f"   Letzte Antwort: {time}\n")
+    
+    lines.append("━━━━━━━━━━━━━━━━━━━━")
+    lines.append("<i>/done – Erledigt (nie wieder Reminder)</i>")
+    lines.append("<i>/skip – Überspring für 3 Tage</i>")
+    
+    rows = [(followup_cursor(c), c) for c in chats]
+    has_prev, has_next = (cursor is not None, more) if forward else (more, True)
+    return "\n".join(lines), page_keyboard("fu", rows, has_prev, has_next)
+
+# Blätterbare Listen: Renderer + Typen der Cursor-Felder
+PAGED_VIEWS = {
+    "inbox": (render_inbox, (int, int, float, int)),
+    "all": (render_all, (int, int, float, int)),
+    "fu": (render_followups, (int, str, int)),
+}
+
+async def on_page(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """◀️/▶️ pressed: render the neighbouring page and edit the list message in place"""
+    query = update.callback_query
+    await query.answer()
+    if update.effective_chat.id != SUPPORT_GROUP_ID: return
+    
+    _, view, direction, raw = query.data.split(":", 3)
+    if view not in PAGED_VIEWS: return
+    render, types = PAGED_VIEWS[view]
+    text, markup = await render(tuple(t(v) for t, v in zip(types, raw.split(";"))), direction == "n")
+    try:
+        await query.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+    except BadRequest as e:
+        if "not modified" not in e.message.lower(): raise
+
+async def cmd_inbox(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.id != SUPPORT_GROUP_ID: return
+    text, markup = await render_inbox()
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+
+async def cmd_all(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.id != SUPPORT_GROUP_ID: return
+    text, markup = await render_all()
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+
+async def find_chat(update: Update, query: str) -> Optional[dict]:
+    """Resolve a customer by name/@username via NAMES – replies itself when nothing or several match equally well"""
+    matches = NAMES.find(query)
+    if not matches:
+        await update.message.reply_text("Nicht gefunden")
+        return None
+    best = [c for rank, c in matches if rank == matches[0][0]]
+    if len(best) == 1:
+        return best[0]
+    lines = ["Mehrere Treffer – genauer bitte (oder im Topic):"]
+    for c in best:
+        user = f" (@{c['username']})" if c['username'] and not get_name(c).startswith("@") else ""
+        lines.append(f"• {html.escape(get_name(c))}{html.escape(user)}")
     await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+    return None
 
 async def cmd_unread(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != SUPPORT_GROUP_ID: return
     
     topic_id = update.message.message_thread_id
     if topic_id:
-        chat = Chat.get_by_topic(topic_id)
+        chat = await Chat.get_by_topic(topic_id)
         if chat:
-            Chat.mark_unread(chat['user_id'])
-            await update_topic(ctx.bot, Chat.get(chat['user_id']))
+            await Chat.mark_unread(chat['user_id'])
+            await update_topic(ctx.bot, await Chat.get(chat['user_id']))
             await update.message.reply_text("🔴 Ungelesen")
             return
     
     if ctx.args:
-        search = " ".join(ctx.args).lower()
-        for c in Chat.get_all_active():
-            if search in get_name(c).lower():
-                Chat.mark_unread(c['user_id'])
-                await update_topic(ctx.bot, Chat.get(c['user_id']))
-                await update.message.reply_text(f"🔴 {get_name(c)} → ungelesen")
-                return
-        await update.message.reply_text("Nicht gefunden")
+        c = await find_chat(update, " ".join(ctx.args))
+        if c:
+            await Chat.mark_unread(c['user_id'])
+            await update_topic(ctx.bot, await Chat.get(c['user_id']))
+            await update.message.reply_text(f"🔴 {get_name(c)} → ungelesen")
     else:
         await update.message.reply_text("Im Topic oder: /unread <name>")
 
@@ -656,22 +2319,19 @@ async def cmd_read(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     topic_id = update.message.message_thread_id
     if topic_id:
-        chat = Chat.get_by_topic(topic_id)
+        chat = await Chat.get_by_topic(topic_id)
         if chat:
-            Chat.mark_read(chat['user_id'])
-            await update_topic(ctx.bot, Chat.get(chat['user_id']))
+            await Chat.mark_read(chat['user_id'])
+            await update_topic(ctx.bot, await Chat.get(chat['user_id']))
             await update.message.reply_text("⚪ Gelesen")
             return
     
     if ctx.args:
-        search = " ".join(ctx.args).lower()
-        for c in Chat.get_all_active():
-            if search in get_name(c).lower():
-                Chat.mark_read(c['user_id'])
-                await update_topic(ctx.bot, Chat.get(c['user_id']))
-                await update.message.reply_text(f"⚪ {get_name(c)} → gelesen")
-                return
-        await update.message.reply_text("Nicht gefunden")
+        c = await find_chat(update, " ".join(ctx.args))
+        if c:
+            await Chat.mark_read(c['user_id'])
+            await update_topic(ctx.bot, await Chat.get(c['user_id']))
+            await update.message.reply_text(f"⚪ {get_name(c)} → gelesen")
     else:
         await update.message.reply_text("Im Topic oder: /read <name>")
 
@@ -680,78 +2340,132 @@ async def cmd_info(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     topic_id = update.message.message_thread_id
     if not topic_id: return await update.message.reply_text("Im Topic nutzen")
     
-    chat = Chat.get_by_topic(topic_id)
+    chat = await Chat.get_by_topic(topic_id)
     if not chat: return
     
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*), SUM(CASE WHEN direction='in' THEN 1 ELSE 0 END), SUM(CASE WHEN direction='out' THEN 1 ELSE 0 END) FROM messages WHERE user_id=?", (chat['user_id'],))
-    stats = c.fetchone()
-    conn.close()
+    stats = await get_chat_stats(chat['user_id'])
+    types = " · ".join(f"{msg_icon(t) or t} {n}" for t, n in sorted(stats['by_type'].items(), key=lambda x: -x[1]))
+    first_response = ""
+    if stats['first_in_at'] and stats['first_response_at']:
+        first_response = f"\n⏱ Erste Antwort nach {fmt_duration(stats['first_response_at'] - stats['first_in_at'])}"
     
     await update.message.reply_text(f"""<b>{html.escape(get_name(chat))}</b>
 
 🆔 <code>{chat['user_id']}</code>
 📧 @{html.escape(chat['username'] or '—')}
-💬 {stats[0] or 0} ({stats[1] or 0} ↙️ {stats[2] or 0} ↗️)
+💬 {stats['total']} ({stats['incoming']} ↙️ {stats['outgoing']} ↗️){f" – {html.escape(types)}" if types else ""}{first_response}
 📅 {chat['created_at'].strftime('%d.%m.%Y') if chat['created_at'] else '—'}""", parse_mode=ParseMode.HTML)
 
 async def cmd_vip(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != SUPPORT_GROUP_ID: return
     topic_id = update.message.message_thread_id
     if not topic_id: return
-    chat = Chat.get_by_topic(topic_id)
+    chat = await Chat.get_by_topic(topic_id)
     if not chat: return
     
     new = "normal" if chat['priority'] == "vip" else "vip"
-    Chat.set_priority(chat['user_id'], new)
-    await update_topic(ctx.bot, Chat.get(chat['user_id']))
+    await Chat.set_priority(chat['user_id'], new)
+    await update_topic(ctx.bot, await Chat.get(chat['user_id']))
     await update.message.reply_text("⭐ VIP" if new == "vip" else "VIP aus")
 
 async def cmd_urgent(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != SUPPORT_GROUP_ID: return
     topic_id = update.message.message_thread_id
     if not topic_id: return
-    chat = Chat.get_by_topic(topic_id)
+    chat = await Chat.get_by_topic(topic_id)
     if not chat: return
     
     new = "normal" if chat['priority'] == "urgent" else "urgent"
-    Chat.set_priority(chat['user_id'], new)
-    await update_topic(ctx.bot, Chat.get(chat['user_id']))
+    await Chat.set_priority(chat['user_id'], new)
+    await update_topic(ctx.bot, await Chat.get(chat['user_id']))
     await update.message.reply_text("🚨 Urgent" if new == "urgent" else "Urgent aus")
 
 async def cmd_close(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != SUPPORT_GROUP_ID: return
     topic_id = update.message.message_thread_id
     if not topic_id: return
-    chat = Chat.get_by_topic(topic_id)
+    chat = await Chat.get_by_topic(topic_id)
     if not chat: return
     
-    Chat.archive(chat['user_id'])
+    await Chat.archive(chat['user_id'])
     try: await ctx.bot.close_forum_topic(chat_id=SUPPORT_GROUP_ID, message_thread_id=topic_id)
-    except: pass
+    except TelegramError as e: logging.warning(f"Topic {topic_id} schließen fehlgeschlagen: {e}")
     await update.message.reply_text("⚫ Archiviert")
 
+async def cmd_archive(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """Auto-archive dry run: what the next run would archive; /archive jetzt runs it now"""
+    if update.effective_chat.id != SUPPORT_GROUP_ID: return
+    
+    if ctx.args and ctx.args[0].lower() in ("jetzt", "now"):
+        archived = await archive_stale_chats(ctx.bot)
+        await update.message.reply_text(f"🗄 {archived} archiviert – Topics werden im Hintergrund geschlossen")
+        return
+    
+    cutoff = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    stale, total, queued = await asyncio.gather(Chat.get_stale(cutoff, 10), Chat.count_stale(cutoff), count_topic_close_queue())
+    
+    lines = ["🗄 <b>AUTO-ARCHIV</b> (Vorschau)\n", f"Seit {ARCHIVE_AFTER_DAYS} Tagen still: <b>{total}</b>"]
+    for c in stale:
+        lines.append(f"• {html.escape(get_name(c))} – <i>{time_ago(c['last_message_at'])}</i>")
+    if total > len(stale):
+        lines.append(f"<i>... +{total - len(stale)} weitere</i>")
+    lines.append(f"\nTopics noch zu schließen: {queued}")
+    if total:
+        lines.append("/archive jetzt – sofort archivieren")
+    
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+def fmt_ms(seconds: float) -> str:
+    return f"{seconds * 1000:.0f}ms" if seconds < 10 else f"{seconds:.0f}s"
+
+async def cmd_stats(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """Where does the time go: handler latency, Telegram API, DB and queues since start"""
+    if update.effective_chat.id != SUPPORT_GROUP_ID: return
+    
+    uptime = timedelta(seconds=int(time.time() - METRICS.started))
+    lines = [f"📈 <b>STATS</b> (seit {uptime})\n", "<b>Handler</b> p50 / p95 / Anzahl"]
+    handlers = sorted(METRICS.series("support_handler_seconds").items(), key=lambda kv: -kv[1].count)
+    for labels, hist in handlers[:12]:
+        lines.append(f"• {dict(labels)['handler']}: {fmt_ms(hist.quantile(0.5))} / {fmt_ms(hist.quantile(0.95))} / {hist.count}")
+    
+    calls = METRICS.series("support_api_calls_total")
+    errors = sum(METRICS.series("support_api_errors_total").values())
+    retries = sum(METRICS.series("support_api_retry_after_total").values())
+    lines.append(f"\n<b>Telegram API</b>: {sum(calls.values()):.0f} Calls, {errors:.0f} Fehler, {retries:.0f}× RetryAfter")
+    for labels, n in sorted(calls.items(), key=lambda kv: -kv[1])[:5]:
+        lines.append(f"• {dict(labels)['method']}: {n:.0f}")
+    
+    db = METRICS.series("support_db_seconds")
+    lines.append("")
+    for kind in ("read", "write"):
+        hists = [h for labels, h in db.items() if dict(labels)['kind'] == kind]
+        n = sum(h.count for h in hists)
+        avg = sum(h.sum for h in hists) / n if n else 0
+        lines.append(f"<b>DB {kind}</b>: {n} × ⌀ {fmt_ms(avg)}")
+    
+    lines.append("\n<b>Queues</b>")
+    for (name, labels), fn in METRICS.gauges.items():
+        try: value = fn()
+        except Exception: continue
+        suffix = f" ({', '.join(v for _, v in labels)})" if labels else ""
+        lines.append(f"• {name.removeprefix('support_')}{suffix}: {value}")
+    
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
 async def cmd_note(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != SUPPORT_GROUP_ID: return
     topic_id = update.message.message_thread_id
     if not topic_id: return
-    chat = Chat.get_by_topic(topic_id)
+    chat = await Chat.get_by_topic(topic_id)
     if not chat: return
     
     note = " ".join(ctx.args) if ctx.args else ""
-    conn = get_db()
-    c = conn.cursor()
     
     if note:
-        c.execute("INSERT INTO notes (user_id, note) VALUES (?,?)", (chat['user_id'], note))
-        conn.commit()
-        conn.close()
+        await add_note(chat['user_id'], note)
         await update.message.reply_text(f"📝 {note}")
     else:
-        c.execute("SELECT note, created_at FROM notes WHERE user_id=? ORDER BY created_at DESC LIMIT 5", (chat['user_id'],))
-        notes = c.fetchall()
-        conn.close()
+        notes = await get_notes(chat['user_id'])
         if notes:
             lines = ["📝 <b>Notizen</b>\n"]
             for n, d in notes:
@@ -771,7 +2485,7 @@ async def cmd_t(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     topic_id = update.message.message_thread_id
     if not topic_id: return await update.message.reply_text("Im Topic")
-    chat = Chat.get_by_topic(topic_id)
+    chat = await Chat.get_by_topic(topic_id)
     if not chat: return
     
     tmpl = TEMPLATES.get(ctx.args[0].lower())
@@ -779,9 +2493,8 @@ async def cmd_t(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     try:
         await ctx.bot.send_message(chat_id=chat['user_id'], text=tmpl)
-        log_msg(chat['user_id'], "out", "text", tmpl)
-        Chat.mark_answered(chat['user_id'])
-        await update_topic(ctx.bot, Chat.get(chat['user_id']))
+        await asyncio.gather(log_msg(chat['user_id'], "out", "text", tmpl), Chat.mark_answered(chat['user_id']))
+        await update_topic(ctx.bot, await Chat.get(chat['user_id']))
     except Exception as e:
         await update.message.reply_text(f"⚠️ {e}")
 
@@ -795,11 +2508,7 @@ async def cmd_save(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     if not ctx.args:
         # Liste alle gespeicherten Voice-Templates
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("SELECT name, duration FROM voice_templates ORDER BY name")
-        templates = c.fetchall()
-        conn.close()
+        templates = await get_voice_templates()
         
         if templates:
             lines = ["🎤 <b>Gespeicherte Sprachnachrichten</b>\n"]
@@ -832,12 +2541,7 @@ async def handle_voice_save(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     file_id = voice.file_id
     duration = voice.duration or 0
     
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO voice_templates (name, file_id, duration) VALUES (?, ?, ?)", 
-              (name, file_id, duration))
-    conn.commit()
-    conn.close()
+    await save_voice_template(name, file_id, duration)
     
     await update.message.reply_text(f"✅ Sprachnachricht <b>{name}</b> gespeichert!\n\nNutze /v {name} im Topic", parse_mode=ParseMode.HTML)
     return True
@@ -848,11 +2552,7 @@ async def cmd_v(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     if not ctx.args:
         # Liste alle Voice-Templates
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("SELECT name, duration FROM voice_templates ORDER BY name")
-        templates = c.fetchall()
-        conn.close()
+        templates = await get_voice_templates()
         
         if templates:
             lines = ["🎤 <b>Sprachnachrichten</b>\n"]
@@ -866,15 +2566,11 @@ async def cmd_v(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     topic_id = update.message.message_thread_id
     if not topic_id: return await update.message.reply_text("Im Topic nutzen")
     
-    chat = Chat.get_by_topic(topic_id)
+    chat = await Chat.get_by_topic(topic_id)
     if not chat: return
     
     name = ctx.args[0].lower()
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT file_id, duration FROM voice_templates WHERE name=?", (name,))
-    row = c.fetchone()
-    conn.close()
+    row = await get_voice_template(name)
     
     if not row:
         return await update.message.reply_text(f"❌ '{name}' nicht gefunden\n/v für Liste")
@@ -883,8 +2579,8 @@ async def cmd_v(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     try:
         await ctx.bot.send_voice(chat_id=chat['user_id'], voice=file_id)
-        log_msg(chat['user_id'], "out", "voice", f"[Voice: {name}]", file_id, duration)
-        Chat.mark_answered(chat['user_id'])
+        await asyncio.gather(log_msg(chat['user_id'], "out", "voice", f"[Voice: {name}]", file_id, duration),
+                             Chat.mark_answered(chat['user_id']))
         await update.message.reply_text(f"🎤 ✓", parse_mode=ParseMode.HTML)
     except Exception as e:
         await update.message.reply_text(f"⚠️ {e}")
@@ -898,68 +2594,158 @@ async def cmd_del(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return await update.message.reply_text("/del name → löscht Sprachnachricht")
     
     name = ctx.args[0].lower()
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("DELETE FROM voice_templates WHERE name=?", (name,))
-    deleted = c.rowcount
-    conn.commit()
-    conn.close()
+    deleted = await delete_voice_template(name)
     
     if deleted:
         await update.message.reply_text(f"🗑 <b>{name}</b> gelöscht", parse_mode=ParseMode.HTML)
     else:
         await update.message.reply_text(f"❌ '{name}' nicht gefunden")
 
+SEARCH_HELP = """<b>🔍 Suche</b>
+
+/search wort – alle Wörter müssen vorkommen
+/search "ganzer satz" – exakte Phrase
+/search bestell* – Präfix
+
+<b>Filter</b> (kombinierbar)
+dir:in / dir:out – nur Kunde / nur wir
+kunde:anna, kunde:@user, kunde:12345
+ab:2024-01-31, bis:2024-02-28
+archiv:ja – auch archivierte (ältere) Nachrichten
+seite:2 – weitere Treffer"""
+
 async def cmd_search(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != SUPPORT_GROUP_ID: return
     q = " ".join(ctx.args) if ctx.args else ""
-    if not q: return await update.message.reply_text("/search <text>")
+    query = parse_search(q) if q else None
+    if not query: return await update.message.reply_text(SEARCH_HELP, parse_mode=ParseMode.HTML)
     
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT m.content, m.direction, c.first_name FROM messages m JOIN chats c ON m.user_id=c.user_id WHERE m.content LIKE ? ORDER BY m.created_at DESC LIMIT 10", (f"%{q}%",))
-    results = c.fetchall()
-    conn.close()
+    results, has_more = await search_messages(query)
     
     if not results: return await update.message.reply_text("Nichts gefunden")
     
-    lines = [f"🔍 <b>'{html.escape(q)}'</b>\n"]
-    for content, direction, name in results:
+    page = query['page']
+    lines = [f"🔍 <b>'{html.escape(q)}'</b>" + (f" – Seite {page}" if page > 1 else "") + "\n"]
+    for content, direction, name, created_at, snippet in results:
         arrow = "↗️" if direction == "out" else "↙️"
-        lines.append(f"{arrow} <b>{html.escape(name or '?')}</b>: {html.escape(content[:40])}")
+        text = html.escape((snippet or content or "")[:120]).replace("\x02", "<b>").replace("\x03", "</b>")
+        if text.count("<b>") > text.count("</b>"): text += "</b>"
+        date = created_at.strftime('%d.%m.%y') if created_at else ""
+        lines.append(f"{arrow} <b>{html.escape(name or '?')}</b> <i>{date}</i>: {text}")
+    if has_more:
+        rest = re.sub(r"\s*seite:\d+", "", q)
+        lines.append(f"\n<i>Mehr: /search {html.escape(rest)} seite:{page + 1}</i>")
     await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
 
+# ============================================================
+# FOLLOW-UP TIMER
+# ============================================================
+
+def followup_due(chat: dict) -> Optional[datetime]:
+    """When the next reminder of a chat is due – None if there's nothing to remind (not answered, done, last stage, ...)"""
+    stage = chat['followup_stage'] or 0
+    if (chat['is_archived'] or chat['status'] != 'answered' or chat['followup_done'] or not chat.get('followup_enabled', 1)
+            or not chat['last_reply_at'] or stage >= len(FOLLOWUP_STAGES_HOURS)):
+        return None
+    due = chat['last_reply_at'] + timedelta(hours=FOLLOWUP_STAGES_HOURS[stage])
+    skipped = chat['followup_skipped_until']
+    return max(due, skipped) if skipped else due
+
+class FollowupTimers:
+    """One timer per answered chat, kept in a heap. Armed, moved and disarmed from the chat state on every change
+    (CHAT_CACHE.put: mark_answered arms, new_message/done disarm, skip shifts), restored at startup.
+    A single task sleeps until the next timer is due and posts the reminder into the topic"""
+
+    def __init__(self):
+        self.due = {}    # user_id → datetime
+        self.heap = []   # (due, user_id); veraltete Einträge werden beim Herausnehmen übersprungen
+        self.wake: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def update(self, chat: dict):
+        self.arm(chat['user_id'], followup_due(chat))
+
+    def arm(self, user_id: int, due: Optional[datetime]):
+        if self.due.get(user_id) == due: return
+        if due is None:
+            del self.due[user_id]
+            return
+        self.due[user_id] = due
+        heapq.heappush(self.heap, (due, user_id))
+        if self.wake and self.heap[0] == (due, user_id):
+            self.wake.set()  # früher als bisher nächster Timer
+
+    def rebuild(self, chats: List[dict]):
+        self.due = {c['user_id']: due for c in chats if (due := followup_due(c))}
+        self.heap = [(due, user_id) for user_id, due in self.due.items()]
+        heapq.heapify(self.heap)
+
+    def start(self, bot: Bot):
+        self.wake = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self._run(bot), name="followup-timers")
+
+    def cancel(self):
+        if self.task: self.task.cancel()
+
+    async def _run(self, bot: Bot):
+        while True:
+            while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            delay = (self.heap[0][0] - datetime.now()).total_seconds() if self.heap else None
+            if delay is None or delay > 0:
+                self.wake.clear()
+                try: await asyncio.wait_for(self.wake.wait(), delay)
+                except asyncio.TimeoutError: pass
+                continue
+            
+            _, user_id = heapq.heappop(self.heap)
+            del self.due[user_id]
+            try:
+                await self.fire(bot, user_id)
+            except Exception as e:
+                logging.warning(f"Follow-up für {user_id} fehlgeschlagen, neuer Versuch in {FOLLOWUP_RETRY_MINUTES} min: {e!r}")
+                self.arm(user_id, datetime.now() + timedelta(minutes=FOLLOWUP_RETRY_MINUTES))
+
+    async def fire(self, bot: Bot, user_id: int):
+        chat = await Chat.get(user_id)
+        due = followup_due(chat) if chat else None
+        now = datetime.now()
+        if due is None or due > now:
+            return self.arm(user_id, due)  # Zustand hat sich inzwischen geändert
+        
+        # War der Bot offline, nur die jüngste fällige Stufe posten statt mehrere auf einmal
+        stage = chat['followup_stage'] or 0
+        while stage + 1 < len(FOLLOWUP_STAGES_HOURS) and chat['last_reply_at'] + timedelta(hours=FOLLOWUP_STAGES_HOURS[stage + 1]) <= now:
+            stage += 1
+        
+        text = (f"💛 <b>Follow-up fällig</b> ({stage + 1}/{len(FOLLOWUP_STAGES_HOURS)})\n"
+                f"Keine Antwort seit {time_ago(chat['last_reply_at'])}\n\n"
+                f"/done – erledigt • /skip – später")
+        # Stufe vor dem Senden weiterschalten (→ arm() plant die nächste): scheitert erst das Schreiben danach,
+        # würde ein neuer Versuch dieselbe Erinnerung ein zweites Mal posten
+        await Chat.set_followup_stage(user_id, stage + 1)
+        try:
+            await bot.send_message(chat_id=SUPPORT_GROUP_ID, message_thread_id=chat['topic_id'], text=text,
+                                   parse_mode=ParseMode.HTML, rate_limit_args=LANE_BULK)
+        except BadRequest as e:
+            # Topic weg o.ä. – wird durch Warten nicht besser, Stufe bleibt weitergeschaltet
+            logging.warning(f"Follow-up-Erinnerung für {user_id} nicht gepostet: {e}")
+        except Exception:
+            # Nicht gepostet (Netzwerk, Flood) → Stufe zurück, _run versucht es in FOLLOWUP_RETRY_MINUTES erneut
+            await Chat.set_followup_stage(user_id, chat['followup_stage'] or 0)
+            raise
+
+FOLLOWUPS = FollowupTimers()
+
 # ============================================================
 # FOLLOW-UP COMMANDS
 # ============================================================
 
 async def cmd_followup(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    """Show all pending follow-ups"""
+    """Show pending follow-ups (paged)"""
     if update.effective_chat.id != SUPPORT_GROUP_ID: return
-    
-    followups = Chat.get_followups_due()
-    
-    if not followups:
-        await update.message.reply_text("✅ Keine Follow-ups fällig!")
-        return
-    
-    lines = ["━━━━━━━━━━━━━━━━━━━━", f"📋 <b>FOLLOW-UPS ({len(followups)})</b>", "━━━━━━━━━━━━━━━━━━━━\n"]
-    
-    for c in followups[:15]:
-        name = get_name(c)
-        time = time_ago(c['last_reply_at'])
-        p = PRIORITY.get(c['priority'], "")
-        lines.append(f"{p}💛 <b>{html.escape(name)}</b>")
-        lines.append(f"   Letzte Antwort: {time}\n")
-    
-    if len(followups) > 15:
-        lines.append(f"<i>... +{len(followups)-15} weitere</i>\n")
-    
-    lines.append("━━━━━━━━━━━━━━━━━━━━")
-    lines.append("<i>/done – Erledigt (nie wieder Reminder)</i>")
-    lines.append("<i>/skip – Überspring für 3 Tage</i>")
-    
-    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+    text, markup = await render_followups()
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
 
 async def cmd_done(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """Mark follow-up as done"""
@@ -967,20 +2753,17 @@ async def cmd_done(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     topic_id = update.message.message_thread_id
     if topic_id:
-        chat = Chat.get_by_topic(topic_id)
+        chat = await Chat.get_by_topic(topic_id)
         if chat:
-            Chat.mark_followup_done(chat['user_id'])
+            await Chat.mark_followup_done(chat['user_id'])
             await update.message.reply_text("✅ Follow-up erledigt – keine weiteren Reminder")
             return
     
     if ctx.args:
-        search = " ".join(ctx.args).lower()
-        for c in Chat.get_all_active():
-            if search in get_name(c).lower():
-                Chat.mark_followup_done(c['user_id'])
-                await update.message.reply_text(f"✅ {get_name(c)} – Follow-up erledigt")
-                return
-        await update.message.reply_text("Nicht gefunden")
+        c = await find_chat(update, " ".join(ctx.args))
+        if c:
+            await Chat.mark_followup_done(c['user_id'])
+            await update.message.reply_text(f"✅ {get_name(c)} – Follow-up erledigt")
     else:
         await update.message.reply_text("Im Topic oder: /done <name>")
 
@@ -994,20 +2777,17 @@ async def cmd_skip(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     topic_id = update.message.message_thread_id
     if topic_id:
-        chat = Chat.get_by_topic(topic_id)
+        chat = await Chat.get_by_topic(topic_id)
         if chat:
-            Chat.skip_followup(chat['user_id'], days)
+            await Chat.skip_followup(chat['user_id'], days)
             await update.message.reply_text(f"⏭️ Follow-up übersprungen für {days} Tage")
             return
     
     if ctx.args:
-        search = ctx.args[0].lower()
-        for c in Chat.get_all_active():
-            if search in get_name(c).lower():
-                Chat.skip_followup(c['user_id'], days)
-                await update.message.reply_text(f"⏭️ {get_name(c)} – Follow-up übersprungen für {days} Tage")
-                return
-        await update.message.reply_text("Nicht gefunden")
+        c = await find_chat(update, " ".join(ctx.args[:-1] if len(ctx.args) > 1 and ctx.args[-1].isdigit() else ctx.args))
+        if c:
+            await Chat.skip_followup(c['user_id'], days)
+            await update.message.reply_text(f"⏭️ {get_name(c)} – Follow-up übersprungen für {days} Tage")
     else:
         await update.message.reply_text("Im Topic oder: /skip <name> [tage]")
 
@@ -1018,6 +2798,8 @@ async def cmd_help(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 /inbox – Ungelesene
 /all – Alle Chats
 /search – Suchen
+/archive – Auto-Archiv Vorschau (jetzt = sofort)
+/stats – Latenzen, API-Calls, Queues
 
 <b>Follow-Up</b>
 /followup – Alle anstehenden
@@ -1041,6 +2823,94 @@ async def cmd_help(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 # Pending broadcasts waiting for confirmation
 PENDING_BROADCAST = {}
 
+# Laufende Broadcast-Tasks (broadcast_id → Task); Zustand liegt in SQLite
+RUNNING_BROADCASTS = {}
+
+def start_broadcast(bot: Bot, broadcast: dict):
+    if broadcast['id'] in RUNNING_BROADCASTS: return
+    task = asyncio.get_running_loop().create_task(run_broadcast(bot, broadcast), name=f"broadcast-{broadcast['id']}")
+    RUNNING_BROADCASTS[broadcast['id']] = task
+    task.add_done_callback(lambda t: RUNNING_BROADCASTS.pop(broadcast['id'], None))
+
+async def send_broadcast_message(bot: Bot, broadcast: dict, user_id: int):
+    """Send to one recipient with retries for transient errors; records the outcome"""
+    error = None
+    for attempt in range(BROADCAST_MAX_ATTEMPTS):
+        try:
+            await bot.send_message(chat_id=user_id, text=broadcast['message'], rate_limit_args=LANE_BULK)
+        except (BadRequest, Forbidden) as e:
+            # Bot blockiert, Chat weg, ... → endgültig
+            error = e
+            break
+        except (NetworkError, RetryAfter) as e:
+            # Vorübergehend → mit Backoff erneut versuchen
+            error = e
+            await asyncio.sleep(2 ** attempt)
+        except TelegramError as e:
+            error = e
+            break
+        else:
+            error = None
+            break
+    if error is not None:
+        await set_recipient_state(broadcast['id'], user_id, "failed", str(error))
+        return
+    # Gesendet ist gesendet: scheitert die Buchung, nur loggen – nie den Empfänger erneut anschreiben
+    results = await asyncio.gather(set_recipient_state(broadcast['id'], user_id, "sent"), Chat.mark_answered(user_id),
+                                   log_msg(user_id, "out", "text", f"[Broadcast] {broadcast['message'][:50]}"),
+                                   return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logging.error(f"Broadcast {broadcast['id']}: an {user_id} gesendet, Buchung fehlgeschlagen: {result!r}")
+
+async def report_broadcast(bot: Bot, broadcast: dict, final: bool = False, reported: int = None) -> int:
+    """Edit the status message; returns sent+failed. Skips the edit if that hasn't changed since `reported`"""
+    counts = await get_broadcast_counts(broadcast['id'])
+    sent, failed, pending = counts.get("sent", 0), counts.get("failed", 0), counts.get("pending", 0)
+    if not final and sent + failed == reported:
+        return reported   # gleicher Text → Edit würde nur ein Token kosten und mit "not modified" scheitern
+    if final:
+        text = f"""✅ <b>Broadcast gesendet!</b>
+
+📤 Gesendet: {sent}
+❌ Fehlgeschlagen: {failed}"""
+    else:
+        text = f"📤 Sende... {sent + failed}/{sent + failed + pending}"
+    try:
+        await bot.edit_message_text(text, chat_id=broadcast['status_chat_id'], message_id=broadcast['status_message_id'],
+                                    parse_mode=ParseMode.HTML, rate_limit_args=LANE_BULK)
+    except TelegramError:
+        pass
+    return sent + failed
+
+async def run_broadcast(bot: Bot, broadcast: dict):
+    """Send all still-pending recipients with bounded concurrency (the rate limiter sets the pace)"""
+    pending = await get_broadcast_pending(broadcast['id'])
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    
+    async def send_one(user_id: int):
+        async with sem:
+            try:
+                await send_broadcast_message(bot, broadcast, user_id)
+            except Exception as e:
+                logging.error(f"Broadcast {broadcast['id']}: Empfänger {user_id} fehlgeschlagen: {e!r}")
+    
+    async def progress():
+        reported = None
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_SECONDS)
+            reported = await report_broadcast(bot, broadcast, reported=reported)
+    
+    reporter = asyncio.get_running_loop().create_task(progress())
+    try:
+        # Ein Fehler bei einem Empfänger darf den Rest nicht abbrechen (sonst startet sync_broadcasts den
+        # Broadcast neu, während die übrigen Sends noch laufen → doppelte Nachrichten)
+        await asyncio.gather(*(send_one(u) for u in pending), return_exceptions=True)
+    finally:
+        reporter.cancel()
+    await finish_broadcast(broadcast['id'])
+    await report_broadcast(bot, broadcast, final=True)
+
 async def cmd_broadcast(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """Broadcast message to multiple users"""
     if update.effective_chat.id != SUPPORT_GROUP_ID: return
@@ -1065,15 +2935,13 @@ async def cmd_broadcast(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     recipients = []
     
     if target == "followup":
-        followups = Chat.get_followups_due()
-        for stage in ['overdue', 'urgent', 'due']:
-            recipients.extend(followups.get(stage, []))
+        recipients = await Chat.get_followups_due()
         target_name = "Follow-ups"
     elif target == "all":
-        recipients = Chat.get_all_active()
+        recipients = await Chat.get_all_active()
         target_name = "Alle aktiven"
     elif target == "vip":
-        recipients = [c for c in Chat.get_all_active() if c['priority'] == 'vip']
+        recipients = [c for c in await Chat.get_all_active() if c['priority'] == 'vip']
         target_name = "VIPs"
     else:
         await update.message.reply_text("❌ Unbekanntes Ziel. Nutze: followup, all, vip")
@@ -1089,7 +2957,7 @@ async def cmd_broadcast(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     # Store pending broadcast
     PENDING_BROADCAST[user_id] = {
-        'recipients': recipients,
+        'user_ids': [r['user_id'] for r in recipients],
         'message': message,
         'target_name': target_name
     }
@@ -1123,35 +2991,16 @@ async def cmd_confirm(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Kein Broadcast ausstehend")
         return
     
-    broadcast = PENDING_BROADCAST.pop(user_id)
-    recipients = broadcast['recipients']
-    message = broadcast['message']
-    
-    sent = 0
-    failed = 0
-    
-    status_msg = await update.message.reply_text(f"📤 Sende... 0/{len(recipients)}")
+    pending = PENDING_BROADCAST.pop(user_id)
+    status_msg = await update.message.reply_text(f"📤 Sende... 0/{len(pending['user_ids'])}")
     
-    for i, recipient in enumerate(recipients):
-        try:
-            await ctx.bot.send_message(chat_id=recipient['user_id'], text=message)
-            Chat.mark_answered(recipient['user_id'])
-            log_msg(recipient['user_id'], "out", "text", f"[Broadcast] {message[:50]}")
-            sent += 1
-        except Exception as e:
-            failed += 1
-        
-        # Update status every 5 messages
-        if (i + 1) % 5 == 0:
-            try:
-                await status_msg.edit_text(f"📤 Sende... {i + 1}/{len(recipients)}")
-            except:
-                pass
-    
-    await status_msg.edit_text(f"""✅ <b>Broadcast gesendet!</b>
-
-📤 Gesendet: {sent}
-❌ Fehlgeschlagen: {failed}""", parse_mode=ParseMode.HTML)
+    # Erst persistieren, dann im Hintergrund senden – der Befehl blockiert nicht
+    broadcast_id = await create_broadcast(user_id, pending['target_name'], pending['message'], pending['user_ids'],
+                                          status_msg.chat_id, status_msg.message_id)
+    # Broadcasts laufen auf dem Leader – eine andere Instanz holt ihn beim nächsten Lease-Tick ab
+    if LEADER.is_leader:
+        start_broadcast(ctx.bot, {'id': broadcast_id, 'message': pending['message'],
+                                  'status_chat_id': status_msg.chat_id, 'status_message_id': status_msg.message_id})
 
 async def cmd_cancel(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """Cancel pending broadcast"""
@@ -1160,6 +3009,13 @@ async def cmd_cancel(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if user_id in PENDING_BROADCAST:
         del PENDING_BROADCAST[user_id]
         await update.message.reply_text("❌ Broadcast abgebrochen")
+    elif user_id in ADMIN_IDS and (running := await get_running_broadcasts()):
+        # Laufende Broadcasts stoppen – bereits gesendete bleiben gesendet. Läuft er auf einer anderen
+        # Instanz, stoppt ihn deren nächster Lease-Tick (Status in der DB ist nicht mehr 'running')
+        for broadcast in running:
+            if broadcast['id'] in RUNNING_BROADCASTS: RUNNING_BROADCASTS[broadcast['id']].cancel()
+            await finish_broadcast(broadcast['id'], "cancelled")
+        await update.message.reply_text("⏹ Laufender Broadcast gestoppt")
     else:
         await update.message.reply_text("Nichts zum Abbrechen")
 
@@ -1168,91 +3024,403 @@ async def cmd_cancel(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 # ============================================================
 
 async def job_digest(ctx: ContextTypes.DEFAULT_TYPE):
-    unread = Chat.get_unread()
-    old = [c for c in unread if c['last_message_at'] and (datetime.now() - c['last_message_at']).seconds > 1800]
-    if not old: return
+    waiting, old = INBOX.older_than("unread", datetime.now() - timedelta(minutes=30), limit=5)
+    if not waiting: return
     
-    lines = [f"📬 <b>{len(old)} warten!</b>\n"]
-    for c in old[:5]:
+    lines = [f"📬 <b>{waiting} warten!</b>\n"]
+    for c in old:
         lines.append(f"• {html.escape(get_name(c))} – {time_ago(c['last_message_at'])}")
     lines.append("\n/inbox")
     
-    await ctx.bot.send_message(chat_id=SUPPORT_GROUP_ID, text="\n".join(lines), parse_mode=ParseMode.HTML)
+    await ctx.bot.send_message(chat_id=SUPPORT_GROUP_ID, text="\n".join(lines), parse_mode=ParseMode.HTML, rate_limit_args=LANE_BULK)
 
 async def job_followup_morning(ctx: ContextTypes.DEFAULT_TYPE):
     """Daily morning follow-up report"""
-    followups = Chat.get_followups_due()
+    followups, total = await asyncio.gather(Chat.get_followups_page(limit=10), Chat.count_followups_due())
     
     if not followups:
         return  # No follow-ups needed
     
     lines = ["━━━━━━━━━━━━━━━━━━━━", "☀️ <b>GUTEN MORGEN!</b>", "━━━━━━━━━━━━━━━━━━━━\n"]
-    lines.append(f"📋 <b>{len(followups)} Follow-ups fällig</b>\n")
+    lines.append(f"📋 <b>{total} Follow-ups fällig</b>\n")
     
-    for c in followups[:10]:
+    for c in followups:
         name = get_name(c)
         time = time_ago(c['last_reply_at'])
         p = PRIORITY.get(c['priority'], "")
         lines.append(f"{p}💛 {html.escape(name)} – {time}")
     
-    if len(followups) > 10:
-        lines.append(f"\n... +{len(followups)-10} weitere")
+    if total > len(followups):
+        lines.append(f"\n... +{total - len(followups)} weitere")
     
     lines.append("\n━━━━━━━━━━━━━━━━━━━━")
     lines.append("/followup für Details")
     
-    await ctx.bot.send_message(chat_id=SUPPORT_GROUP_ID, text="\n".join(lines), parse_mode=ParseMode.HTML)
+    await ctx.bot.send_message(chat_id=SUPPORT_GROUP_ID, text="\n".join(lines), parse_mode=ParseMode.HTML, rate_limit_args=LANE_BULK)
+
+class TopicCloser:
+    """Drains topic_close_queue in the background on LANE_BULK: the rate limiter sets the pace and interactive
+    traffic goes first. A topic leaves the queue once it is closed (or can't be), so nothing is closed twice"""
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+
+    def kick(self, bot: Bot):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run(bot), name="topic-closer")
+
+    async def _run(self, bot: Bot):
+        while topic_ids := await get_topic_close_queue():
+            for topic_id in topic_ids:
+                try:
+                    await bot.close_forum_topic(chat_id=SUPPORT_GROUP_ID, message_thread_id=topic_id, rate_limit_args=LANE_BULK)
+                except BadRequest as e:
+                    # Schon zu oder gelöscht → erledigt; andere Ablehnungen werden nicht besser
+                    if not (is_topic_missing(e) or "not_modified" in e.message.lower()):
+                        logging.warning(f"Topic {topic_id} schließen fehlgeschlagen: {e}")
+                except TelegramError as e:
+                    logging.warning(f"Topics schließen unterbrochen, nächster Lauf macht weiter: {e!r}")
+                    return
+                await dequeue_topic_close(topic_id)
+
+    def cancel(self):
+        if self.task: self.task.cancel()
+
+TOPIC_CLOSER = TopicCloser()
+
+async def archive_stale_chats(bot: Bot) -> int:
+    """Archive stale chats in ARCHIVE_BATCH_SIZE transactions (progress is committed per batch), then close their topics"""
+    cutoff = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    archived = 0
+    while True:
+        batch = await Chat.archive_stale(cutoff)
+        archived += len(batch)
+        if len(batch) < ARCHIVE_BATCH_SIZE: break
+    if archived: logging.info(f"Auto-Archiv: {archived} Chats archiviert")
+    # Die Queue leert der Leader (/archive jetzt auf einer anderen Instanz: beim nächsten Leader-Tick)
+    if LEADER.is_leader: TOPIC_CLOSER.kick(bot)
+    return archived
 
 async def job_archive(ctx: ContextTypes.DEFAULT_TYPE):
+    await archive_stale_chats(ctx.bot)
+
+async def job_retention(ctx: ContextTypes.DEFAULT_TYPE):
+    await run_retention()
+
+# ============================================================
+# REPLICAS (Leader-Lease, Abgleich der Chat-Caches)
+# ============================================================
+
+@db_write
+def acquire_lease(name: str, holder: str, ttl: float) -> bool:
+    now = time.time()
+    return get_db().execute(SQL_ACQUIRE_LEASE, {'name': name, 'holder': holder, 'expires_at': now + ttl, 'now': now}).fetchone() is not None
+
+@db_write
+def release_lease(name: str, holder: str):
+    get_db().execute("DELETE FROM leases WHERE name=? AND holder=?", (name, holder))
+
+class LeaseBackend(abc.ABC):
+    """Where the leader lease lives. A shared store (Redis SET NX PX, etcd, a Postgres row, ...) subclasses this and
+    registers in LEASE_BACKENDS; acquire() must atomically take or renew the lease and return whether we hold it"""
+
+    @abc.abstractmethod
+    async def acquire(self, name: str, holder: str, ttl: float) -> bool: ...
+
+    @abc.abstractmethod
+    async def release(self, name: str, holder: str): ...
+
+class SQLiteLease(LeaseBackend):
+    """Lease row in support.db – for instances sharing the DB file (one host or one volume)"""
+
+    async def acquire(self, name: str, holder: str, ttl: float) -> bool:
+        return await acquire_lease(name, holder, ttl)
+
+    async def release(self, name: str, holder: str):
+        await release_lease(name, holder)
+
+LEASE_BACKENDS = {"sqlite": SQLiteLease}
+
+class LeaderElection:
+    """Renews the lease every LEASE_RENEW_SECONDS. If renewing fails or stalls (store unreachable, busy DB),
+    a deadline timer drops leadership shortly before the lease can expire for the others – independent of the
+    renewal loop, so never two leaders at once"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.is_leader = False
+        self.valid_until = 0.0   # loop.time(), bis zu der die Lease sicher uns gehört
+        self.task: Optional[asyncio.Task] = None
+        self.backend: Optional[LeaseBackend] = None
+        self.deadline: Optional[asyncio.TimerHandle] = None
+        self.demoting: Optional[asyncio.Task] = None
+
+    def start(self, backend: LeaseBackend, on_elected: Callable[[], Awaitable], on_demoted: Callable[[], Awaitable],
+              on_tick: Callable[[], Awaitable]):
+        self.backend = backend
+        self.task = asyncio.get_running_loop().create_task(self._run(on_elected, on_demoted, on_tick), name="leader-election")
+
+    def _expire(self, on_demoted: Callable[[], Awaitable]):
+        """Deadline timer: the lease wasn't renewed in time and may belong to someone else now"""
+        if not self.is_leader: return
+        logging.warning(f"Leader-Lease nicht rechtzeitig erneuert – {REPLICA_ID} gibt ab")
+        self.is_leader = False
+        self.demoting = SIDE_EFFECTS.spawn(on_demoted(), "Leader abgeben")
+
+    async def _run(self, on_elected, on_demoted, on_tick):
+        loop = asyncio.get_running_loop()
+        while True:
+            t0 = loop.time()
+            # Als Leader nur bis valid_until auf den Store warten – danach hat der Deadline-Timer schon abgegeben
+            timeout = self.valid_until - t0 if self.is_leader else LEASE_RENEW_SECONDS
+            try:
+                held = await asyncio.wait_for(self.backend.acquire(self.name, REPLICA_ID, LEASE_TTL_SECONDS), max(timeout, 0.1))
+            except Exception as e:
+                logging.warning(f"Leader-Lease nicht erneuert: {e!r}")
+                held = None
+            if held:
+                self.valid_until = t0 + LEASE_TTL_SECONDS - LEASE_RENEW_SECONDS
+                if self.deadline: self.deadline.cancel()
+                self.deadline = loop.call_at(self.valid_until, self._expire, on_demoted)
+            leader = bool(held) or (held is None and self.is_leader and loop.time() < self.valid_until)
+            if leader != self.is_leader:
+                self.is_leader = leader
+                if not leader and self.deadline: self.deadline.cancel()
+                if self.demoting:
+                    await asyncio.gather(self.demoting, return_exceptions=True)  # Abgabe durch den Timer erst abschließen
+                    self.demoting = None
+                try: await (on_elected() if leader else on_demoted())
+                except Exception as e: logging.error(f"Leader-Wechsel fehlgeschlagen: {e!r}")
+            # Fester Takt ab t0: ein hängender Tick (Broadcast-Abgleich, DB) darf die nächste Verlängerung nicht verzögern
+            next_renew = t0 + LEASE_RENEW_SECONDS
+            if self.is_leader:
+                try: await asyncio.wait_for(on_tick(), max(next_renew - loop.time(), 0.1))
+                except Exception as e: logging.warning(f"Leader-Tick fehlgeschlagen: {e!r}")
+            await asyncio.sleep(max(next_renew - loop.time(), 0))
+
+    async def stop(self, on_demoted: Callable[[], Awaitable]):
+        """Shutdown: hand the lease over right away instead of letting it expire"""
+        if self.task:
+            self.task.cancel()
+            try: await self.task
+            except asyncio.CancelledError: pass
+        if self.deadline: self.deadline.cancel()
+        if self.is_leader:
+            self.is_leader = False
+            await on_demoted()
+            try: await self.backend.release(self.name, REPLICA_ID)
+            except Exception as e: logging.warning(f"Leader-Lease nicht freigegeben: {e!r}")
+
+LEADER = LeaderElection("jobs")
+
+def leader_only(fn):
+    """Scheduled job that runs on the leader only (every instance schedules it, the others skip)"""
+    @functools.wraps(fn)
+    async def wrapper(ctx: ContextTypes.DEFAULT_TYPE):
+        if LEADER.is_leader: return await fn(ctx)
+    return wrapper
+
+@db_read
+def get_last_chat_change() -> int:
+    return get_db().execute("SELECT COALESCE(MAX(seq), 0) FROM chat_changes").fetchone()[0]
+
+@db_write
+def prune_chat_changes():
+    get_db().execute("DELETE FROM chat_changes WHERE changed_at < datetime('now', ?)", (f"-{CHAT_CHANGES_KEEP_MINUTES} minutes",))
+
+def _poll_chat_changes(since: int, version: Optional[int]) -> Tuple[int, int, List[dict]]:
+    """Writer thread (sees every commit, ordered with our own group commits): chats changed since `since`.
+    PRAGMA data_version of this connection only moves when another process committed"""
     conn = get_db()
-    c = conn.cursor()
-    cutoff = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
-    c.execute("SELECT user_id, topic_id FROM chats WHERE is_archived=0 AND last_message_at<?", (cutoff,))
-    
-    for user_id, topic_id in c.fetchall():
-        try: await ctx.bot.close_forum_topic(chat_id=SUPPORT_GROUP_ID, message_thread_id=topic_id)
-        except: pass
-        c.execute("UPDATE chats SET is_archived=1, status='closed' WHERE user_id=?", (user_id,))
-    
-    conn.commit()
-    conn.close()
+    current = conn.execute("PRAGMA data_version").fetchone()[0]
+    if current == version: return current, since, []
+    changes = conn.execute(SQL_CHAT_CHANGES, (since,)).fetchall()
+    if not changes: return current, since, []
+    c = conn.execute("SELECT * FROM chats WHERE user_id IN (SELECT value FROM json_each(?))", (json.dumps([u for u, _ in changes]),))
+    cols = [d[0] for d in c.description]
+    return current, max(seq for _, seq in changes), [dict(zip(cols, r)) for r in c.fetchall()]
+
+class ChatChangeFeed:
+    """Keeps CHAT_CACHE – and with it INBOX, NAMES and FOLLOWUPS – current when other instances write the DB.
+    A single instance only pays one PRAGMA per poll"""
+
+    def __init__(self):
+        self.seq = 0
+        self.version: Optional[int] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Call before loading the chats, so nothing committed in between is missed"""
+        self.seq = await get_last_chat_change()
+        self.task = asyncio.get_running_loop().create_task(self._run(), name="chat-change-feed")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(REPLICA_SYNC_MS / 1000)
+            try:
+                self.version, self.seq, chats = await loop.run_in_executor(DB_WRITER, _poll_chat_changes, self.seq, self.version)
+            except Exception as e:
+                logging.warning(f"Chat-Abgleich fehlgeschlagen: {e!r}")
+                continue
+            for chat in chats:
+                CHAT_CACHE.put(chat)
+            if chats: METRICS.inc("support_replica_synced_chats_total", len(chats))
+
+    def cancel(self):
+        if self.task: self.task.cancel()
+
+CHAT_CHANGES = ChatChangeFeed()
+
+async def sync_broadcasts(bot: Bot):
+    """Leader: run every broadcast that is 'running' in the DB (after failover, /confirm on another instance),
+    stop local ones that were cancelled elsewhere"""
+    running = {b['id']: b for b in await get_running_broadcasts()}
+    for broadcast_id, task in list(RUNNING_BROADCASTS.items()):
+        if broadcast_id not in running: task.cancel()
+    for broadcast_id, broadcast in running.items():
+        if broadcast_id not in RUNNING_BROADCASTS:
+            logging.info(f"Broadcast {broadcast_id} wird fortgesetzt")
+            start_broadcast(bot, broadcast)
+
+async def become_leader(bot: Bot):
+    logging.info(f"👑 {REPLICA_ID} ist Leader – Jobs, Follow-up-Timer, Topic-Schließen und Broadcasts laufen hier")
+    FOLLOWUPS.start(bot)
+    TOPIC_CLOSER.kick(bot)  # vor dem Leader-Wechsel nicht mehr geschlossene Topics
+    await sync_broadcasts(bot)
+
+async def step_down():
+    logging.info(f"{REPLICA_ID} ist nicht mehr Leader")
+    FOLLOWUPS.cancel()
+    TOPIC_CLOSER.cancel()
+    # Broadcasts anhalten – der neue Leader macht mit den offenen Empfängern weiter
+    for task in list(RUNNING_BROADCASTS.values()):
+        task.cancel()
+    await asyncio.gather(*RUNNING_BROADCASTS.values(), return_exceptions=True)
+
+async def leader_tick(bot: Bot):
+    await sync_broadcasts(bot)
+    TOPIC_CLOSER.kick(bot)  # läuft schon → nichts; sonst leert er, was andere Instanzen eingereiht haben
+    await prune_chat_changes()
 
 # ============================================================
 # MAIN
 # ============================================================
 
+async def job_checkpoint(ctx: ContextTypes.DEFAULT_TYPE):
+    await db_checkpoint()
+
+async def post_init(app: Application):
+    # Inbox, Namens-Index und Follow-up-Timer einmal aus SQLite laden, danach hält sie jede Chat-Änderung aktuell
+    # (auch die anderer Instanzen, siehe ChatChangeFeed)
+    await CHAT_CHANGES.start()
+    chats = await Chat.get_all_active()
+    INBOX.rebuild(chats)
+    NAMES.rebuild(chats)
+    FOLLOWUPS.rebuild(chats)
+    if METRICS_PORT:
+        METRICS.server = await asyncio.start_server(serve_metrics, METRICS_LISTEN, METRICS_PORT)
+    # Follow-up-Timer, Topic-Schließen und (unterbrochene) Broadcasts startet, wer Leader wird
+    LEADER.start(LEASE_BACKENDS[LEASE_BACKEND](), functools.partial(become_leader, app.bot), step_down,
+                 functools.partial(leader_tick, app.bot))
+
+async def post_stop(app: Application):
+    # Noch gesammelte Alben abschicken, solange der Bot noch senden kann; Nacharbeiten abwarten
+    await ALBUMS.flush()
+    await SIDE_EFFECTS.drain()
+
+async def post_shutdown(app: Application):
+    if METRICS.server: METRICS.server.close()
+    await LEADER.stop(step_down)
+    CHAT_CHANGES.cancel()
+    # Laufende Broadcasts anhalten – sie laufen nach dem Neustart weiter
+    for task in list(RUNNING_BROADCASTS.values()):
+        task.cancel()
+    await asyncio.gather(*RUNNING_BROADCASTS.values(), return_exceptions=True)
+    TOPIC_RENAMER.cancel_all()
+    TOPIC_CLOSER.cancel()
+    FOLLOWUPS.cancel()
+    await JOURNAL.close()
+    close_db()
+
+def register_gauges(limiter: SupportRateLimiter, processor: ConversationUpdateProcessor):
+    """Queue depths and in-memory state, read on every scrape / /stats"""
+    METRICS.gauge("support_updates_in_flight", lambda: sum(n for _, n in processor.locks.values()))
+    METRICS.gauge("support_rate_waiters", lambda: len(limiter.global_gate.waiters), gate="global")
+    METRICS.gauge("support_rate_waiters", lambda: sum(len(g.waiters) for g in limiter.chat_gates.values()), gate="chats")
+    METRICS.gauge("support_journal_queue", lambda: JOURNAL.queue.qsize() if JOURNAL.queue else 0)
+    METRICS.gauge("support_side_effects", lambda: len(SIDE_EFFECTS.tasks))
+    METRICS.gauge("support_pending_albums", lambda: len(ALBUMS.pending))
+    METRICS.gauge("support_pending_renames", lambda: len(TOPIC_RENAMER.pending))
+    METRICS.gauge("support_followup_timers", lambda: len(FOLLOWUPS.due))
+    METRICS.gauge("support_running_broadcasts", lambda: len(RUNNING_BROADCASTS))
+    METRICS.gauge("support_open_chats", lambda: INBOX.count())
+    METRICS.gauge("support_unread_chats", lambda: INBOX.count("unread"))
+    METRICS.gauge("support_chat_cache_size", lambda: len(CHAT_CACHE.by_user))
+    METRICS.gauge("support_is_leader", lambda: int(LEADER.is_leader))
+
 def main():
     logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
     init_db()
     
-    app = Application.builder().token(BOT_TOKEN).build()
+    limiter, processor = SupportRateLimiter(), ConversationUpdateProcessor(MAX_CONCURRENT_UPDATES)
+    builder = (Application.builder().token(BOT_TOKEN).rate_limiter(limiter).concurrent_updates(processor)
+               .post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown))
+    if BOT_API_URL:
+        builder = builder.base_url(f"{BOT_API_URL.rstrip('/')}/bot").base_file_url(f"{BOT_API_URL.rstrip('/')}/file/bot")
+    app = builder.build()
+    register_gauges(limiter, processor)
+    handler = timed("support_handler", "handler")
+    job = timed("support_job", "job")
     
     # Delete "topic renamed" service messages
-    app.add_handler(MessageHandler(filters.Chat(SUPPORT_GROUP_ID) & filters.StatusUpdate.FORUM_TOPIC_EDITED, delete_service_messages), group=0)
+    app.add_handler(MessageHandler(filters.Chat(SUPPORT_GROUP_ID) & filters.StatusUpdate.FORUM_TOPIC_EDITED, handler(delete_service_messages)), group=0)
     
     # Private messages - also catch voice for /save
-    app.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.VOICE, handle_user))
-    app.add_handler(MessageHandler(filters.ChatType.PRIVATE & ~filters.COMMAND, handle_user))
+    app.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.VOICE, handler(handle_user)))
+    app.add_handler(MessageHandler(filters.ChatType.PRIVATE & ~filters.COMMAND, handler(handle_user)))
     # Allow ALL messages in support group (including /commands for Quick Replies)
-    app.add_handler(MessageHandler(filters.Chat(SUPPORT_GROUP_ID), handle_admin), group=1)
+    app.add_handler(MessageHandler(filters.Chat(SUPPORT_GROUP_ID), handler(handle_admin)), group=1)
     
     for cmd, fn in [("inbox", cmd_inbox), ("all", cmd_all), ("unread", cmd_unread), ("read", cmd_read),
                     ("info", cmd_info), ("vip", cmd_vip), ("urgent", cmd_urgent), ("close", cmd_close),
                     ("note", cmd_note), ("t", cmd_t), ("v", cmd_v), ("save", cmd_save), ("del", cmd_del),
                     ("search", cmd_search), ("help", cmd_help), ("hilfe", cmd_help),
                     ("followup", cmd_followup), ("done", cmd_done), ("skip", cmd_skip),
-                    ("bc", cmd_broadcast), ("broadcast", cmd_broadcast), ("confirm", cmd_confirm), ("cancel", cmd_cancel)]:
-        app.add_handler(CommandHandler(cmd, fn))
+                    ("bc", cmd_broadcast), ("broadcast", cmd_broadcast), ("confirm", cmd_confirm), ("cancel", cmd_cancel),
+                    ("archive", cmd_archive), ("stats", cmd_stats)]:
+        app.add_handler(CommandHandler(cmd, handler(fn)))
+    app.add_handler(CallbackQueryHandler(handler(on_page), pattern=r"^pg:"))
     
-    app.job_queue.run_repeating(job_digest, interval=DIGEST_INTERVAL_MINUTES * 60, first=300)
-    app.job_queue.run_repeating(job_archive, interval=3600, first=60)
+    # Jede Instanz plant die Jobs, ausgeführt werden sie nur vom Leader
+    app.job_queue.run_repeating(job(leader_only(job_digest)), interval=DIGEST_INTERVAL_MINUTES * 60, first=300)
+    app.job_queue.run_repeating(job(leader_only(job_archive)), interval=3600, first=60)
+    app.job_queue.run_repeating(job(leader_only(job_retention)), interval=RETENTION_INTERVAL_MINUTES * 60, first=600)
+    app.job_queue.run_repeating(job(job_checkpoint), interval=DB_CHECKPOINT_MINUTES * 60, first=DB_CHECKPOINT_MINUTES * 60)
     
     # Morning follow-up report at 9:00
     from datetime import time as dt_time
-    app.job_queue.run_daily(job_followup_morning, time=dt_time(hour=FOLLOWUP_MORNING_HOUR, minute=0))
+    app.job_queue.run_daily(job(leader_only(job_followup_morning)), time=dt_time(hour=FOLLOWUP_MORNING_HOUR, minute=0))
     
     print("🚀 Support Bot + Follow-Up System gestartet")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        if not WEBHOOK_SECRET:
+            logging.warning("WEBHOOK_SECRET nicht gesetzt – Webhook-Requests werden nicht authentifiziert")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or None, max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        app.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == "__main__":
+    if sys.argv[1:] == ["--check-plans"]:
+        init_db()
+        if not FTS_ENABLED: HOT_QUERIES.pop("search_messages")
+        problems = check_query_plans(get_db())
+        for p in problems: print(f"❌ {p}")
+        print("✅ Alle Hot Queries nutzen Indizes" if not problems else f"{len(problems)} Query(s) mit Full Table Scan oder Sortierung")
+        sys.exit(1 if problems else 0)
     main()
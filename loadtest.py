@@ -0,0 +1,391 @@
+"""
+End-to-End-Lasttest: bot.py gegen einen lokalen Fake-Bot-API-Server
+
+    python loadtest.py                                   # 60s, 0.2 Kundennachrichten/s, 0.1 Antworten/s
+    python loadtest.py --customers 500 --rate 2 --reply-rate 1 --duration 300 --json run.json
+    python loadtest.py --api-latency-ms 80 --retry-after 0.02 --topic-deleted 0.01
+    python loadtest.py --record stream.jsonl --duration 120    # Stream speichern …
+    python loadtest.py --replay stream.jsonl --speed 4         # … und 4× so schnell abspielen
+
+Der Bot läuft als eigener Prozess im Webhook-Modus (BOT_API_URL zeigt auf den Fake-Server,
+DB_PATH auf eine Temp-DB). Der Generator schickt Updates an den Webhook; der Fake-Server
+protokolliert jeden API-Call und ordnet copyMessage/copyMessages dem gesendeten Update zu.
+Gemessen wird vom POST des Updates bis zur Kopie im Topic bzw. beim Kunden – inklusive
+Rate Limiter, DB und Fake-API-Latenz.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+from urllib.parse import parse_qsl
+
+import httpx
+
+SUPPORT_GROUP_ID = -1001234567890
+ADMIN_ID = 4242
+BOT_TOKEN = "123456:LOADTEST"
+USER_ID_BASE = 1_000_000
+STARTUP_METHODS = {"getMe", "setWebhook", "deleteWebhook", "setMyCommands", "getWebhookInfo"}
+
+FIRST_NAMES = ["Anna", "Ben", "Clara", "David", "Emma", "Felix", "Greta", "Hannah", "Jonas", "Lea", "Lukas", "Marie"]
+WORDS = ("bestellung lieferung rechnung paket adresse zahlung rückerstattung konto passwort frage danke hallo "
+         "problem termin preis rabatt gutschein versand größe farbe umtausch retoure nummer status").split()
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def param(value: str):
+    """PTB sends form fields with JSON-encoded values (ids, lists), plain strings stay strings"""
+    try: return json.loads(value)
+    except ValueError: return value
+
+def percentiles(values: list) -> dict:
+    if not values: return {}
+    v = sorted(values)
+    at = lambda q: v[min(len(v) - 1, int(q * len(v)))]
+    return {"n": len(v), "p50": at(0.5), "p90": at(0.9), "p95": at(0.95), "p99": at(0.99), "max": v[-1]}
+
+# ============================================================
+# FAKE BOT API
+# ============================================================
+
+class FakeBotAPI:
+    """Minimal Bot API over HTTP/1.1 keep-alive: records every call, answers with plausible objects,
+    injects latency, 429 RetryAfter and deleted forum topics. Matches copies to the updates sent"""
+
+    def __init__(self, rng: random.Random, latency_ms: float, jitter_ms: float, retry_after: float,
+                 retry_after_seconds: int, topic_deleted: float):
+        self.rng = rng
+        self.latency_ms, self.jitter_ms = latency_ms, jitter_ms
+        self.retry_after, self.retry_after_seconds, self.topic_deleted = retry_after, retry_after_seconds, topic_deleted
+        self.calls = []            # (zeit, methode, status)
+        self.ids = iter(range(10_000_000, 1 << 62))
+        self.threads = iter(range(100, 1 << 62))
+        self.deleted = set()       # gelöschte message_thread_ids
+        self.topics = {}           # kunde → aktuelles Topic (aus der ersten Kopie hinein)
+        self.sent = {}             # (chat_id, message_id) → Sendezeitpunkt des Updates
+        self.latency = {"in": [], "out": []}
+        self.injected = Counter()
+        self.ready = asyncio.Event()
+        self.server = None
+
+    async def start(self, port: int):
+        self.server = await asyncio.start_server(self.serve, "127.0.0.1", port)
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                _, path, _ = line.decode().split(" ", 2)
+                headers = {}
+                while (h := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    k, _, v = h.decode().partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                params = {}
+                if headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+                    params = {k: param(v) for k, v in parse_qsl(body.decode())}
+                status, payload = await self.call(path.rsplit("/", 1)[-1], params)
+                out = json.dumps(payload).encode()
+                writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(out)}\r\n\r\n".encode() + out)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def call(self, method: str, p: dict) -> tuple:
+        if method not in STARTUP_METHODS and self.latency_ms:
+            await asyncio.sleep(max(0.0, self.rng.gauss(self.latency_ms, self.jitter_ms)) / 1000)
+        status, payload = self.answer(method, p)
+        self.calls.append((time.perf_counter(), method, status))
+        if method == "setWebhook": self.ready.set()
+        return status, payload
+
+    def error(self, code: int, description: str, **parameters) -> tuple:
+        payload = {"ok": False, "error_code": code, "description": description}
+        if parameters: payload["parameters"] = parameters
+        return code, payload
+
+    def message(self, p: dict) -> dict:
+        chat_id = int(p.get("chat_id", 0))
+        return {"message_id": next(self.ids), "date": int(time.time()), "text": str(p.get("text", "")),
+                "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"}}
+
+    def answer(self, method: str, p: dict) -> tuple:
+        if method not in STARTUP_METHODS and self.rng.random() < self.retry_after:
+            self.injected["RetryAfter"] += 1
+            return self.error(429, f"Too Many Requests: retry after {self.retry_after_seconds}", retry_after=self.retry_after_seconds)
+        thread = p.get("message_thread_id")
+        if thread in self.deleted:
+            return self.error(400, "Bad Request: message thread not found")
+        if method in ("copyMessage", "copyMessages") and thread and self.rng.random() < self.topic_deleted:
+            self.deleted.add(thread)
+            self.injected["Topic gelöscht"] += 1
+            return self.error(400, "Bad Request: message thread not found")
+
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": int(BOT_TOKEN.split(":")[0]), "is_bot": True, "first_name": "Loadtest",
+                                                "username": "loadtest_bot", "can_join_groups": True,
+                                                "can_read_all_group_messages": True, "supports_inline_queries": False}}
+        if method == "createForumTopic":
+            self.injected["Topics angelegt"] += 1
+            return 200, {"ok": True, "result": {"message_thread_id": next(self.threads), "name": p.get("name", ""), "icon_color": 7322096}}
+        if method == "getChat":
+            return 200, {"ok": True, "result": {"id": int(p["chat_id"]), "type": "supergroup", "title": "Support",
+                                                "is_forum": True, "accent_color_id": 0, "max_reaction_count": 11}}
+        if method in ("copyMessage", "copyMessages"):
+            mids = [p["message_id"]] if method == "copyMessage" else p["message_ids"]
+            self.delivered(int(p["from_chat_id"]), mids, int(p["chat_id"]), thread)
+            result = [{"message_id": next(self.ids)} for _ in mids]
+            return 200, {"ok": True, "result": result[0] if method == "copyMessage" else result}
+        if method.startswith("send") and method != "sendChatAction" or method.startswith("editMessage"):
+            return 200, {"ok": True, "result": self.message(p)}
+        return 200, {"ok": True, "result": True}
+
+    def delivered(self, from_chat: int, mids: list, to_chat: int, thread):
+        now = time.perf_counter()
+        if to_chat == SUPPORT_GROUP_ID and thread: self.topics[from_chat] = thread
+        for mid in mids:
+            t0 = self.sent.pop((from_chat, mid), None)
+            if t0 is not None:
+                self.latency["in" if from_chat > 0 else "out"].append((now - t0) * 1000)
+
+# ============================================================
+# TRAFFIC
+# ============================================================
+
+def user_update(uid: int, mid: int, text: str = None, album: str = None) -> dict:
+    name = FIRST_NAMES[uid % len(FIRST_NAMES)]
+    msg = {"message_id": mid, "date": int(time.time()),
+           "chat": {"id": uid, "type": "private", "first_name": name},
+           "from": {"id": uid, "is_bot": False, "first_name": name, "username": f"kunde{uid}"}}
+    if album:
+        msg.update(media_group_id=album, photo=[{"file_id": f"photo-{uid}-{mid}", "file_unique_id": f"p{uid}{mid}", "width": 1280, "height": 960}])
+    else:
+        msg["text"] = text
+    return {"message": msg}
+
+def admin_update(mid: int, text: str) -> dict:
+    return {"message": {"message_id": mid, "date": int(time.time()), "text": text, "is_topic_message": True,
+                        "chat": {"id": SUPPORT_GROUP_ID, "type": "supergroup", "title": "Support", "is_forum": True},
+                        "from": {"id": ADMIN_ID, "is_bot": False, "first_name": "Support"}}}
+
+def synthetic(rng: random.Random, customers: int, rate: float, reply_rate: float, album_ratio: float, duration: float) -> list:
+    """Poisson arrivals of customer messages (some as albums) and admin replies to customers who already wrote.
+    Admin events carry the customer; the topic id is filled in at send time"""
+    events, seen, mids, group_mid = [], [], Counter(), 0
+    sentence = lambda: " ".join(rng.choices(WORDS, k=rng.randint(2, 12)))
+    streams = [("user", rate), ("admin", reply_rate)]
+    for kind, r in streams:
+        t = 0.0
+        while r > 0 and (t := t + rng.expovariate(r)) < duration:
+            events.append({"t": t, "kind": kind})
+    events.sort(key=lambda e: e["t"])
+    out = []
+    for e in events:
+        if e["kind"] == "user":
+            uid = USER_ID_BASE + rng.randrange(customers)
+            if uid not in mids: seen.append(uid)
+            if rng.random() < album_ratio:
+                group = f"album-{uid}-{mids[uid]}"
+                for i in range(rng.randint(2, 5)):
+                    mids[uid] += 1
+                    out.append({"t": e["t"] + i * 0.05, "kind": "user", "customer": uid, "update": user_update(uid, mids[uid], album=group)})
+            else:
+                mids[uid] += 1
+                out.append({"t": e["t"], "kind": "user", "customer": uid, "update": user_update(uid, mids[uid], sentence())})
+        elif seen:
+            group_mid += 1
+            out.append({"t": e["t"], "kind": "admin", "customer": rng.choice(seen), "update": admin_update(group_mid, sentence())})
+    return out
+
+def load_stream(path: Path) -> list:
+    """Recorded stream: one {"t", "update", ["kind", "customer"]} per line. Group messages get our support group;
+    with "customer" set, message_thread_id is resolved to that customer's current topic at send time"""
+    events = []
+    for line in path.read_text().splitlines():
+        if not line.strip(): continue
+        e = json.loads(line)
+        msg = e["update"].get("message") or {}
+        if msg.get("chat", {}).get("type") != "private" and msg.get("chat"):
+            msg["chat"]["id"] = SUPPORT_GROUP_ID
+            e.setdefault("kind", "admin")
+        events.append(e)
+    return sorted(events, key=lambda e: e["t"])
+
+class Generator:
+    def __init__(self, api: FakeBotAPI, webhook: str, secret: str, connections: int):
+        self.api, self.webhook = api, webhook
+        self.client = httpx.AsyncClient(headers={"X-Telegram-Bot-Api-Secret-Token": secret},
+                                        limits=httpx.Limits(max_connections=connections), timeout=30)
+        self.update_ids = iter(range(1, 1 << 62))
+        self.stats = Counter()
+        self.max_lag = 0.0
+
+    async def post(self, e: dict):
+        update = dict(e["update"], update_id=next(self.update_ids))
+        msg = update.get("message") or {}
+        if e.get("kind") == "admin" and e.get("customer"):
+            thread = self.api.topics.get(e["customer"])
+            if not thread or thread in self.api.deleted:
+                self.stats["übersprungen (kein Topic)"] += 1
+                return
+            msg["message_thread_id"] = thread
+        if msg: self.api.sent[(msg["chat"]["id"], msg["message_id"])] = time.perf_counter()
+        try:
+            r = await self.client.post(self.webhook, json=update)
+            self.stats["gesendet" if r.status_code == 200 else f"Webhook HTTP {r.status_code}"] += 1
+        except httpx.HTTPError as ex:
+            self.stats[f"Webhook {type(ex).__name__}"] += 1
+        self.stats["Kunde" if e.get("kind") != "admin" else "Admin"] += 1
+
+    async def run(self, events: list, speed: float):
+        start, tasks = time.perf_counter(), set()
+        for e in events:
+            delay = start + e["t"] / speed - time.perf_counter()
+            if delay > 0: await asyncio.sleep(delay)
+            else: self.max_lag = max(self.max_lag, -delay)
+            task = asyncio.create_task(self.post(e))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - start
+
+# ============================================================
+# ABLAUF
+# ============================================================
+
+def start_bot(api_port: int, webhook_port: int, secret: str, db: Path, log: Path, metrics_port: int) -> subprocess.Popen:
+    env = dict(os.environ, BOT_TOKEN=BOT_TOKEN, SUPPORT_GROUP_ID=str(SUPPORT_GROUP_ID), ADMIN_IDS=str(ADMIN_ID),
+               BOT_API_URL=f"http://127.0.0.1:{api_port}", WEBHOOK_URL=f"http://127.0.0.1:{webhook_port}",
+               WEBHOOK_LISTEN="127.0.0.1", PORT=str(webhook_port), WEBHOOK_SECRET=secret,
+               DB_PATH=str(db), METRICS_PORT=str(metrics_port), PYTHONUNBUFFERED="1")
+    return subprocess.Popen([sys.executable, str(Path(__file__).parent / "bot.py")], env=env,
+                            stdout=log.open("w"), stderr=subprocess.STDOUT)
+
+async def stop_bot(proc: subprocess.Popen):
+    proc.send_signal(signal.SIGINT)
+    for _ in range(150):
+        if proc.poll() is not None: return
+        await asyncio.sleep(0.1)
+    proc.kill()
+
+async def settle(api: FakeBotAPI, drain: float, quiet: float):
+    """Wait until every sent message arrived (or `drain` ran out), then until no API call came for `quiet`
+    seconds – so coalesced topic renames and other follow-up calls are counted too"""
+    deadline = time.perf_counter() + drain
+    while api.sent and time.perf_counter() < deadline:
+        await asyncio.sleep(0.1)
+    while time.perf_counter() < deadline and api.calls and time.perf_counter() - api.calls[-1][0] < quiet:
+        await asyncio.sleep(0.1)
+
+def report(api: FakeBotAPI, gen: Generator, elapsed: float, messages: int) -> dict:
+    calls = [(m, s) for _, m, s in api.calls if m not in STARTUP_METHODS]
+    by_method, errors = Counter(m for m, _ in calls), Counter(m for m, s in calls if s != 200)
+    result = {
+        "duration_s": round(elapsed, 1),
+        "messages": messages,
+        "throughput_per_s": round(messages / elapsed, 2) if elapsed else 0,
+        "generator": dict(gen.stats),
+        "generator_max_lag_ms": round(gen.max_lag * 1000, 1),
+        "undelivered": len(api.sent),
+        "latency_ms": {"kunde→topic": percentiles(api.latency["in"]), "admin→kunde": percentiles(api.latency["out"])},
+        "api_calls": len(calls),
+        "api_calls_per_message": round(len(calls) / messages, 2) if messages else 0,
+        "api_methods": {m: {"calls": n, "errors": errors[m]} for m, n in by_method.most_common()},
+        "injected": dict(api.injected),
+    }
+
+    print(f"\n{messages} Nachrichten in {elapsed:.1f}s ({result['throughput_per_s']}/s), "
+          f"{result['undelivered']} nicht zugestellt, Generator-Verzug max. {result['generator_max_lag_ms']} ms")
+    print(f"\n{'Latenz (ms)':<14} {'n':>7} {'p50':>9} {'p90':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for name, p in result["latency_ms"].items():
+        if p: print(f"{name:<14} {p['n']:>7} " + " ".join(f"{p[k]:>9.1f}" for k in ("p50", "p90", "p95", "p99", "max")))
+    print(f"\nAPI-Calls: {len(calls)} ({result['api_calls_per_message']} pro Nachricht)")
+    for m, n in by_method.most_common():
+        print(f"  {m:<22} {n:>7} {n / messages if messages else 0:>7.2f}/Nachr." + (f"  {errors[m]} Fehler" if errors[m] else ""))
+    if api.injected:
+        print("Simuliert: " + ", ".join(f"{k} {v}" for k, v in api.injected.items()))
+    return result
+
+async def run(args):
+    rng = random.Random(args.seed)
+    if args.replay:
+        events = load_stream(args.replay)
+    else:
+        events = synthetic(rng, args.customers, args.rate, args.reply_rate, args.albums, args.duration)
+    if args.record:
+        args.record.write_text("".join(json.dumps(e, ensure_ascii=False) + "\n" for e in events))
+        print(f"📼 {len(events)} Updates nach {args.record} geschrieben")
+    if not events:
+        print("Keine Updates zu senden")
+        return None
+
+    api = FakeBotAPI(rng, args.api_latency_ms, args.api_jitter_ms, args.retry_after, args.retry_after_seconds, args.topic_deleted)
+    api_port, webhook_port, secret = free_port(), free_port(), "loadtest"
+    await api.start(api_port)
+    workdir = Path(tempfile.mkdtemp(prefix="support-loadtest-"))
+    log = args.bot_log or workdir / "bot.log"
+    proc = start_bot(api_port, webhook_port, secret, workdir / "support.db", log, args.metrics_port)
+    try:
+        try:
+            await asyncio.wait_for(api.ready.wait(), 30)
+        except asyncio.TimeoutError:
+            sys.exit(f"Bot nicht gestartet, siehe {log}")
+        await asyncio.sleep(0.5)  # Webhook-Server lauscht, post_init ist durch
+        print(f"🚀 {len(events)} Updates an den Bot (Log: {log})")
+        gen = Generator(api, f"http://127.0.0.1:{webhook_port}/telegram", secret, args.connections)
+        elapsed = await gen.run(events, args.speed)
+        await settle(api, args.drain, args.quiet)
+        await gen.client.aclose()
+        return report(api, gen, elapsed, gen.stats["gesendet"])
+    finally:
+        await stop_bot(proc)
+        api.server.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-End-Lasttest für bot.py")
+    traffic = parser.add_argument_group("Traffic")
+    traffic.add_argument("--customers", type=int, default=100, help="Anzahl verschiedener Kunden")
+    traffic.add_argument("--rate", type=float, default=0.2, help="Kundennachrichten pro Sekunde")
+    traffic.add_argument("--reply-rate", type=float, default=0.1, help="Admin-Antworten pro Sekunde")
+    traffic.add_argument("--albums", type=float, default=0.05, help="Anteil Kundennachrichten als Album (2–5 Fotos)")
+    traffic.add_argument("--duration", type=float, default=60, help="Sekunden synthetischer Traffic")
+    traffic.add_argument("--seed", type=int, default=42)
+    traffic.add_argument("--record", type=Path, help="Update-Stream als JSONL speichern")
+    traffic.add_argument("--replay", type=Path, help="gespeicherten/aufgezeichneten Stream abspielen")
+    traffic.add_argument("--speed", type=float, default=1.0, help="Zeitraffer-Faktor")
+    traffic.add_argument("--connections", type=int, default=40, help="parallele Webhook-Verbindungen")
+    fake = parser.add_argument_group("Fake-API")
+    fake.add_argument("--api-latency-ms", type=float, default=50)
+    fake.add_argument("--api-jitter-ms", type=float, default=15)
+    fake.add_argument("--retry-after", type=float, default=0.0, help="Anteil Calls mit 429 RetryAfter")
+    fake.add_argument("--retry-after-seconds", type=int, default=1)
+    fake.add_argument("--topic-deleted", type=float, default=0.0, help="Anteil Kopien ins Topic, bei denen das Topic gelöscht ist")
+    parser.add_argument("--drain", type=float, default=60, help="max. Sekunden warten, bis alles zugestellt ist")
+    parser.add_argument("--quiet", type=float, default=4, help="so lange ohne API-Call = fertig (Topic-Umbenennungen)")
+    parser.add_argument("--metrics-port", type=int, default=0, help="Prometheus-Endpoint des Bots währenddessen")
+    parser.add_argument("--bot-log", type=Path)
+    parser.add_argument("--json", type=Path, help="Ergebnis als JSON schreiben")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    if result and args.json:
+        args.json.write_text(json.dumps({"args": {k: str(v) if isinstance(v, Path) else v for k, v in vars(args).items()},
+                                         "result": result}, indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()